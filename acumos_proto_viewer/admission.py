@@ -0,0 +1,137 @@
+# Acumos - Apache 2.0
+
+
+from collections import OrderedDict
+import math
+import time
+from tornado import gen
+from tornado.locks import Semaphore
+
+from acumos_proto_viewer import get_module_logger
+from acumos_proto_viewer.exceptions import IngestRejected
+
+_logger = get_module_logger(__name__)
+
+
+class _ModelState(object):
+    """
+    Admission bookkeeping for one model
+    """
+    def __init__(self, concurrency, rate, now):
+        self.semaphore = Semaphore(concurrency)
+        self.rate = rate
+        self.tokens = float(rate)
+        self.refilled_at = now
+        self.queued = 0
+        self.accepted = 0
+        self.rejected_rate = 0
+
+
+class AdmissionController(object):
+    """
+    Bounds the ingest work accepted by the server.
+    At most max_queue requests are queued or running in total; each model runs
+    at most `concurrency` of them at once and, if rate is not zero, is admitted
+    at most `rate` messages per second on average (a token bucket holding one
+    second of messages). Requests over either limit are rejected with
+    IngestRejected instead of piling up in memory.
+    Models are keyed by a header of the request, so at most max_models are tracked:
+    beyond that, the least recently used model with no request queued or running is
+    forgotten, along with its counters and its token bucket.
+    Must be used from the IOLoop thread.
+    """
+    def __init__(self, max_queue, concurrency, rate, clock=time.monotonic, max_models=1000):
+        self._max_queue = max_queue
+        self._concurrency = concurrency
+        self._rate = rate
+        self._clock = clock
+        self._max_models = max_models
+        self._models = OrderedDict()  # least recently used first
+        self._depth = 0
+        self._rejected_queue_full = 0
+        self._rejected_rate = 0
+
+    def _get_model(self, model_id):
+        state = self._models.get(model_id)
+        if state is None:
+            if len(self._models) >= self._max_models:
+                self._evict_idle()
+            state = _ModelState(self._concurrency, self._rate, self._clock())
+            self._models[model_id] = state
+        else:
+            self._models.move_to_end(model_id)
+        return state
+
+    def _evict_idle(self):
+        """
+        Forgets the least recently used model that has no request queued or running, if any;
+        the others are at most max_queue
+        """
+        for model_id, state in self._models.items():
+            if state.queued == 0:
+                del self._models[model_id]
+                _logger.debug("AdmissionController: forgetting idle model %s", model_id)
+                return
+
+    def _take_tokens(self, state, cost):
+        """
+        Answers 0 if cost messages may be admitted now, otherwise the seconds to wait
+        """
+        if not state.rate:
+            return 0
+        now = self._clock()
+        state.tokens = min(float(state.rate), state.tokens + (now - state.refilled_at) * state.rate)
+        state.refilled_at = now
+        if state.tokens <= 0:
+            return max(1, int(math.ceil(-state.tokens / state.rate)))
+        # a batch may overdraw the bucket, later requests then wait for the refill
+        state.tokens -= cost
+        return 0
+
+    @gen.coroutine
+    def acquire(self, model_id, cost=1):
+        """
+        Admits a request of cost messages for a model, waiting while the model
+        is at its concurrency limit. Every successful acquire must be paired
+        with a release.
+        Raises IngestRejected if the queue is full or the model is over its rate.
+        """
+        state = self._get_model(model_id)
+        if self._depth >= self._max_queue:
+            self._rejected_queue_full += 1
+            raise IngestRejected("ingest queue is full", 1)
+        wait = self._take_tokens(state, cost)
+        if wait:
+            state.rejected_rate += 1
+            self._rejected_rate += 1
+            raise IngestRejected("model is over its ingest rate", wait)
+        self._depth += 1
+        state.queued += 1
+        try:
+            yield state.semaphore.acquire()
+        except Exception:
+            self._depth -= 1
+            state.queued -= 1
+            raise
+        state.accepted += 1
+
+    def release(self, model_id):
+        """
+        Releases a request admitted by acquire
+        """
+        state = self._models[model_id]
+        state.semaphore.release()
+        state.queued -= 1
+        self._depth -= 1
+
+    def stats(self):
+        """
+        Answers the queue depth and the admission counters, overall and per model
+        """
+        return {"depth": self._depth,
+                "max_queue": self._max_queue,
+                "rejected_queue_full": self._rejected_queue_full,
+                "rejected_rate": self._rejected_rate,
+                "models": {m: {"depth": s.queued,
+                               "accepted": s.accepted,
+                               "rejected_rate": s.rejected_rate} for m, s in self._models.items()}}
@@ -0,0 +1,122 @@
+# Acumos - Apache 2.0
+
+
+from collections import OrderedDict
+from threading import Condition, Thread
+import time
+
+from acumos_proto_viewer import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+
+class WriteBehindBuffer(object):
+    """
+    Collects encoded records per data source and hands them to a flush function
+    in one call when max_records are pending or the oldest pending record is
+    max_delay_ms old, whichever comes first.
+    The flush function takes an OrderedDict {key: [records]} and answers a dict
+    {key: sequence number of the first record}; it runs on a background thread,
+    one flush at a time, so records of a key are flushed in the order appended.
+    """
+    def __init__(self, flush, max_records, max_delay_ms):
+        self._flush = flush
+        self._max_records = max_records
+        self._max_delay = max_delay_ms / 1000.0
+        self._cond = Condition()
+        self._pending = OrderedDict()
+        self._count = 0
+        self._oldest = None
+        self._force = False
+        self._started = 0  # number of flushes that took their records
+        self._done = 0  # number of flushes that completed
+        self._waiters = {}  # generation -> number of appends waiting for it
+        self._results = {}  # generation -> (first sequence numbers, exception), kept while waited for
+        self._thread = None
+
+    def append(self, key, records, wait=False):
+        """
+        Adds records for a key. If wait is set, blocks until the records are flushed
+        and answers the sequence number of the first one; otherwise answers None.
+        Raises the exception of the flush if waiting and the flush failed.
+        """
+        with self._cond:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+            pending = self._pending.setdefault(key, [])
+            offset = len(pending)
+            pending.extend(records)
+            self._count += len(records)
+            generation = self._started + 1  # the flush that will carry these records
+            if self._oldest is None or self._count >= self._max_records:
+                # an idle flusher waits without a timeout, so wake it to set the deadline
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                self._cond.notify_all()
+            if not wait:
+                return None
+            self._waiters[generation] = self._waiters.get(generation, 0) + 1
+            while self._done < generation:
+                self._cond.wait()
+            first_seqs, error = self._results[generation]
+            self._waiters[generation] -= 1
+            if self._waiters[generation] == 0:
+                del self._waiters[generation]
+                del self._results[generation]
+            if error is not None:
+                raise error
+            return first_seqs[key] + offset
+
+    def flush(self):
+        """
+        Blocks until every record appended so far is flushed
+        """
+        with self._cond:
+            generation = self._started
+            if self._count > 0:
+                generation += 1
+                self._force = True
+                self._cond.notify_all()
+            while self._done < generation:
+                self._cond.wait()
+
+    def pending(self):
+        """
+        Answers the number of records waiting for a flush
+        """
+        with self._cond:
+            return self._count
+
+    def _due(self):
+        return self._count > 0 and (self._force or self._count >= self._max_records or time.monotonic() - self._oldest >= self._max_delay)
+
+    def _run(self):
+        """
+        Body of the flusher thread
+        """
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = None if self._oldest is None else max(self._oldest + self._max_delay - time.monotonic(), 0)
+                    self._cond.wait(timeout)
+                pending = self._pending
+                self._pending = OrderedDict()
+                self._count = 0
+                self._oldest = None
+                self._force = False
+                self._started += 1
+                generation = self._started
+            try:
+                first_seqs = self._flush(pending)
+                error = None
+            except Exception as exc:
+                _logger.error("WriteBehindBuffer: flush of %d data sources failed", len(pending))
+                _logger.exception(exc)
+                first_seqs = {}
+                error = exc
+            with self._cond:
+                if generation in self._waiters:
+                    self._results[generation] = (first_seqs, error)
+                self._done = generation
+                self._cond.notify_all()
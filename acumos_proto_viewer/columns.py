@@ -0,0 +1,112 @@
+# Acumos - Apache 2.0
+
+
+from google.protobuf.descriptor import FieldDescriptor
+import struct
+
+from acumos_proto_viewer import get_module_logger
+from acumos_proto_viewer.serializer import _FIXED_CODES
+from acumos_proto_viewer.utils import APV_RECVD, APV_SEQNO
+
+_logger = get_module_logger(__name__)
+
+# the receive time is a whole number of seconds, like in the binary record format
+_RECVD_CODE = "Q"
+
+
+class ColumnLayout(object):
+    """
+    The columns of a message: its singular numeric and bool fields, also those of nested
+    messages, by their flattened name ("i.x" like properties_flat), and the receive time.
+    A row packs the values of one record in this order, little endian; a column is the
+    concatenation of one field of consecutive rows, so a typed array.
+    """
+    def __init__(self, descriptor):
+        self.fields = [APV_RECVD]
+        self.codes = [_RECVD_CODE]
+        self._paths = []
+        self._collect(descriptor, ())
+        self.row = struct.Struct("<" + "".join(self.codes))
+        self.widths = [struct.calcsize(c) for c in self.codes]
+        self.offsets = [sum(self.widths[:i]) for i in range(len(self.widths))]
+        self.by_field = {f: i for i, f in enumerate(self.fields)}
+
+    def _collect(self, descriptor, path):
+        for field in descriptor.fields:
+            if field.label == FieldDescriptor.LABEL_REPEATED:
+                continue  # also map fields
+            if field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+                self._collect(field.message_type, path + (field.name,))
+            elif field.cpp_type in _FIXED_CODES:
+                self.fields.append(".".join(path + (field.name,)))
+                self.codes.append(_FIXED_CODES[field.cpp_type])
+                self._paths.append(path + (field.name,))
+
+    def column_of(self, field_name):
+        """
+        Answers the column holding the values of a flattened field name, or None if the field is not
+        in a column. The probe fields of nested messages have the values of the top level ones.
+        """
+        name = field_name.rsplit(".", 1)[-1]
+        if name in (APV_RECVD, APV_SEQNO):
+            field_name = name
+        return self.by_field.get(field_name, None)
+
+    def record_values(self, record):
+        """
+        Gets the values of the row of a converted record dict, unpacked
+        """
+        values = [record[APV_RECVD]]
+        for path in self._paths:
+            value = record
+            for name in path:
+                value = value[name]
+            values.append(value)
+        return values
+
+    def pack_record(self, record):
+        """
+        Packs the row of a converted record dict
+        """
+        return self.row.pack(*self.record_values(record))
+
+    def pack_message(self, msg, received_at):
+        """
+        Packs the row of a parsed protobuf message
+        """
+        values = [received_at]
+        for path in self._paths:
+            value = msg
+            for name in path:
+                value = getattr(value, name)
+            values.append(value)
+        return self.row.pack(*values)
+
+    def split_rows(self, rows):
+        """
+        Splits packed rows into the chunks to append to each column, in the order of fields
+        """
+        chunks = []
+        for offset, width in zip(self.offsets, self.widths):
+            chunks.append(b"".join(row[offset:offset + width] for row in rows))
+        return chunks
+
+    def unpack_column(self, column, buf):
+        """
+        Unpacks the values of a column from a chunk of it
+        """
+        code = self.codes[column]
+        return list(struct.unpack("<{0}{1}".format(len(buf) // self.widths[column], code), buf))
+
+
+_layouts = {}
+
+
+def get_layout(descriptor):
+    """
+    Gets the column layout of a message descriptor, computing it on first use
+    """
+    layout = _layouts.get(descriptor)
+    if layout is None:
+        layout = _layouts[descriptor] = ColumnLayout(descriptor)
+    return layout
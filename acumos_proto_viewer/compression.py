@@ -0,0 +1,71 @@
+# Acumos - Apache 2.0
+
+
+import zlib
+
+from acumos_proto_viewer import get_module_logger
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # optional, pip install acumos_proto_viewer[lz4]
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:  # optional, pip install acumos_proto_viewer[zstd]
+    zstandard = None
+
+_logger = get_module_logger(__name__)
+
+# compressed records are the marker and the codec id, followed by the compressed record;
+# no serialized record format (see serializer) nor raw protobuf records (b"P") start with the marker
+_COMPRESSED_MARKER = b"Z"
+
+# codec name -> (id, compress, decompress); ids are stored with the records, never reuse one
+_CODECS = {"zlib": (b"\x01", zlib.compress, zlib.decompress)}
+if lz4_frame is not None:
+    _CODECS["lz4"] = (b"\x02", lz4_frame.compress, lz4_frame.decompress)
+if zstandard is not None:
+    # the (de)compressor objects are not thread safe, so they are made per call
+    _CODECS["zstd"] = (b"\x03",
+                       lambda raw: zstandard.ZstdCompressor().compress(raw),
+                       lambda raw: zstandard.ZstdDecompressor().decompress(raw))
+_DECOMPRESSORS = {cid: decompress for cid, _, decompress in _CODECS.values()}
+_KNOWN_IDS = {b"\x01": "zlib", b"\x02": "lz4", b"\x03": "zstd"}
+
+
+def available_codecs():
+    """
+    Returns the names of the codecs usable in this installation
+    """
+    return sorted(_CODECS)
+
+
+def compress(codec, raw, min_bytes=0):
+    """
+    Compresses a record with the named codec, "none" leaves it alone.
+    Records shorter than min_bytes, and records that do not shrink, are returned as is,
+    so decompress must be used on every stored record.
+    Raises ValueError if the codec is unknown or not installed.
+    """
+    if codec == "none" or len(raw) < min_bytes:
+        return raw
+    if codec not in _CODECS:
+        raise ValueError("unknown or not installed record codec {0}, available: {1}".format(codec, available_codecs()))
+    cid, comp, _ = _CODECS[codec]
+    packed = comp(raw)
+    if len(packed) + 2 >= len(raw):
+        return raw
+    return _COMPRESSED_MARKER + cid + packed
+
+
+def decompress(raw):
+    """
+    Reverses compress; other records are returned as is.
+    Raises ValueError if the record was compressed by a codec that is not installed.
+    """
+    if raw[:1] != _COMPRESSED_MARKER:
+        return raw
+    cid = raw[1:2]
+    if cid not in _DECOMPRESSORS:
+        raise ValueError("record compressed with {0}, which is not installed".format(_KNOWN_IDS.get(cid, cid)))
+    return _DECOMPRESSORS[cid](raw[2:])
@@ -1,22 +1,32 @@
 # Acumos - Apache 2.0
 
 
-import copy
-from datetime import date, datetime
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from datetime import time as dttime
-from google.protobuf.json_format import MessageToJson
+from functools import lru_cache
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.message import DecodeError
 import hashlib
 import json
 import jsonschema
-import pickle
+import os
 import redis
 import requests
-from threading import Thread
+import struct
+from threading import Lock, Thread
 import time
 import uuid
 
 from acumos_proto_viewer import get_module_logger
-from acumos_proto_viewer.utils import load_proto, register_jsonschema_from_url, register_proto_from_url, APV_RECVD, APV_SEQNO, APV_MODEL
+from acumos_proto_viewer.buffer import WriteBehindBuffer
+from acumos_proto_viewer.columns import get_layout
+from acumos_proto_viewer.compression import compress, decompress
+from acumos_proto_viewer.rollups import Rollup
+from acumos_proto_viewer.segments import SegmentBackend
+from acumos_proto_viewer.storage import MemoryBackend, StorageBackend
+from acumos_proto_viewer.serializer import BlobRef, dumps, is_map_field, json_value, loads, needs_schema
+from acumos_proto_viewer.utils import load_proto, register_jsonschema_from_url, register_proto_from_url, compile_field_accessor, get_messages_data, APV_RECVD, APV_SEQNO, APV_MODEL
 
 _logger = get_module_logger(__name__)
 
@@ -25,45 +35,165 @@ jsonschema_data_structure = {}
 
 myredis = redis.StrictRedis(host='localhost', port=6379, db=0)
 
+# where records are kept: "redis", "memory" for a ring buffer of RETENTION_MAX_RECORDS
+# records per data source in this process, see storage.MemoryBackend, or "disk" for a log
+# of segment files per data source under DATA_DIR, see segments.SegmentBackend
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "redis")
+# the directory of the disk backend, its segment size, and the most its segments may take
+# altogether, 0 for no limit; its segments also expire RETENTION_DAYS days after their last write
+DATA_DIR = os.environ.get("DATA_DIR", "/tmp/probedata")
+SEGMENT_BYTES = int(os.environ["SEGMENT_BYTES"]) if "SEGMENT_BYTES" in os.environ else 64 * 1024 * 1024
+DATA_DIR_MAX_BYTES = int(os.environ["DATA_DIR_MAX_BYTES"]) if "DATA_DIR_MAX_BYTES" in os.environ else 0
 
-def _repair_json_data(model_id, message_name, pb_msg, json_equiv, sequence_no):
+# how records are stored in redis: "binary" (the converted dict, in a compact schema-aware encoding),
+# "pickle" (the former, legacy encoding of the dict) or "protobuf" (the original bytes)
+RECORD_FORMAT = os.environ.get("RECORD_FORMAT", "binary")
+# loading a pickle runs code of whoever wrote it, so pickled records are read only with this set,
+# e.g., while the lists of an earlier release expire, or with RECORD_FORMAT pickle
+ALLOW_PICKLE_RECORDS = os.environ.get("ALLOW_PICKLE_RECORDS", "false").lower() in ("1", "true", "yes")
+# raw records are the marker and the receive time, followed by the message
+_RAW_RECORD_MARKER = b"P"
+_RAW_RECORD_HEADER = struct.Struct(">cQ")
+_message_class_cache = {}
+_message_keys_match = {}
+# records of at least RECORD_COMPRESSION_MIN_BYTES are stored compressed with RECORD_COMPRESSION:
+# "none", "zlib", or "lz4"/"zstd" if installed. RECORD_COMPRESSION_MODELS sets the codec of
+# particular models or topics as "model_id=codec,model_id=codec"
+RECORD_COMPRESSION = os.environ.get("RECORD_COMPRESSION", "none")
+RECORD_COMPRESSION_MIN_BYTES = int(os.environ["RECORD_COMPRESSION_MIN_BYTES"]) if "RECORD_COMPRESSION_MIN_BYTES" in os.environ else 256
+RECORD_COMPRESSION_MODELS = dict(item.strip().split("=", 1) for item in os.environ.get("RECORD_COMPRESSION_MODELS", "").split(",") if item.strip())
+
+# if set, the numeric and bool fields of protobuf messages are also appended to one typed array per
+# field and day bucket, so plots read only the fields they draw, see get_raw_columns.
+# Only daily retention keeps columns
+COLUMN_STORE = os.environ.get("COLUMN_STORE", "false").lower() in ("1", "true", "yes")
+# between encoding and storing, a record with columns carries their packed values behind this marker
+_COLUMN_MARKER = b"C"
+_column_layouts = {}  # stream key -> ColumnLayout of the records being stored
+
+# if set, the numeric fields of protobuf messages are rolled up at ingest into the count, min, max,
+# mean and last value per 1 s, 10 s and 1 min, of which the latest ROLLUP_BUCKETS buckets are kept
+# in the memory of this process only, so they start empty on restart; x-y plots over receive time
+# draw their past from them in a bounded number of points, see get_rollups
+ROLLUPS = os.environ.get("ROLLUPS", "false").lower() in ("1", "true", "yes")
+ROLLUP_BUCKETS = int(os.environ["ROLLUP_BUCKETS"]) if "ROLLUP_BUCKETS" in os.environ else 1440
+_rollups = {}  # (model_id, message_name) -> Rollup
+_rollups_lock = Lock()
+
+# read params from env variables
+# "daily" keeps each stream in one list per day, read over the last RETENTION_DAYS days; "ring" keeps
+# each stream in a single list of its latest RETENTION_MAX_RECORDS records, further capped at about
+# RETENTION_MAX_BYTES bytes if that is set, so memory is bounded whatever the ingest rate; "stream"
+# keeps the same records in a Redis stream instead, trimmed approximately, whose entries have time
+# ordered ids and which readers can wait on, see wait_for_data
+RETENTION_MODE = os.environ.get("RETENTION_MODE", "daily")
+RETENTION_MAX_RECORDS = int(os.environ["RETENTION_MAX_RECORDS"]) if "RETENTION_MAX_RECORDS" in os.environ else 100000
+RETENTION_MAX_BYTES = int(os.environ["RETENTION_MAX_BYTES"]) if "RETENTION_MAX_BYTES" in os.environ else 0
+_record_sizes = {}  # ring index -> running average of the encoded record size
+_ring_totals = {}  # ring index -> number of records ever appended, as last read
+_STREAM_FIELD = "r"  # the field of a Redis stream entry that holds the record
+# the time index of a stream has the position of the first record written in each second;
+# records are written at most this many seconds after they are received, or INGEST_FLUSH_MS
+# and a second if that is longer, see get_raw_data_by_time
+TIME_INDEX_SLACK = 5
+_time_indexed = {}  # time index key -> (second, position) last indexed by this process
+_time_indexed_lock = Lock()
+RETENTION_DAYS = int(os.environ["RETENTION_DAYS"]) if "RETENTION_DAYS" in os.environ else 1
+_DAY_TTL = RETENTION_DAYS * 60 * 60 * 24
+
+# records are buffered and written in one pipeline per INGEST_FLUSH_RECORDS records or INGEST_FLUSH_MS ms;
+# a value of 1 record writes every message through
+INGEST_FLUSH_RECORDS = int(os.environ["INGEST_FLUSH_RECORDS"]) if "INGEST_FLUSH_RECORDS" in os.environ else 1
+INGEST_FLUSH_MS = int(os.environ["INGEST_FLUSH_MS"]) if "INGEST_FLUSH_MS" in os.environ else 100
+# if set, ingest waits for the flush of its records before acknowledging
+INGEST_FLUSH_SYNC = os.environ.get("INGEST_FLUSH_SYNC", "false").lower() in ("1", "true", "yes")
+_write_buffer = None
+_write_buffer_lock = Lock()
+
+# bytes fields of at least BLOB_THRESHOLD bytes, e.g., images, are stored once per distinct content
+# under their own redis key and the record only keeps a BlobRef to it; 0 keeps them in the record.
+# Rings and streams keep them in the record, so the retention caps bound them, see _stores_blobs
+BLOB_THRESHOLD = int(os.environ["BLOB_THRESHOLD"]) if "BLOB_THRESHOLD" in os.environ else 16384
+# a day bucket expires RETENTION_DAYS days after its last write, so a day later than that after its first record at the latest
+_BLOB_TTL = (RETENTION_DAYS + 1) * 60 * 60 * 24
+
+# the raw display only ever shows the latest record of a stream, so this can be small
+MODEL_STRING_CACHE_SIZE = 64
+_model_string_cache = OrderedDict()
+_model_string_lock = Lock()
+
+
+def _get_message_class(model_id, message_name):
+    """
+    Gets the class of the named protobuf message, cached per (model_id, message_name)
     """
-    Restores byte-array fields that were mangled by the PB toJson method.
-    Recurses on nested messages.
+    key = (model_id, message_name)
+    msg_class = _message_class_cache.get(key)
+    if msg_class is None:
+        msg_class = getattr(load_proto(model_id), message_name)
+        _message_class_cache[key] = msg_class
+    return msg_class
+
+
+def _parse_message(binarydata, model_id, message_name):
+    """
+    Parses binary data as the named protobuf message.
+    The message class is cached, so this is cheap enough to call on every read of a raw record.
     """
-    exp_fields = proto_data_structure[model_id]["messages"][message_name]["properties"].keys()
-    for f in exp_fields:
-        if f == APV_RECVD:
-            json_equiv[f] = int(time.time())
-        elif f == APV_SEQNO:
-            json_equiv[f] = sequence_no
-        elif f == APV_MODEL:
-            pass  # handled elsewhere
+    msg = _get_message_class(model_id, message_name)()
+    msg.ParseFromString(binarydata)
+    return msg
+
+
+def _msg_to_dict(pb_msg, received_at, sequence_no=None):
+    """
+    Converts a parsed protobuf message to the dict stored in redis in a single walk
+    of its descriptor. Singular fields keep their native python value, so bytes and
+    ints need no repair; repeated and map fields follow the protobuf JSON mapping.
+    Every (nested) message gets the well-known probe fields, like the json schema.
+    The sequence number is left out if it is None; it is set when the record is read.
+    """
+    json_equiv = {}
+    for field in pb_msg.DESCRIPTOR.fields:
+        value = getattr(pb_msg, field.name)
+        if is_map_field(field):
+            value_field = field.message_type.fields_by_name["value"]
+            json_equiv[field.name] = {(("true" if k else "false") if isinstance(k, bool) else str(k)): json_value(value_field, value[k]) for k in value}
+        elif field.label == FieldDescriptor.LABEL_REPEATED:
+            json_equiv[field.name] = [json_value(field, v) for v in value]
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+            json_equiv[field.name] = _msg_to_dict(value, received_at, sequence_no)
         else:
-            # check if the item type was bytes, and preserve it if so, no encoding!
-            # TODO! Check for nested things like arrays of bytes!
-            item = getattr(pb_msg, f)
-            if isinstance(item, bytes) or isinstance(item, int):
-                json_equiv[f] = item
-            elif hasattr(item, "DESCRIPTOR"):
-                # A nested message
-                d = getattr(item, "DESCRIPTOR")
-                # print((f, item, type(item), json_equiv[f], d.name))
-                _repair_json_data(model_id, d.name, item, json_equiv[f], sequence_no)
-
-
-def _clean_json_for_display(json):
-    """
-    Prepares JSON for display in the raw format: deletes APV-injected keys
-    and changes bytes to short string. Recurses on nested messages.
-    """
-    del json[APV_SEQNO]
-    del json[APV_RECVD]
-    for k, v in json.items():
-        if isinstance(v, bytes):
-            json[k] = "<RAW BYTES>"
+            json_equiv[field.name] = value
+    json_equiv[APV_RECVD] = received_at
+    if sequence_no is not None:
+        json_equiv[APV_SEQNO] = sequence_no
+    return json_equiv
+
+
+def _clean_json_for_display(json_equiv):
+    """
+    Returns a copy of the JSON suitable for display in the raw format: without the
+    APV-injected keys, and with bytes changed to a short string. Recurses on nested messages.
+    """
+    clean = {}
+    for k, v in json_equiv.items():
+        if k in (APV_SEQNO, APV_RECVD):
+            continue
+        if isinstance(v, (bytes, BlobRef)):
+            clean[k] = "<RAW BYTES>"
         elif isinstance(v, dict):
-            _clean_json_for_display(v)
+            clean[k] = _clean_json_for_display(v)
+        else:
+            clean[k] = v
+    return clean
+
+
+def _model_as_string(json_equiv):
+    """
+    Renders the string version of a record used by the raw display
+    """
+    return json.dumps(_clean_json_for_display(json_equiv), indent=4, sort_keys=True)
 
 
 def _msg_to_json_preserve_bytes(binarydata, model_id, message_name, sequence_no):
@@ -71,24 +201,61 @@ def _msg_to_json_preserve_bytes(binarydata, model_id, message_name, sequence_no)
     Converts an inbound protobuf message to JSON, preserving byte fields.
     Google's builtin method MessageToJson *silently reencodes* byte fields as base64.
     But we don't want that because that breaks images that arrive as raw bytes. So
-    after protobuf mangles the byte fields, this repairs their original value.
-    Also it injects values for well-known probe fields.
+    this walks the message descriptor directly instead of round-tripping through
+    MessageToJson. Also it injects values for well-known probe fields, except for
+    the string version of the model which is rendered on demand by get_model_as_string.
     """
     # this level of chattiness is not desirable for typical use
     # _logger.debug("_msg_to_json_preserve_bytes: model_id %s, message %s", model_id, message_name)
-    mod = load_proto(model_id)
-    msg = getattr(mod, message_name)()
-    msg.ParseFromString(binarydata)
-    # https://stackoverflow.com/questions/43835243/google-protobuf-json-format-messagetojson-changes-names-of-fields-how-to-avoid
-    json_equiv = json.loads(MessageToJson(msg, preserving_proto_field_name=True))
-    # Put back byte arrays
-    _repair_json_data(model_id, message_name, msg, json_equiv, sequence_no)
-    # Create JSON suitable for display ("raw") use:
-    # remove the metadata and abbreviate any byte fields
-    json_copy = copy.deepcopy(json_equiv)
-    _clean_json_for_display(json_copy)
-    json_equiv[APV_MODEL] = json.dumps(json_copy, indent=4, sort_keys=True)
-    return json_equiv
+    msg = _parse_message(binarydata, model_id, message_name)
+    return _msg_to_dict(msg, int(time.time()), sequence_no)
+
+
+def _blob_key(digest):
+    """
+    Gets the myredis key of a blob
+    """
+    return "apv_blob_" + digest
+
+
+def _extract_blobs(record, blobs):
+    """
+    Moves the bytes fields of at least BLOB_THRESHOLD bytes out of a record,
+    recursing on nested messages, into blobs {digest: bytes}; the record keeps
+    a BlobRef in their place. Identical contents share one digest.
+    """
+    for k, v in record.items():
+        if isinstance(v, bytes) and len(v) >= BLOB_THRESHOLD:
+            digest = hashlib.sha256(v).hexdigest()
+            blobs[digest] = v
+            record[k] = BlobRef(digest, len(v))
+        elif isinstance(v, dict):
+            _extract_blobs(v, blobs)
+
+
+def _store_blobs(blobs):
+    """
+    Stores blobs {digest: bytes} that redis does not have yet, and extends the TTL
+    of those it has, so a blob referenced again is neither resent nor expired early.
+    Takes two round trips at most; a concurrent write of the same blob is harmless.
+    """
+    digests = list(blobs)
+    pipe = myredis.pipeline()
+    for digest in digests:
+        pipe.expire(_blob_key(digest), _BLOB_TTL)
+    missing = [digest for digest, found in zip(digests, pipe.execute()) if not found]
+    if missing:
+        pipe = myredis.pipeline()
+        for digest in missing:
+            pipe.set(_blob_key(digest), blobs[digest], ex=_BLOB_TTL)
+        pipe.execute()
+
+
+def _get_day_bucket(day):
+    """
+    Gets the bucket of a date, the Unix timestamp of its midnight
+    """
+    return str(int(datetime.combine(day, dttime.min).timestamp()))
 
 
 def _get_bucket():
@@ -96,41 +263,904 @@ def _get_bucket():
     Note: we use the Unix timestamp bucketed methodology described below
     because myredis list members can't have TTLs:
         https://quickleft.com/blog/how-to-create-and-expire-list-items-in-myredis/
-    The result of this is that a current session logging into the probe will see
-    the data since the last midnight. If this isn't good enough, and memory is
-    plentiful, we can go to the last week or something.
+    Records go to the bucket of today. Sessions read the buckets of the last
+    RETENTION_DAYS days, see _get_buckets.
+    """
+    return _get_day_bucket(date.today())
+
+
+def _get_buckets():
+    """
+    Gets the buckets of the last RETENTION_DAYS days, newest first
+    """
+    today = date.today()
+    return [_get_bucket()] + [_get_day_bucket(today - timedelta(days=d)) for d in range(1, RETENTION_DAYS)]
+
+
+@lru_cache(maxsize=1024)
+def _get_stream_key(model_id, message_name):
+    """
+    Hashes (model_id, message_name) to the prefix of the redis keys of its stream.
+    Memoized, so the hash is computed once per stream.
     """
-    return str(int(datetime.combine(date.today(), dttime.min).timestamp()))
+    h = "{0}{1}".format(model_id, message_name)
+    return hashlib.sha224(h.encode('utf-8')).hexdigest()
+
+
+def _get_bucket_index(model_id, message_name, bucket):
+    """
+    Gets the redis key of the list of a (model_id, message_name, bucket)
+    """
+    return "{0}_{1}".format(_get_stream_key(model_id, message_name), bucket)
 
 
 def _get_raw_data_source_index(model_id, message_name):
     """
     Gets the myredis index given model_id and message_name
     """
-    bucket = _get_bucket()
-    h = "{0}{1}{2}".format(model_id, message_name, bucket)
-    index = hashlib.sha224(h.encode('utf-8')).hexdigest()
-    return index
+    if RETENTION_MODE in ("ring", "stream"):
+        return _get_bucket_index(model_id, message_name, RETENTION_MODE)
+    return _get_bucket_index(model_id, message_name, _get_bucket())
+
+
+def _get_total_key(index):
+    """
+    Gets the myredis key that counts the records ever appended to the stream of a list
+    """
+    return index.rsplit("_", 1)[0] + "_total"
+
+
+def _get_time_key(index):
+    """
+    Gets the myredis key of the time index of the stream of a list, a sorted set of the
+    positions of the first records written in each second, by second. The positions are
+    zero padded, so those of a second sort in order.
+    """
+    return index.rsplit("_", 1)[0] + "_time"
+
+
+def _get_column_key(index, field_name):
+    """
+    Gets the myredis key of the column of a field in a day bucket
+    """
+    return "{0}_col_{1}".format(index, field_name)
+
+
+def _get_column_layout(model_id, message_name):
+    """
+    Gets the columns.ColumnLayout of a registered message
+    """
+    return get_layout(_get_message_class(model_id, message_name).DESCRIPTOR)
+
+
+def _split_columns(index, records):
+    """
+    Separates records with columns, see _encode_record, into the records to store
+    and the chunks to append to each column of their layout.
+    Returns the tuple (records, layout, chunks); layout is None if there are no columns to append,
+    which is also the case of rows only carried for the rollups.
+    """
+    layout = _column_layouts.get(index.rsplit("_", 1)[0], None)
+    if layout is None:
+        return records, None, None
+    end = 1 + layout.row.size
+    if not (_stores_columns() and all(r[:1] == _COLUMN_MARKER for r in records)):
+        return [r[end:] if r[:1] == _COLUMN_MARKER else r for r in records], None, None
+    return [r[end:] for r in records], layout, layout.split_rows([r[1:end] for r in records])
+
+
+def _stores_blobs():
+    """
+    Answers whether large bytes fields are stored apart from the records, see BLOB_THRESHOLD;
+    blobs expire by time, so they are not for the redis rings and streams, which are trimmed by size
+    """
+    return BLOB_THRESHOLD > 0 and (RETENTION_MODE == "daily" or not isinstance(_backend, RedisBackend))
+
+
+def _stores_columns():
+    """
+    Answers whether columns are stored, see COLUMN_STORE
+    """
+    return COLUMN_STORE and RETENTION_MODE == "daily" and isinstance(_backend, RedisBackend)
+
+
+def _get_rollup(model_id, message_name):
+    """
+    Gets the rollups.Rollup of a registered message, creating it on first use
+    """
+    key = (model_id, message_name)
+    rollup = _rollups.get(key)
+    if rollup is None:
+        with _rollups_lock:
+            rollup = _rollups.get(key)
+            if rollup is None:
+                rollup = _rollups[key] = Rollup(_get_column_layout(model_id, message_name), ROLLUP_BUCKETS)
+    return rollup
+
+
+def _update_rollups(model_id, message_name, records):
+    """
+    Adds records being stored to the rollups of their data source. Encoded records
+    carry their row of values, see _encode_record; converted dicts are read.
+    Topics have no numeric fields known in advance, so they are not rolled up.
+    """
+    if model_id not in proto_data_structure:
+        return
+    layout = _get_column_layout(model_id, message_name)
+    if _backend.serializes:
+        end = 1 + layout.row.size
+        rows = [layout.row.unpack(r[1:end]) for r in records if r[:1] == _COLUMN_MARKER]
+    else:
+        rows = [layout.record_values(r) for r in records]
+    if rows:
+        _get_rollup(model_id, message_name).add(rows)
+
+
+def _strip_rows(model_id, message_name, records):
+    """
+    Removes the rows carried for the rollups from encoded records, for the backends
+    other than redis, which keep no columns
+    """
+    end = 1 + _get_column_layout(model_id, message_name).row.size
+    return [r[end:] if r[:1] == _COLUMN_MARKER else r for r in records]
+
+
+def _get_base_key(index):
+    """
+    Gets the myredis key that holds the stream position of the first record of a day bucket
+    """
+    return index + "_base"
+
+
+def _ring_capacity(index, records):
+    """
+    Answers how many records a ring keeps: RETENTION_MAX_RECORDS, or fewer if
+    RETENTION_MAX_BYTES is set and the records written so far average more than
+    RETENTION_MAX_BYTES / RETENTION_MAX_RECORDS bytes. The average is kept per
+    process, so the byte cap is approximate.
+    """
+    if not RETENTION_MAX_BYTES:
+        return RETENTION_MAX_RECORDS
+    size = sum(len(r) for r in records) / len(records)
+    average = _record_sizes.get(index, size) * 0.9 + size * 0.1
+    _record_sizes[index] = average
+    return max(1, min(RETENTION_MAX_RECORDS, int(RETENTION_MAX_BYTES // average)))
+
+
+def _queue_append(pipe, index, records):
+    """
+    Queues the commands that append records to a data source. The total count of
+    the stream is advanced in the same transaction, so readers always see the two
+    agree. A ring is trimmed to its capacity, a Redis stream to about its capacity, in
+    whole nodes, which is cheaper. A day bucket and the total count have
+    their TTL of RETENTION_DAYS days (re)set; the bucket receives no writes after
+    midnight, so it is dropped once it is out of the look-back.
+    Answers how many results the commands add to the pipeline.
+    """
+    total_key = _get_total_key(index)
+    records, layout, chunks = _split_columns(index, records)
+    if RETENTION_MODE == "stream":
+        # XADD is sent as is, so this works with every version of the redis client
+        capacity = _ring_capacity(index, records)
+        for record in records:
+            pipe.execute_command("XADD", index, "MAXLEN", "~", capacity, "*", _STREAM_FIELD, record)
+        pipe.incrby(total_key, len(records))
+        return len(records) + 1
+    pipe.rpush(index, *records)
+    if RETENTION_MODE == "ring":
+        pipe.ltrim(index, -_ring_capacity(index, records), -1)
+        pipe.incrby(total_key, len(records))
+        return 3
+    pipe.incrby(total_key, len(records))
+    pipe.expire(index, _DAY_TTL)
+    pipe.expire(total_key, _DAY_TTL)
+    if layout is None:
+        return 4
+    # appended in the same transaction, so the columns of a bucket stay aligned with its list
+    for field_name, chunk in zip(layout.fields, chunks):
+        key = _get_column_key(index, field_name)
+        pipe.append(key, chunk)
+        pipe.expire(key, _DAY_TTL)
+    return 4 + 2 * len(chunks)
+
+
+def _appended(results, index, count, bases):
+    """
+    Answers the sequence number of the first of count records from the results of _queue_append.
+    Sequence numbers are positions in the stream plus one, so they are assigned atomically even
+    with concurrent writers. The write that creates a day bucket learns the position of its first
+    record, which it adds to bases {base key: position} for _store_bases.
+    """
+    if RETENTION_MODE == "ring":
+        return results[2] - count + 1
+    if RETENTION_MODE == "stream":
+        return results[-1] - count + 1
+    length, total = results[0], results[1]
+    if length == count:
+        bases[_get_base_key(index)] = total - length
+    return total - count + 1
+
+
+def _index_time(index, position, times):
+    """
+    Adds the position of the first of records just written to times {time key: (second, position)}
+    if it is the first written this second, or precedes the one indexed, as concurrent writers may
+    index their records in either order.
+    """
+    key = _get_time_key(index)
+    second = int(time.time())
+    with _time_indexed_lock:
+        last = _time_indexed.get(key)
+        if last is not None and (last[0] > second or (last[0] == second and last[1] <= position)):
+            return
+        _time_indexed[key] = (second, position)
+    times[key] = (second, position)
+
+
+def _store_bases(bases, times):
+    """
+    Records the stream positions of the first records of new day buckets, so reads can locate
+    records across buckets. Until this is done, readers derive it from the total count.
+    Also adds entries to time indexes, see _index_time, dropping those older than what is kept.
+    """
+    if bases or times:
+        pipe = myredis.pipeline()
+        for key, base in bases.items():
+            pipe.set(key, base, ex=_DAY_TTL)
+        for key, (second, position) in times.items():
+            # ZADD is sent as is, its arguments differ between versions of the redis client
+            pipe.execute_command("ZADD", key, second, "{0:020d}".format(position))
+            if RETENTION_MODE in ("ring", "stream"):
+                pipe.zremrangebyrank(key, 0, -RETENTION_MAX_RECORDS - 1)
+            else:
+                pipe.zremrangebyscore(key, "-inf", second - _DAY_TTL)
+                pipe.expire(key, _DAY_TTL)
+        pipe.execute()
+
+
+def _push_records(index, records):
+    """
+    Appends encoded records to a data source in a single round trip, or two for the first of a day.
+    Returns the sequence number of the first record.
+    """
+    pipe = myredis.pipeline()
+    _queue_append(pipe, index, records)
+    bases = {}
+    times = {}
+    first_seq = _appended(pipe.execute(), index, len(records), bases)
+    _index_time(index, first_seq - 1, times)
+    _store_bases(bases, times)
+    return first_seq
+
+
+def _flush_records(pending):
+    """
+    Writes the records of several data sources in a single pipeline; the flush
+    function of the write-behind buffer. pending is {index: [records]}.
+    Returns {index: sequence number of the first record}.
+    """
+    pipe = myredis.pipeline()
+    sizes = [_queue_append(pipe, index, records) for index, records in pending.items()]
+    results = pipe.execute()
+    first_seqs = {}
+    bases = {}
+    times = {}
+    pos = 0
+    for (index, records), size in zip(pending.items(), sizes):
+        first_seqs[index] = _appended(results[pos:pos + size], index, len(records), bases)
+        _index_time(index, first_seqs[index] - 1, times)
+        pos += size
+    _store_bases(bases, times)
+    return first_seqs
+
+
+def _read_ring(index, index_start, index_end):
+    """
+    Reads the records at stream positions index_start to index_end, inclusive,
+    of a ring; negative positions count from the end like LRANGE.
+    Trimming moves the head of the list, so the records are located from its end,
+    with the total count read in the same transaction; the window is sized from the
+    total of the previous read plus some slack and read again, wider, if records
+    arrived faster than the slack in between.
+    Returns the tuple (position of the first record, list of raw records).
+    """
+    total_key = _get_total_key(index)
+    slack = 64
+    while True:
+        guess = _ring_totals.get(index, 0)
+        from_end_start = index_start if index_start < 0 else min(index_start - guess - slack, -1)
+        from_end_end = index_end if index_end < 0 else min(index_end - guess, -1)
+        pipe = myredis.pipeline()
+        pipe.get(total_key)
+        pipe.llen(index)
+        pipe.lrange(index, from_end_start, from_end_end)
+        total, length, raw = pipe.execute()
+        total = int(total or 0)
+        _ring_totals[index] = total
+        start = max(total + index_start if index_start < 0 else index_start, total - length)
+        end = total + index_end if index_end < 0 else min(index_end, total - 1)
+        if start > end:
+            return start, []
+        first = total + max(from_end_start, -length)  # position of raw[0]
+        if first <= start and first + len(raw) > end:
+            return start, raw[start - first:end - first + 1]
+        slack *= 2
+
+
+def _locate_days(model_id, message_name, index_start, index_end, layout=None, columns=()):
+    """
+    Locates the stream positions index_start to index_end, inclusive, in the day
+    buckets of the last RETENTION_DAYS days, in one round trip; negative positions
+    count from the end like LRANGE.
+    Returns a list of tuples (index, first position, last position, position of the
+    first record of the bucket, whether the given columns of the layout are complete),
+    one per bucket that holds some of the positions, oldest first.
+    """
+    indexes = [_get_bucket_index(model_id, message_name, b) for b in _get_buckets()]
+    pipe = myredis.pipeline()
+    pipe.get(_get_total_key(indexes[0]))
+    for index in indexes:
+        pipe.llen(index)
+        pipe.get(_get_base_key(index))
+        for column in columns:
+            pipe.strlen(_get_column_key(index, layout.fields[column]))
+    results = pipe.execute()
+    total = int(results[0] or 0)
+    step = 2 + len(columns)
+    buckets = []  # (index, position of first record, length, columns complete), oldest first
+    end_of_bucket = total
+    for i, index in enumerate(indexes):
+        length, base = results[1 + i * step], results[2 + i * step]
+        if length:
+            # a bucket just created may not have its base yet; it ends where the next one starts
+            base = int(base) if base is not None else end_of_bucket - length
+            # columns are missing or short if COLUMN_STORE was switched on during the day
+            complete = all(size == length * layout.widths[column]
+                           for column, size in zip(columns, results[3 + i * step:1 + (i + 1) * step]))
+            buckets.insert(0, (index, base, length, complete))
+            end_of_bucket = base
+    start = total + index_start if index_start < 0 else index_start
+    end = total + index_end if index_end < 0 else min(index_end, total - 1)
+    return [(index, max(start, base), min(end, base + length - 1), base, complete)
+            for index, base, length, complete in buckets if start < base + length and end >= base]
+
+
+def _read_days(model_id, message_name, index_start, index_end):
+    """
+    Reads the records at stream positions index_start to index_end of the day buckets,
+    see _locate_days, in a second round trip, none if there is nothing to read.
+    Returns the tuple (list of positions, list of raw records).
+    """
+    overlapping = _locate_days(model_id, message_name, index_start, index_end)
+    if not overlapping:
+        return [], []
+    pipe = myredis.pipeline()
+    for index, first, last, base, _ in overlapping:
+        pipe.lrange(index, first - base, last - base)
+    positions = []
+    raw = []
+    for (_, first, _, _, _), records in zip(overlapping, pipe.execute()):
+        positions.extend(range(first, first + len(records)))
+        raw.extend(records)
+    return positions, raw
+
+
+def _read_day_columns(model_id, message_name, layout, columns, index_start, index_end):
+    """
+    Reads columns of the layout at stream positions index_start to index_end of the day
+    buckets, see _locate_days, in a second round trip. Buckets with incomplete columns
+    are read as records instead.
+    Returns the tuple (list of positions, {column: list of values}).
+    """
+    overlapping = _locate_days(model_id, message_name, index_start, index_end, layout, columns)
+    positions = []
+    values = {column: [] for column in columns}
+    if not overlapping:
+        return positions, values
+    pipe = myredis.pipeline()
+    for index, first, last, base, complete in overlapping:
+        if complete:
+            for column in columns:
+                width = layout.widths[column]
+                pipe.getrange(_get_column_key(index, layout.fields[column]), (first - base) * width, (last - base + 1) * width - 1)
+        else:
+            pipe.lrange(index, first - base, last - base)
+    results = iter(pipe.execute())
+    for index, first, last, base, complete in overlapping:
+        if complete:
+            chunks = [layout.unpack_column(column, next(results)) for column in columns]
+            # shorter only if the bucket expired in between
+            count = min([len(chunk) for chunk in chunks] + [last - first + 1])
+            for column, chunk in zip(columns, chunks):
+                values[column].extend(chunk[:count])
+        else:
+            records = [_decode_record(model_id, message_name, x, 0) for x in next(results)]
+            count = len(records)
+            accessors = get_field_accessors(model_id, message_name, [layout.fields[column] for column in columns])
+            for column in columns:
+                field_name = layout.fields[column]
+                values[column].extend(get_messages_data(records, field_name, accessors[field_name]))
+        positions.extend(range(first, first + count))
+    return positions, values
+
+
+def _stream_records(entries):
+    """
+    Gets the records of Redis stream entries, which the redis client parses into
+    (id, {field: value}) or leaves as [id, [field, value]] depending on its version
+    """
+    return [fields[_STREAM_FIELD.encode()] if isinstance(fields, dict) else fields[1] for _, fields in entries]
+
+
+def _read_stream(index, index_start, index_end):
+    """
+    Reads the records at stream positions index_start to index_end, inclusive, of a
+    Redis stream, like _read_ring. Entries are located from the end with XREVRANGE,
+    which takes a count but no offset, so this reads the entries after index_end too.
+    Returns the tuple (position of the first record, list of raw records).
+    """
+    total_key = _get_total_key(index)
+    slack = 64
+    while True:
+        guess = _ring_totals.get(index, 0)
+        count = -index_start if index_start < 0 else max(guess - index_start + slack, 1)
+        pipe = myredis.pipeline()
+        pipe.get(total_key)
+        pipe.execute_command("XLEN", index)
+        pipe.execute_command("XREVRANGE", index, "+", "-", "COUNT", count)
+        total, length, entries = pipe.execute()
+        total = int(total or 0)
+        _ring_totals[index] = total
+        start = max(total + index_start if index_start < 0 else index_start, total - length)
+        end = total + index_end if index_end < 0 else min(index_end, total - 1)
+        if start > end:
+            return start, []
+        first = total - len(entries)  # position of the oldest entry read
+        if first <= start:
+            raw = _stream_records(entries[::-1])
+            return start, raw[start - first:end - first + 1]
+        slack *= 2
+
+
+def _get_write_buffer():
+    """
+    Lazily creates the write-behind buffer
+    """
+    global _write_buffer
+    with _write_buffer_lock:
+        if _write_buffer is None:
+            _write_buffer = WriteBehindBuffer(_flush_records, INGEST_FLUSH_RECORDS, INGEST_FLUSH_MS)
+    return _write_buffer
+
+
+def _read_varint(buf, pos):
+    """
+    Decodes a base-128 varint from buf starting at pos.
+    Returns the tuple (value, position after the varint).
+    Raises ValueError if the buffer ends in the middle of the varint.
+    """
+    result = 0
+    shift = 0
+    while pos < len(buf):
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            break
+    raise ValueError("truncated or oversized varint")
+
+
+def _encode_record(binarydata, model_id, message_name, blobs):
+    """
+    Encodes one message as the bytes stored in redis, according to RECORD_FORMAT:
+    "binary" and "pickle" serialize the converted dict, see serializer.dumps;
+    "protobuf" stores the original payload behind a compact header and defers
+    the conversion to _decode_record.
+    Converted dicts have their large bytes fields moved to blobs, see _extract_blobs.
+    Either is then compressed as configured for the model, see _compress_record.
+    The sequence number is not stored; it is the position in the list.
+    Backends that do not serialize get the converted dict.
+    With COLUMN_STORE or ROLLUPS the record is preceded by the marker and its row of
+    columns, see columns.ColumnLayout, which _queue_append splits off.
+    Raises DecodeError if the message cannot be parsed.
+    """
+    if not _backend.serializes:
+        return _msg_to_json_preserve_bytes(binarydata, model_id, message_name, None)
+    columns = _stores_columns() or ROLLUPS
+    if RECORD_FORMAT == "protobuf":
+        received_at = int(time.time())
+        msg = _parse_message(binarydata, model_id, message_name)  # safeguard against malformed data
+        raw = _compress_record(model_id, _RAW_RECORD_HEADER.pack(_RAW_RECORD_MARKER, received_at) + binarydata)
+        return _COLUMN_MARKER + _get_column_layout(model_id, message_name).pack_message(msg, received_at) + raw if columns else raw
+    record = _msg_to_json_preserve_bytes(binarydata, model_id, message_name, None)
+    row = _get_column_layout(model_id, message_name).pack_record(record) if columns else None
+    if _stores_blobs():
+        _extract_blobs(record, blobs)
+    raw = _compress_record(model_id, dumps(RECORD_FORMAT, record, _get_message_class(model_id, message_name).DESCRIPTOR))
+    return _COLUMN_MARKER + row + raw if columns else raw
+
+
+def _compress_record(model_id, raw):
+    """
+    Compresses an encoded record with the codec of its model or topic, if it is long enough
+    """
+    return compress(RECORD_COMPRESSION_MODELS.get(model_id, RECORD_COMPRESSION), raw, RECORD_COMPRESSION_MIN_BYTES)
+
+
+def _decode_record(model_id, message_name, raw, sequence_no):
+    """
+    Decodes bytes stored in redis back to a record dict, decompressing it first if need be.
+    Every format starts with its own marker byte, so a list may hold records of any format.
+    Raises ValueError on a pickled record unless ALLOW_PICKLE_RECORDS is set or RECORD_FORMAT is pickle.
+    """
+    raw = decompress(raw)
+    if raw[:1] == _RAW_RECORD_MARKER:
+        _, received_at = _RAW_RECORD_HEADER.unpack_from(raw)
+        msg = _parse_message(raw[_RAW_RECORD_HEADER.size:], model_id, message_name)
+        return _msg_to_dict(msg, received_at, sequence_no)
+    descriptor = _get_message_class(model_id, message_name).DESCRIPTOR if needs_schema(raw) else None
+    return loads(raw, sequence_no, descriptor, ALLOW_PICKLE_RECORDS or RECORD_FORMAT == "pickle")
+
+
+def _numbered(record, sequence_no):
+    """
+    Copies a record dict kept by a backend that does not serialize, with the sequence
+    number set like serializer.loads does, without modifying the stored one
+    """
+    numbered = dict(record)
+    numbered[APV_SEQNO] = sequence_no
+    for k, v in record.items():
+        if isinstance(v, dict) and APV_RECVD in v:
+            numbered[k] = _numbered(v, sequence_no)
+    return numbered
+
+
+class RedisBackend(StorageBackend):
+    """
+    Keeps the records in redis, see RETENTION_MODE, as the bytes of encode_data,
+    and large bytes fields as blobs; writes may go through the write-behind buffer
+    """
+    @property
+    def wakes_readers(self):
+        return RETENTION_MODE == "stream"
+
+    def append(self, model_id, message_name, records, blobs):
+        """
+        Appends encoded records in one round trip, or hands them to the write-behind
+        buffer if INGEST_FLUSH_RECORDS is more than one. The blobs are stored first,
+        so readers never see a dangling BlobRef.
+        """
+        if blobs:
+            _store_blobs(blobs)
+        index = _get_raw_data_source_index(model_id, message_name)
+        if records[0][:1] == _COLUMN_MARKER:
+            _column_layouts[index.rsplit("_", 1)[0]] = _get_column_layout(model_id, message_name)
+        if INGEST_FLUSH_RECORDS > 1:
+            first_seq = _get_write_buffer().append(index, records, wait=INGEST_FLUSH_SYNC)
+            return first_seq - 1 if first_seq is not None else None
+        # this auto creates the key if it does not exist yet #https://myredis.io/commands/lpush
+        return _push_records(index, records) - 1
+
+    def flush(self):
+        if _write_buffer is not None:
+            _write_buffer.flush()
+
+    def count(self, model_id, message_name):
+        """
+        This counts the records that a ring trimmed or that are older than the look-back since
+        """
+        index = _get_raw_data_source_index(model_id, message_name)
+        return int(myredis.get(_get_total_key(index)) or 0)  # zero if the stream does not exist
+
+    def read(self, model_id, message_name, index_start, index_end):
+        """
+        Positions are those of the stream, across day buckets; this goes back RETENTION_DAYS days,
+        or with RETENTION_MODE ring or stream to the oldest record kept.
+        """
+        if RETENTION_MODE in ("ring", "stream"):
+            read = _read_ring if RETENTION_MODE == "ring" else _read_stream
+            first, raw = read(_get_raw_data_source_index(model_id, message_name), index_start, index_end)
+            return range(first, first + len(raw)), raw
+        return _read_days(model_id, message_name, index_start, index_end)
+
+    def read_columns(self, model_id, message_name, field_names, index_start, index_end):
+        """
+        Reads the columns with COLUMN_STORE, if every field is in one, see columns.ColumnLayout
+        """
+        if not (_stores_columns() and model_id in proto_data_structure):
+            return None
+        layout = _get_column_layout(model_id, message_name)
+        wanted = {f: layout.column_of(f) for f in field_names if f.rsplit(".", 1)[-1] != APV_SEQNO}
+        if None in wanted.values():
+            return None
+        positions, values = _read_day_columns(model_id, message_name, layout, sorted(set(wanted.values())), index_start, index_end)
+        seqs = [pos + 1 for pos in positions]
+        result = {f: values[wanted[f]] if f in wanted else seqs for f in field_names}
+        result[APV_SEQNO] = seqs
+        return result
+
+    def locate(self, model_id, message_name, time_start, time_end):
+        index = _get_raw_data_source_index(model_id, message_name)
+        pipe = myredis.pipeline()
+        pipe.zrangebyscore(_get_time_key(index), time_start, "+inf", start=0, num=1)
+        pipe.zrangebyscore(_get_time_key(index), "({0}".format(time_end), "+inf", start=0, num=1)
+        pipe.get(_get_total_key(index))
+        first, after, total = pipe.execute()
+        total = int(total or 0)
+        return int(first[0]) if first else total, int(after[0]) - 1 if after else total - 1
+
+    def wait(self, model_id, message_name, index_start, timeout_ms):
+        """
+        With RETENTION_MODE stream this blocks in XREAD, so the writer wakes the reader
+        """
+        if RETENTION_MODE != "stream":
+            return self.count(model_id, message_name) > index_start
+        index = _get_raw_data_source_index(model_id, message_name)
+        pipe = myredis.pipeline()
+        pipe.get(_get_total_key(index))
+        pipe.execute_command("XREVRANGE", index, "+", "-", "COUNT", 1)
+        total, last = pipe.execute()
+        if int(total or 0) > index_start:
+            return True
+        # a timeout answers None, or an empty list from some servers
+        return bool(myredis.execute_command("XREAD", "BLOCK", timeout_ms, "COUNT", 1, "STREAMS", index,
+                                            last[0][0] if last else "0-0"))
+
+    def get_blob(self, digest):
+        return myredis.get(_blob_key(digest))
+
+    def get_flag(self, name):
+        return myredis.get(name) is not None
+
+    def set_flag(self, name):
+        return bool(myredis.setnx(name, 1))
+
+    def delete_flag(self, name):
+        return myredis.delete(name) > 0
+
+
+if STORAGE_BACKEND == "memory":
+    _backend = MemoryBackend(RETENTION_MAX_RECORDS)
+elif STORAGE_BACKEND == "disk":
+    _backend = SegmentBackend(DATA_DIR, SEGMENT_BYTES, _DAY_TTL, DATA_DIR_MAX_BYTES)
+else:
+    _backend = RedisBackend()
+
 
 ###########
 # PUBLIC
 
 
+def split_delimited(binarydata):
+    """
+    Splits a body of varint-length-delimited protobuf messages (the framing used by
+    writeDelimitedTo / parseDelimitedFrom) into a list of message payloads.
+    The second element of the returned tuple is true if the body ended with a
+    truncated frame, which is dropped.
+    """
+    payloads = []
+    pos = 0
+    while pos < len(binarydata):
+        try:
+            size, pos = _read_varint(binarydata, pos)
+        except ValueError:
+            return payloads, True
+        if pos + size > len(binarydata):
+            return payloads, True
+        payloads.append(binarydata[pos:pos + size])
+        pos += size
+    return payloads, False
+
+
+def get_backend():
+    """
+    Gets the storage.StorageBackend in use
+    """
+    return _backend
+
+
 def get_raw_data_source_count(model_id, message_name):
-    index = _get_raw_data_source_index(model_id, message_name)
-    return myredis.llen(index) if myredis.exists(index) else 0
+    """
+    Gets the number of records of a (model_id, message_name) pair, which is also
+    the position after the last one, whether the records are still kept or not.
+    """
+    return _backend.count(model_id, message_name)
+
+
+def wait_for_data(model_id, message_name, index_start, timeout_ms):
+    """
+    Waits until a (model_id, message_name) pair has a record at position index_start or
+    later, for at most timeout_ms, and answers whether it has. Only backends that wake
+    readers block, see storage.StorageBackend; the others answer at once.
+    """
+    return _backend.wait(model_id, message_name, index_start, timeout_ms)
 
 
 def get_raw_data(model_id, message_name, index_start, index_end):
     """
     Gets the raw data (list of records) for a (model_id, message_name) pair.
     These data sources are populated from the /senddata endpoint.
-    We always go from the last midnight.
+    Positions of records the backend no longer keeps are skipped, see StorageBackend.read.
+    The sequence number of each record is its position in the stream, plus one.
+    """
+    positions, raw = _backend.read(model_id, message_name, index_start, index_end)
+    if not _backend.serializes:
+        return [_numbered(x, pos + 1) for pos, x in zip(positions, raw)]
+    return [_decode_record(model_id, message_name, x, pos + 1) for pos, x in zip(positions, raw)]
+
+
+def get_raw_data_by_time(model_id, message_name, time_start, time_end):
+    """
+    Gets the records of a (model_id, message_name) pair received from time_start to time_end,
+    in epoch seconds, inclusive, like get_raw_data. The positions are located with the time index
+    of the stream, which is by the second records were written, so this reads the records written
+    up to TIME_INDEX_SLACK seconds later too, or the write-behind delay, and keeps those whose
+    APV_RECVD is in the range. Records written before the time index existed are not found.
     """
-    index = _get_raw_data_source_index(model_id, message_name)
-    # you cannot have lists of dicts in myredis, the solution is to serialize them,
-    # see https://stackoverflow.com/questions/8664664/list-of-dicts-in-myredis
-    return [pickle.loads(x) for x in myredis.lrange(index, index_start, index_end)] if myredis.exists(index) else []
+    slack = max(TIME_INDEX_SLACK, INGEST_FLUSH_MS // 1000 + 1)
+    index_start, index_end = _backend.locate(model_id, message_name, time_start, time_end + slack)
+    if index_start > index_end:
+        return []
+    return [r for r in get_raw_data(model_id, message_name, index_start, index_end) if time_start <= r[APV_RECVD] <= time_end]
+
+
+def get_raw_columns(model_id, message_name, field_names, index_start, index_end):
+    """
+    Gets the values of some fields of the records at stream positions index_start to
+    index_end, like get_raw_data, as the dict {field name: list of values}, which also
+    has the APV_SEQNO of each record. Field names may be flattened, "i.x".
+    With COLUMN_STORE, if every field is in a column, see columns.ColumnLayout, this
+    reads only those columns instead of the records, which is far less to read and
+    decode for wide messages; otherwise it reads the records.
+    """
+    result = _backend.read_columns(model_id, message_name, field_names, index_start, index_end)
+    if result is None:
+        records = get_raw_data(model_id, message_name, index_start, index_end)
+        accessors = get_field_accessors(model_id, message_name, field_names)
+        result = {f: get_messages_data(records, f, accessors[f]) for f in field_names}
+        result[APV_SEQNO] = [r[APV_SEQNO] for r in records]
+    return result
+
+
+def get_rollups(model_id, message_name, field_names, time_start, time_end, width):
+    """
+    Gets the rollups of numeric fields of a (model_id, message_name) pair over the receive
+    times time_start to time_end, in epoch seconds, for a plot width points wide. This reads the
+    finest tier with at most width buckets in the range that still covers it, else the coarsest,
+    so the number of points is bounded whatever the range and the ingest rate.
+    Answers the dict {"resolution": seconds per bucket, APV_RECVD: [bucket start],
+    "count": [number of records], "fields": {field name: {"min", "max", "mean", "last": [value]}}},
+    by ascending bucket start, or None if nothing was rolled up, see ROLLUPS.
+    Field names may be flattened, "i.x"; raises KeyError for a field that is not rolled up.
+    """
+    rollup = _rollups.get((model_id, message_name))
+    if rollup is None:
+        return None
+    return rollup.read(field_names, time_start, time_end, width)
+
+
+def get_field_accessors(model_id, message_name, field_names):
+    """
+    Gets the accessors of fields of a (model_id, message_name) pair, compiled when it was
+    registered, see utils.compile_field_accessors; those of unknown fields are compiled here.
+    Returns a dict of field name -> accessor.
+    """
+    if model_id in proto_data_structure:
+        known = proto_data_structure[model_id].get("messages", {}).get(message_name, {}).get("accessors", {})
+    else:
+        known = jsonschema_data_structure.get(model_id, {}).get("accessors", {})
+    return {f: known[f] if f in known else compile_field_accessor(f) for f in field_names}
+
+
+def get_model_as_string(model_id, message_name, record):
+    """
+    Returns the string version of a record (the apv_model_as_string field) that
+    is used by the raw display. It is not stored with the record; instead it is
+    rendered when a session reads it, and the last few renderings are cached.
+    """
+    key = (model_id, message_name, record.get(APV_SEQNO), record.get(APV_RECVD))
+    with _model_string_lock:
+        if key in _model_string_cache:
+            _model_string_cache.move_to_end(key)
+            return _model_string_cache[key]
+    rendered = _model_as_string(record)
+    with _model_string_lock:
+        _model_string_cache[key] = rendered
+        if len(_model_string_cache) > MODEL_STRING_CACHE_SIZE:
+            _model_string_cache.popitem(last=False)
+    return rendered
+
+
+def message_keys_match(model_id, message_name):
+    """
+    Answers whether records converted from the message have exactly the keys its
+    json schema expects; a safeguard against malformed definitions.
+    The converter emits every field of the descriptor, so the answer depends only
+    on (model_id, message_name) and is worked out once, on an empty message.
+    """
+    key = (model_id, message_name)
+    if key not in _message_keys_match:
+        act_keys = sorted(_msg_to_dict(_parse_message(b"", model_id, message_name), 0).keys())
+        exp_keys = sorted(k for k in proto_data_structure[model_id]["messages"][message_name]["properties"].keys() if k not in (APV_MODEL, APV_SEQNO))
+        if act_keys != exp_keys:
+            _logger.warning("message_keys_match: messages {0} will be dropped due to unexpected keys: received {1} expected {2}".format(message_name, act_keys, exp_keys))
+        _message_keys_match[key] = act_keys == exp_keys
+    return _message_keys_match[key]
+
+
+def get_blob(ref):
+    """
+    Gets the bytes a BlobRef (or a blob digest) stands for, None if they expired
+    """
+    digest = ref.digest if isinstance(ref, BlobRef) else ref
+    return _backend.get_blob(digest)
+
+
+def encode_data(binarydata, model_id, message_name):
+    """
+    Encodes one message of a registered model as the bytes stored in redis, or as the
+    dict kept by a backend that does not serialize.
+    This is the CPU-bound part of ingest and touches neither redis nor the
+    registries, so it can run in a worker process.
+    Returns the tuple (encoded record, blobs {digest: bytes} it refers to).
+    Raises DecodeError if the message cannot be parsed.
+    """
+    blobs = {}
+    return _encode_record(binarydata, model_id, message_name, blobs), blobs
+
+
+def encode_data_batch(binarydata, model_id, message_name):
+    """
+    Encodes a body of varint-length-delimited messages of a registered model.
+    Like encode_data this can run in a worker process.
+    Returns the tuple (list of encoded records, blobs they refer to, number of messages rejected).
+    """
+    payloads, truncated = split_delimited(binarydata)
+    rejected = 1 if truncated else 0
+    records = []
+    blobs = {}
+    for payload in payloads:
+        try:
+            records.append(_encode_record(payload, model_id, message_name, blobs))
+        except DecodeError:
+            _logger.warning("encode_data_batch: dropped undecodable message {0}".format(message_name))
+            rejected += 1
+    return records, blobs, rejected
+
+
+def store_data(model_id, message_name, records, blobs=None):
+    """
+    Appends encoded records, and the blobs they refer to, to the (model_id, message_name)
+    data source, see StorageBackend.append.
+    Returns the sequence number of the first record, or None if it is not known yet
+    because the records are buffered and INGEST_FLUSH_SYNC is not set.
+    """
+    if ROLLUPS:
+        _update_rollups(model_id, message_name, records)
+        if _backend.serializes and not isinstance(_backend, RedisBackend) and model_id in proto_data_structure:
+            records = _strip_rows(model_id, message_name, records)
+    first = _backend.append(model_id, message_name, records, blobs or {})
+    return first + 1 if first is not None else None
+
+
+def flush_data():
+    """
+    Blocks until every buffered record is written
+    """
+    _backend.flush()
+
+
+def register_model(proto_url, message_name):
+    """
+    Registers the proto file of a message; returns immediately if it already is.
+    Returns the model_id, or None if messages of this type would be dropped due to unexpected keys.
+    Raises SchemaNotReachable if the proto_url is invalid.
+    """
+    model_id = register_proto_from_url(proto_url)
+    return model_id if message_keys_match(model_id, message_name) else None
 
 
 def inject_data(binarydata, proto_url, message_name):
@@ -140,30 +1170,16 @@ def inject_data(binarydata, proto_url, message_name):
     Answers true if expected keys are found, otherwise false.
     In the future if the data moves to a database this would go away
     """
-    # register the proto file. Will return immediately if already exists
-    model_id = register_proto_from_url(proto_url)
-
-    count = get_raw_data_source_count(model_id, message_name)
-    index = _get_raw_data_source_index(model_id, message_name)
-    _logger.debug("inject_data: message_name %s sequence %d", message_name, count + 1)
-    j = _msg_to_json_preserve_bytes(binarydata, model_id, message_name, count + 1)
-    # safeguard against malformed data
-    act_keys = sorted(j.keys())
-    exp_keys = sorted(proto_data_structure[model_id]["messages"][message_name]["properties"].keys())
-    if act_keys == exp_keys:
-        # this auto creates the key if it does not exist yet #https://myredis.io/commands/lpush
-        try:
-            pickled_json_message = pickle.dumps(j)
-            myredis.rpush(index, pickled_json_message)
-        except Exception as exc:
-            _logger.error("inject_data: failed to pickle data or upload it to redis")
-            _logger.exception(exc)
-        if count == 0:
-            _logger.debug("inject_data: created new data source with TTL of one day")
-            myredis.expire(index, 60 * 60 * 24)
-    else:
-        _logger.warning("inject_data: dropped message {0} due to unexpected keys: received {1} expected {2}".format(message_name, act_keys, exp_keys))
+    model_id = register_model(proto_url, message_name)
+    if model_id is None:
         return False
+    record, blobs = encode_data(binarydata, model_id, message_name)
+    try:
+        sequence_no = store_data(model_id, message_name, [record], blobs)
+        _logger.debug("inject_data: message_name %s sequence %s", message_name, sequence_no)
+    except Exception as exc:
+        _logger.error("inject_data: failed to upload data to redis")
+        _logger.exception(exc)
     return True
 
 
@@ -172,10 +1188,7 @@ def delete_mr_subscription(topic_name):
     Teardown a message-router subscription
     """
     # all we need to do is delete the active flag and the thread will kill itself
-    if myredis.get(topic_name) is None:
-        return False
-    myredis.delete(topic_name)
-    return True
+    return _backend.delete_flag(topic_name)
 
 
 def setup_mr_subscription(fully_qualified_topic_url, schema_url, topic_name):
@@ -183,9 +1196,8 @@ def setup_mr_subscription(fully_qualified_topic_url, schema_url, topic_name):
     Creates a new message-router subscription (if it doesn't already exist)
     """
     register_jsonschema_from_url(schema_url, topic_name)
-    if myredis.get(topic_name) is not None:
+    if not _backend.set_flag(topic_name):
         return True
-    myredis.set(topic_name, 1)
     tp = Thread(target=mr_reader_thread, args=[fully_qualified_topic_url, topic_name])
     tp.start()  # thread will kill itself when DELETE is called or an exception is raised
 
@@ -198,31 +1210,26 @@ def mr_reader_thread(fully_qualified_topic_url, topic_name):
     _logger.info("Starting MR thread on topic %s", topic_name)
     groupid = uuid.uuid4().hex
     clientid = uuid.uuid4().hex
-    while myredis.get(topic_name) is not None:  # check if we should die
+    while _backend.get_flag(topic_name):  # check if we should die
         time.sleep(.5)
         _logger.debug("Getting from {0}".format(topic_name))
         resp = requests.get('{0}/{1}/{2}?timeout=1000&limit=100'.format(fully_qualified_topic_url, groupid, clientid))
         try:
             resp.raise_for_status()
         except Exception as exc:
-            myredis.delete(topic_name)
+            _backend.delete_flag(topic_name)
             raise exc
 
         data = json.loads(resp.text)
 
         message_name = "{0}_messages".format(topic_name)
 
-        size = get_raw_data_source_count(topic_name, message_name)
-        index = _get_raw_data_source_index(topic_name, message_name)
-
-        item_sequence_no = size + 1
+        records = []
         for data_item in data:
             data_item = json.loads(data_item)
 
-            # set the apv fields
-            data_item[APV_MODEL] = json.dumps(data_item)
+            # set the apv fields; the sequence number is the position in the list
             data_item[APV_RECVD] = int(time.time())
-            data_item[APV_SEQNO] = item_sequence_no
 
             # safegaurd against malformed data
             try:
@@ -230,15 +1237,15 @@ def mr_reader_thread(fully_qualified_topic_url, topic_name):
             except jsonschema.exceptions.ValidationError:
                 _logger.error("data item does not match the schema!")
 
-            # this auto creates the key if it does not exist yet #https://myredis.io/commands/lpush
-            myredis.rpush(index, pickle.dumps(data_item))
-            _logger.debug("MR reader for {0} received valid data".format(topic_name))
-            if size == 0:
-                _logger.debug(
-                    "Created new data source and setting a TTL of one day")
-                myredis.expire(index, 60 * 60 * 24)
+            if not _backend.serializes:
+                records.append(data_item)
+            else:
+                # topics have no protobuf schema, so they are stored as json whatever the RECORD_FORMAT
+                records.append(_compress_record(topic_name, dumps("json", data_item)))
 
-            item_sequence_no += 1
+        if records:
+            store_data(topic_name, message_name, records)
+            _logger.debug("MR reader for {0} received {1} data items".format(topic_name, len(records)))
 
     _logger.debug("mr_reader_thread for %s is now exiting", topic_name)
 
@@ -0,0 +1,125 @@
+# Acumos - Apache 2.0
+
+
+from bisect import bisect_left
+
+import numpy
+
+from acumos_proto_viewer import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# the decimation methods: largest triangle three buckets picks one point per bucket, the one
+# that keeps the shape of the line; min/max keeps the extremes of each bucket, for step plots
+LTTB = "lttb"
+MINMAX = "minmax"
+
+
+def _lttb_pick(xs, ys, start, end, prev, next_x, next_y):
+    """
+    Picks the point of the bucket xs[start:end] that makes the largest triangle with the point
+    picked in the previous bucket, at index prev, and the average of the next bucket
+    """
+    bx = xs[start:end]
+    by = ys[start:end]
+    areas = numpy.abs((xs[prev] - next_x) * (by - ys[prev]) - (xs[prev] - bx) * (next_y - ys[prev]))
+    return start + int(numpy.argmax(numpy.where(numpy.isnan(areas), -1.0, areas)))
+
+
+def _minmax_pick(ys, start, end):
+    """
+    Picks the points of the minimum and the maximum of the bucket ys[start:end], in order
+    """
+    by = ys[start:end]
+    if numpy.isnan(by).all():
+        return (start,)
+    low = start + int(numpy.nanargmin(by))
+    high = start + int(numpy.nanargmax(by))
+    return (min(low, high), max(low, high)) if low != high else (low,)
+
+
+class Decimator(object):
+    """
+    Keeps the latest window points of an x-y series and draws them in about budget points,
+    with LTTB or MINMAX. Points fall into buckets of a power of two points by their position
+    in the series, the smallest size that fits the budget, so a bucket keeps the same points
+    until the size doubles; the picks of complete buckets are kept, so new points cost the
+    buckets they complete instead of the whole series. The points of the last, incomplete
+    bucket are drawn as they are, so the plot stays current.
+    """
+    def __init__(self, budget, window, method=LTTB):
+        self.budget = budget if method == LTTB else max(budget // 2, 1)  # buckets
+        self.window = max(window, budget)
+        self.method = method
+        self._xs = numpy.empty(0)
+        self._ys = numpy.empty(0)
+        self._offset = 0  # the position in the series of the first point kept
+        self._size = 1
+        self._buckets = None  # the complete buckets drawn last, (first, end)
+        self._picks = []  # the positions picked in the buckets after the first up to _picks_end, which are final
+        self._picks_end = 0
+
+    def _pick(self, bucket, prev, end_bucket):
+        """
+        Answers the positions of the points picked in a complete bucket, given the last one
+        picked before it, if any, and whether they are final
+        """
+        xs, ys, size, offset = self._xs, self._ys, self._size, self._offset
+        start = max(bucket * size - offset, 0)
+        end = (bucket + 1) * size - offset
+        if self.method == MINMAX:
+            return [offset + i for i in _minmax_pick(ys, start, end)], True
+        if prev is None:
+            return [offset + start], False  # keeps the first point
+        # the next bucket is averaged; the last complete one has the incomplete one after it, if any
+        next_end = min(end + size, len(xs))
+        if next_end == end:
+            return [offset + end - 1], False  # keeps the last point
+        next_x, next_y = numpy.nanmean(xs[end:next_end]), numpy.nanmean(ys[end:next_end])
+        return [offset + _lttb_pick(xs, ys, start, end, prev - offset, next_x, next_y)], bucket + 1 < end_bucket
+
+    def add(self, xs, ys):
+        """
+        Adds the new points of the series. Answers (True, (xs, ys)) with the points to draw
+        instead of those drawn so far, or (False, (xs, ys)) with the points to draw after them.
+        """
+        xs = numpy.asarray(xs, dtype="float64")
+        ys = numpy.asarray(ys, dtype="float64")
+        self._xs = numpy.concatenate((self._xs, xs))
+        self._ys = numpy.concatenate((self._ys, ys))
+        count = len(self._xs)
+        if count > self.window:
+            self._offset += count - self.window
+            self._xs = self._xs[-self.window:]
+            self._ys = self._ys[-self.window:]
+            count = self.window
+        if self._buckets is None and count <= self.budget:
+            return False, (xs, ys)  # few enough to draw them all
+        size = self._size
+        while (count + size - 1) // size > self.budget:
+            size *= 2
+        if size != self._size:
+            _logger.debug("Decimator: buckets of {0} points".format(size))
+            self._size = size
+            self._buckets = None
+            self._picks, self._picks_end = [], 0
+        first_bucket = self._offset // size
+        end_bucket = (self._offset + count) // size  # after the last complete one
+        if (first_bucket, end_bucket) == self._buckets:
+            return False, (xs, ys)  # in the incomplete bucket
+        self._buckets = (first_bucket, end_bucket)
+        # the first bucket may have lost points to the window, so it is picked again
+        picks = self._picks
+        del picks[:bisect_left(picks, (first_bucket + 1) * size)]
+        first, _ = self._pick(first_bucket, None, end_bucket)
+        last = []
+        for bucket in range(max(self._picks_end, first_bucket + 1), end_bucket):
+            picked, final = self._pick(bucket, picks[-1] if picks else first[-1], end_bucket)
+            if not final:
+                last = picked
+                break
+            picks.extend(picked)
+            self._picks_end = bucket + 1
+        kept = numpy.asarray(first + picks + last, dtype="int64") - self._offset
+        tail = slice(end_bucket * size - self._offset, count)
+        return True, (numpy.concatenate((self._xs[kept], self._xs[tail])), numpy.concatenate((self._ys[kept], self._ys[tail])))
@@ -3,3 +3,13 @@
 
 class SchemaNotReachable(Exception):
     pass
+
+
+class IngestRejected(Exception):
+    """
+    Raised when the ingest queue cannot take more work; retry_after is in seconds
+    """
+    def __init__(self, reason, retry_after):
+        super(IngestRejected, self).__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
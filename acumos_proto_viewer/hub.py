@@ -0,0 +1,169 @@
+# Acumos - Apache 2.0
+
+
+from threading import Event, Lock, Thread
+
+from acumos_proto_viewer import data, get_module_logger
+from acumos_proto_viewer.utils import APV_SEQNO
+
+_logger = get_module_logger(__name__)
+
+
+class Subscription(object):
+    """
+    A subscription to the new records of a data source, see StreamHub.subscribe
+    """
+    __slots__ = ("seq", "deliver", "_poller")
+
+    def __init__(self, seq, deliver, poller):
+        self.seq = seq
+        self.deliver = deliver
+        self._poller = poller
+
+    def cancel(self):
+        """
+        Stops the deliveries; one already being made may still arrive
+        """
+        self._poller.remove(self)
+
+
+class _Poller(Thread):
+    """
+    Reads the new records, or columns, of a data source once per tick and hands the same
+    batch to every subscriber. With a storage backend that wakes readers a tick starts when
+    records arrive, else every interval_ms. Exits when the last subscriber leaves.
+    A tick reads at most batch_size records, and a subscriber behind the others catches up
+    by at most batch_size records a tick, so a backlog loads over several ticks, each
+    interval_ms apart, and no session update is larger than that.
+    """
+    def __init__(self, hub, key, interval_ms, batch_size):
+        model_id, message_name, _ = key
+        super().__init__(name="hub-{0}-{1}".format(model_id, message_name), daemon=True)
+        self._hub = hub
+        self._key = key
+        self._interval_ms = interval_ms
+        self._batch_size = batch_size
+        self._subscriptions = []
+        self._woken = Event()
+        self.cursor = 0  # the sequence number of the last record read
+
+    def join_subscription(self, subscription):
+        self._subscriptions.append(subscription)
+        self._woken.set()
+
+    def remove(self, subscription):
+        with self._hub._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _read(self, index_start, index_end):
+        """
+        Reads records, or columns if the key has fields; answers (batch, sequence number of its
+        last record), or (None, None) if there are none
+        """
+        model_id, message_name, fields = self._key
+        if fields is None:
+            records = data.get_raw_data(model_id, message_name, index_start, index_end)
+            return (records, records[-1][APV_SEQNO]) if records else (None, None)
+        columns = data.get_raw_columns(model_id, message_name, list(fields), index_start, index_end)
+        return (columns, columns[APV_SEQNO][-1]) if columns[APV_SEQNO] else (None, None)
+
+    def _deliver(self, subscription, batch):
+        try:
+            subscription.deliver(batch)
+        except Exception as exc:  # e.g., the session was closed
+            _logger.debug("_Poller: dropping a subscriber of {0}: {1}".format(self.name, exc))
+            self.remove(subscription)
+
+    def _tick(self, subscriptions):
+        """
+        Answers whether there is a backlog left
+        """
+        # subscribers behind the others catch up on their own
+        lagging = [subscription for subscription in subscriptions if subscription.seq < self.cursor]
+        for subscription in lagging:
+            end = min(subscription.seq + self._batch_size, self.cursor)
+            batch, last = self._read(subscription.seq, end - 1)
+            if batch is not None:
+                self._deliver(subscription, batch)
+            # records a ring dropped since are skipped
+            subscription.seq = last if batch is not None else end
+        live = [subscription for subscription in subscriptions if subscription.seq >= self.cursor]
+        batch, last = self._read(self.cursor, self.cursor + self._batch_size - 1)
+        if batch is not None:
+            self.cursor = last
+            for subscription in live:
+                self._deliver(subscription, batch)
+                subscription.seq = max(subscription.seq, last)
+        if any(subscription.seq < self.cursor for subscription in lagging):
+            return True
+        model_id, message_name, _ = self._key
+        return last is not None and data.get_raw_data_source_count(model_id, message_name) > self.cursor
+
+    def _wait(self, backlog):
+        model_id, message_name, _ = self._key
+        if not backlog and data.get_backend().wakes_readers:
+            data.wait_for_data(model_id, message_name, self.cursor, self._interval_ms)
+        else:
+            self._woken.wait(self._interval_ms / 1000.0)
+            self._woken.clear()
+
+    def run(self):
+        model_id, message_name, _ = self._key
+        self.cursor = data.get_raw_data_source_count(model_id, message_name)
+        backlog = False
+        while True:
+            with self._hub._lock:
+                if not self._subscriptions:
+                    del self._hub._pollers[self._key]
+                    _logger.debug("_Poller: {0} has no subscribers left".format(self.name))
+                    return
+                subscriptions = list(self._subscriptions)
+            try:
+                backlog = self._tick(subscriptions)
+                self._wait(backlog)
+            except Exception as exc:
+                _logger.exception(exc)
+                self._woken.wait(self._interval_ms / 1000.0)
+
+
+class StreamHub(object):
+    """
+    Fans the new records of each data source out to every session that plots it, so each
+    batch is read and decoded once, whatever the number of sessions: one poller thread per
+    (model_id, message_name, fields) subscribed to. Sessions get at most batch_size records at
+    a time, see _Poller.
+    """
+    def __init__(self, interval_ms, batch_size):
+        self._interval_ms = interval_ms
+        self._batch_size = batch_size
+        self._pollers = {}
+        self._lock = Lock()
+
+    def subscribe(self, model_id, message_name, fields, seq, deliver):
+        """
+        Subscribes to the records after sequence number seq: deliver(batch) is called, from
+        the poller thread, with the list of the new records, or if fields is set the dict of
+        their columns like data.get_raw_columns, of at most batch_size records. The batches are
+        shared by the subscribers, which must not modify them, and may overlap what a subscriber
+        already has. A subscriber far behind gets its backlog over several ticks.
+        Returns the Subscription.
+        """
+        key = (model_id, message_name, tuple(fields) if fields is not None else None)
+        with self._lock:
+            poller = self._pollers.get(key)
+            started = poller is None
+            if started:
+                poller = self._pollers[key] = _Poller(self, key, self._interval_ms, self._batch_size)
+            subscription = Subscription(seq, deliver, poller)
+            poller.join_subscription(subscription)
+        if started:
+            poller.start()
+        return subscription
+
+    def pollers(self):
+        """
+        Answers the keys of the data sources being polled
+        """
+        with self._lock:
+            return list(self._pollers)
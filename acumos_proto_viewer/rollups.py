@@ -0,0 +1,120 @@
+# Acumos - Apache 2.0
+
+
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+from acumos_proto_viewer import get_module_logger
+from acumos_proto_viewer.utils import APV_RECVD
+
+_logger = get_module_logger(__name__)
+
+# the bucket lengths of the tiers, in seconds, finest first
+RESOLUTIONS = (1, 10, 60)
+# the bool columns of a layout are not rolled up
+_BOOL_CODE = "?"
+
+
+class _Bucket(object):
+    """
+    The aggregates of the records of one time bucket: their number, and for each
+    field the minimum, maximum, sum and last value, in one array of doubles
+    """
+    __slots__ = ("count", "stats")
+
+    def __init__(self, width):
+        self.count = 0
+        self.stats = array("d", [float("inf"), float("-inf"), 0.0, 0.0] * width)
+
+    def merge(self, count, mins, maxs, sums, lasts):
+        stats = self.stats
+        for i, j in enumerate(range(0, len(stats), 4)):
+            if mins[i] < stats[j]:
+                stats[j] = mins[i]
+            if maxs[i] > stats[j + 1]:
+                stats[j + 1] = maxs[i]
+            stats[j + 2] += sums[i]
+            stats[j + 3] = lasts[i]
+        self.count += count
+
+
+class Rollup(object):
+    """
+    The rollup tiers of one data source: for each of RESOLUTIONS, the count, min, max,
+    mean and last value of every numeric column of its columns.ColumnLayout per bucket
+    of that many seconds of receive time. Each tier keeps its latest capacity buckets,
+    so the finer ones cover less time.
+    """
+    def __init__(self, layout, capacity):
+        self.capacity = capacity
+        self._columns = [i for i, code in enumerate(layout.codes) if i > 0 and code != _BOOL_CODE]
+        self.fields = [layout.fields[i] for i in self._columns]
+        self._by_field = {f: i for i, f in enumerate(self.fields)}
+        self._tiers = [OrderedDict() for _ in RESOLUTIONS]
+        self._lock = Lock()
+
+    def add(self, rows):
+        """
+        Adds records, given their rows of values in the order of the layout, see
+        columns.ColumnLayout, as received. Records of the same second are aggregated
+        once, then merged into the bucket of each tier. The buckets of a tier are kept
+        by ascending start, also when records arrive out of order, so the oldest is evicted.
+        """
+        seconds = OrderedDict()
+        for row in rows:
+            seconds.setdefault(row[0], []).append([row[i] for i in self._columns])
+        with self._lock:
+            for second, group in seconds.items():
+                columns = list(zip(*group))
+                mins = [min(c) for c in columns]
+                maxs = [max(c) for c in columns]
+                sums = [sum(c) for c in columns]
+                for resolution, tier in zip(RESOLUTIONS, self._tiers):
+                    start = second - second % resolution
+                    bucket = tier.get(start)
+                    if bucket is None:
+                        if len(tier) >= self.capacity:
+                            if start < next(iter(tier)):
+                                continue  # late, its bucket is gone already
+                            tier.popitem(last=False)
+                        late = tier and start < next(reversed(tier))
+                        bucket = tier[start] = _Bucket(len(self.fields))
+                        if late:
+                            # the tiers are in time order, which eviction and _pick_tier rely on
+                            for later in [k for k in tier if k > start]:
+                                tier.move_to_end(later)
+                    bucket.merge(len(group), mins, maxs, sums, group[-1])
+
+    def _pick_tier(self, time_start, time_end, width):
+        """
+        Picks the finest tier that draws the range in at most width buckets and still
+        has its start, else the coarsest
+        """
+        for resolution, tier in zip(RESOLUTIONS, self._tiers):
+            if (time_end - time_start) // resolution < width and (len(tier) < self.capacity or next(iter(tier)) <= time_start):
+                return resolution, tier
+        return RESOLUTIONS[-1], self._tiers[-1]
+
+    def read(self, field_names, time_start, time_end, width):
+        """
+        Reads the buckets of the tier that suits a time range, see data.get_rollups
+        """
+        unknown = [f for f in field_names if f not in self._by_field]
+        if unknown:
+            raise KeyError("not rolled up: {0}".format(", ".join(unknown)))
+        with self._lock:
+            resolution, tier = self._pick_tier(time_start, time_end, width)
+            buckets = sorted((start, bucket.count, bucket.stats[:]) for start, bucket in tier.items()
+                             if time_start - resolution < start <= time_end)
+        result = {"resolution": resolution,
+                  APV_RECVD: [start for start, _, _ in buckets],
+                  "count": [count for _, count, _ in buckets],
+                  "fields": {}}
+        for f in field_names:
+            j = 4 * self._by_field[f]
+            result["fields"][f] = {"min": [stats[j] for _, _, stats in buckets],
+                                   "max": [stats[j + 1] for _, _, stats in buckets],
+                                   "mean": [stats[j + 2] / count for _, count, stats in buckets],
+                                   "last": [stats[j + 3] for _, _, stats in buckets]}
+        return result
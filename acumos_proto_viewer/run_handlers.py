@@ -1,12 +1,33 @@
 # Acumos - Apache 2.0
 
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from google.protobuf.message import DecodeError
 import hashlib
+import json
+import multiprocessing
+import os
+import numpy
+from tornado import gen
 from acumos_proto_viewer import data, get_module_logger
-from acumos_proto_viewer.exceptions import SchemaNotReachable
+from acumos_proto_viewer.admission import AdmissionController
+from acumos_proto_viewer.exceptions import IngestRejected, SchemaNotReachable
 
 _logger = get_module_logger(__name__)
 
+# read params from env variables
+# messages POSTed to /data are decoded in a pool of threads or processes, so the IOLoop keeps serving the sessions
+INGEST_EXECUTOR = os.environ.get("INGEST_EXECUTOR", "thread")
+INGEST_WORKERS = int(os.environ["INGEST_WORKERS"]) if "INGEST_WORKERS" in os.environ else 4
+_decode_pool = None
+_io_pool = None
+# admission control in front of the pools: POSTs over these limits are answered 429 with a Retry-After
+INGEST_QUEUE_SIZE = int(os.environ["INGEST_QUEUE_SIZE"]) if "INGEST_QUEUE_SIZE" in os.environ else 1000
+INGEST_MODEL_CONCURRENCY = int(os.environ["INGEST_MODEL_CONCURRENCY"]) if "INGEST_MODEL_CONCURRENCY" in os.environ else INGEST_WORKERS
+INGEST_MODEL_RATE = float(os.environ["INGEST_MODEL_RATE"]) if "INGEST_MODEL_RATE" in os.environ else 0
+INGEST_TRACKED_MODELS = int(os.environ["INGEST_TRACKED_MODELS"]) if "INGEST_TRACKED_MODELS" in os.environ else 1000
+_admission = None
+
 # Constants used in the GUI to name bokeh models
 DEFAULT_UNSELECTED = "Please Select"
 MODEL_SELECTION = "modelselec"
@@ -24,6 +45,10 @@ Y_AXIS_SELECTION = "yaxisselect"
 COLUMN_MULTISELECT = "colmultiselect"
 COLUMN_SELECTION = "colselect"
 
+# the numpy dtypes of the numeric json schema types; browsers hold every number as a double, and bokeh
+# sends float64 arrays as binary buffers but int64 ones as JSON lists, so integers become doubles too
+_COLUMN_DTYPES = {"number": "float64", "integer": "float64"}
+
 
 def get_modelid_messagename_type(curdoc):
     """
@@ -48,6 +73,33 @@ def get_model_properties(model_id, message_name, model_type):
     return data.proto_data_structure[model_id]["messages"][message_name]["properties_flat"] if model_type == "protobuf" else data.jsonschema_data_structure[model_id]["json_schema"]["properties"]
 
 
+def get_column_dtypes(model_id, message_name, model_type, field_names):
+    """
+    Gets the numpy dtype of the columns of fields, from the json schema type of their properties;
+    None for those that are not numeric
+    """
+    props = get_model_properties(model_id, message_name, model_type)
+    dtypes = {}
+    for f in field_names:
+        json_type = props.get(f, {}).get("type")
+        dtypes[f] = _COLUMN_DTYPES.get(json_type) if isinstance(json_type, str) else None
+    return dtypes
+
+
+def to_typed_column(values, dtype):
+    """
+    Converts the values of a column to a numpy array of dtype, which bokeh streams to the
+    browser as a binary buffer instead of a JSON list; None becomes NaN. The values stay a
+    list if dtype is None or if they do not convert.
+    """
+    if dtype is None:
+        return values
+    try:
+        return numpy.asarray(values, dtype=dtype)
+    except (TypeError, ValueError):
+        return values
+
+
 def get_source_index(session_id, model_id, message_name, field_name=None):
     """
     Gets a ColumnDataSource index given session id, modelid, messagename, and optionally field
@@ -60,27 +112,151 @@ def get_source_index(session_id, model_id, message_name, field_name=None):
     return hashlib.sha224(hind.encode('utf-8')).hexdigest()
 
 
-def handle_data_post(headers, req_body):
+def start_pools():
+    """
+    Creates the pools used by the asynchronous handlers: one that decodes messages,
+    made of threads or processes per INGEST_EXECUTOR, and a thread pool for the
+    blocking work, i.e., schema registration and the redis writes.
+    Worker processes are forked right away, so call this before any thread starts:
+    a fork copies the locks other threads hold, e.g., of logging or of the redis
+    connection pool, and the worker would deadlock on them. They are not spawned
+    instead because that runs the main script, i.e., the server, again in each of them.
+    """
+    global _decode_pool, _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+        if INGEST_EXECUTOR == "process":
+            _decode_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context("fork"))
+            _decode_pool.submit(int).result()  # the first task forks all the workers
+        else:
+            _decode_pool = _io_pool
+        _logger.debug("start_pools: decoding in a %s pool of %d workers", INGEST_EXECUTOR, INGEST_WORKERS)
+
+
+def _get_pools():
+    """
+    Gets the pools of the asynchronous handlers, creating them if start_pools was not called
+    """
+    start_pools()
+    return _decode_pool, _io_pool
+
+
+def _get_admission():
+    """
+    Lazily creates the admission controller of the asynchronous handlers
+    """
+    global _admission
+    if _admission is None:
+        _admission = AdmissionController(INGEST_QUEUE_SIZE, INGEST_MODEL_CONCURRENCY, INGEST_MODEL_RATE,
+                                         max_models=INGEST_TRACKED_MODELS)
+    return _admission
+
+
+@gen.coroutine
+def _admitted(proto_url, cost, ingest):
+    """
+    Runs the coroutine function ingest once the model of proto_url is admitted,
+    answering its (code, status) plus the response headers.
+    Answers 429 with a Retry-After header if the request is not admitted.
+    """
+    admission = _get_admission()
+    try:
+        yield admission.acquire(proto_url, cost)
+    except IngestRejected as exc:
+        _logger.warning("_admitted: rejected POST for url %s: %s", proto_url, exc.reason)
+        return 429, "Error: {0}, retry later.".format(exc.reason), {"Retry-After": str(exc.retry_after)}
+    try:
+        code, status = yield ingest()
+    finally:
+        admission.release(proto_url)
+    return code, status, {}
+
+
+@gen.coroutine
+def _ingest_one(proto_url, message_name, req_body):
+    """
+    Registers, decodes and stores one POSTed message, see handle_data_post_async
+    """
+    decode_pool, io_pool = _get_pools()
+    try:
+        model_id = yield io_pool.submit(data.register_model, proto_url, message_name)
+    except SchemaNotReachable:
+        _logger.error("handle_data_post_async: failed to download def for url %s", proto_url)
+        return 400, "Error: {0} was not downloadable!".format(proto_url)
+    if model_id is None:
+        return 400, req_body
+    try:
+        record, blobs = yield decode_pool.submit(data.encode_data, req_body, model_id, message_name)
+    except DecodeError:
+        _logger.warning("handle_data_post_async: dropped undecodable message %s", message_name)
+        return 400, req_body
+    yield io_pool.submit(data.store_data, model_id, message_name, [record], blobs)
+    # due to the way the Acumos "model connector" aka "blueprint orchestrator" works,
+    # this should return the same request body that it received
+    return 200, req_body
+
+
+@gen.coroutine
+def handle_data_post_async(headers, req_body):
     """
     Handles the POST to /data. Uses metadata to discover the supporting protocol buffer definition.
+    The registration and the redis write run in a thread pool and the decoding in
+    the ingest pool, so a burst of large POSTs does not stall the sessions' callbacks.
+    Answers (code, status, response headers); POSTs beyond the admission limits
+    are answered 429 with a Retry-After header.
     """
-    proto_url = headers.get("PROTO-URL", None)  # the weird casing on these were told to me by the model connector team
+    proto_url = headers.get("PROTO-URL", None)
     message_name = headers.get("Message-Name", None)
-    # this level of chattiness is not desirable for typical use
-    # _logger.debug("handle_data_post: proto_url %s message_name %s", proto_url, message_name)
     if (proto_url is None or message_name is None):
-        return 400, "Error: PROTO-URL or Message-Name header missing."
+        return 400, "Error: PROTO-URL or Message-Name header missing.", {}
+    res = yield _admitted(proto_url, 1, lambda: _ingest_one(proto_url, message_name, req_body))
+    return res
+
+
+@gen.coroutine
+def _ingest_batch(proto_url, message_name, req_body, count):
+    """
+    Registers, decodes and stores a POSTed batch of count messages, see handle_data_batch_post_async
+    """
+    decode_pool, io_pool = _get_pools()
     try:
-        res = data.inject_data(req_body, proto_url, message_name)
-        # due to the way the Acmos "model conector" aka "blueprint orchestrator" works,
-        # this should return the same request body that it received
-        if res:
-            return 200, req_body
-        else:
-            return 400, req_body
+        model_id = yield io_pool.submit(data.register_model, proto_url, message_name)
     except SchemaNotReachable:
-        _logger.error("handle_data_post: failed to download def for url %s", proto_url)
+        _logger.error("handle_data_batch_post_async: failed to download def for url %s", proto_url)
         return 400, "Error: {0} was not downloadable!".format(proto_url)
+    if model_id is None:
+        return 400, json.dumps({"accepted": 0, "rejected": count})
+    records, blobs, rejected = yield decode_pool.submit(data.encode_data_batch, req_body, model_id, message_name)
+    if records:
+        yield io_pool.submit(data.store_data, model_id, message_name, records, blobs)
+    code = 400 if not records and rejected > 0 else 200
+    return code, json.dumps({"accepted": len(records), "rejected": rejected})
+
+
+@gen.coroutine
+def handle_data_batch_post_async(headers, req_body):
+    """
+    Handles the POST to /data/batch. The body is a sequence of varint-length-delimited
+    protobuf messages that all share the PROTO-URL and Message-Name headers.
+    The status is a JSON object with the number of accepted and rejected messages.
+    Answers (code, status, response headers); every message of the batch counts
+    against the rate limit of the model.
+    """
+    proto_url = headers.get("PROTO-URL", None)
+    message_name = headers.get("Message-Name", None)
+    if (proto_url is None or message_name is None):
+        return 400, "Error: PROTO-URL or Message-Name header missing.", {}
+    count = len(data.split_delimited(req_body)[0])
+    res = yield _admitted(proto_url, max(count, 1), lambda: _ingest_batch(proto_url, message_name, req_body, count))
+    return res
+
+
+def handle_ingest_stats_get():
+    """
+    Handles the GET to /ingest_stats: the depth of the ingest queue and the
+    admission counters, overall and per PROTO-URL
+    """
+    return 200, json.dumps(_get_admission().stats())
 
 
 def handle_onap_mr_put(headers, topic_name):
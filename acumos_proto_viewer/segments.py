@@ -0,0 +1,369 @@
+# Acumos - Apache 2.0
+
+
+from bisect import bisect_right
+import hashlib
+import mmap
+import os
+import struct
+from threading import Condition, Lock
+import time
+import zlib
+
+from acumos_proto_viewer import get_module_logger
+from acumos_proto_viewer.storage import StorageBackend, TimeIndex
+
+_logger = get_module_logger(__name__)
+
+# a record is stored behind its length and crc32, so a torn write ends the log on recovery
+_FRAME = struct.Struct("<II")
+# the sparse index of a segment has the offset of every INDEX_INTERVAL-th record
+INDEX_INTERVAL = 64
+_INDEX_ENTRY = struct.Struct("<Q")
+_LOG_SUFFIX = ".log"
+_INDEX_SUFFIX = ".idx"
+# the entries of the time index written while a segment was the last one: (second, position)
+_TIME_ENTRY = struct.Struct("<QQ")
+_TIME_SUFFIX = ".tix"
+_BLOB_DIR = "blobs"
+# appends look for expired segments at most this often, in seconds, and whenever a segment is full
+_EXPIRE_INTERVAL = 60
+
+
+class _Segment(object):
+    """
+    A file of the log of a data source, preallocated to its capacity and mapped read-only,
+    holding the frames of consecutive records from position first, and its sparse index.
+    Only the last segment of a log is written, by pwrite, which the map sees.
+    """
+    __slots__ = ("first", "path", "capacity", "end", "count", "index", "written_at", "fd", "mm")
+
+    def __init__(self, path, first, capacity):
+        self.first = first
+        self.path = path
+        self.fd = os.open(path + _LOG_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+        self.written_at = os.fstat(self.fd).st_mtime
+        if os.fstat(self.fd).st_size < capacity:
+            os.ftruncate(self.fd, capacity)  # sparse, the disk is used as it is written
+            self.written_at = time.time()
+        self.capacity = os.fstat(self.fd).st_size
+        self.mm = mmap.mmap(self.fd, self.capacity, access=mmap.ACCESS_READ)
+        self.end = 0
+        self.count = 0
+        self.index = []
+
+    @classmethod
+    def load(cls, path, first):
+        """
+        Opens a segment written before, finding its end from the last index entry
+        """
+        segment = cls(path, first, 0)
+        with open(path + _INDEX_SUFFIX, "ab+") as index_file:
+            index_file.seek(0)
+            raw = index_file.read()
+        segment.index = [entry for entry, in _INDEX_ENTRY.iter_unpack(raw[:len(raw) - len(raw) % _INDEX_ENTRY.size])]
+        # a crash may have lost index entries or left frames or entries past the end
+        while segment.index and not segment._valid_frame(segment.index[-1]):
+            segment.index.pop()
+        if segment.index:
+            segment.count = (len(segment.index) - 1) * INDEX_INTERVAL
+            segment.end = segment.index[-1]
+        while segment._valid_frame(segment.end):
+            if segment.count % INDEX_INTERVAL == 0 and segment.count // INDEX_INTERVAL == len(segment.index):
+                segment.index.append(segment.end)
+            size, _ = _FRAME.unpack_from(segment.mm, segment.end)
+            segment.end += _FRAME.size + size
+            segment.count += 1
+        with open(path + _INDEX_SUFFIX, "wb") as index_file:
+            index_file.write(b"".join(_INDEX_ENTRY.pack(entry) for entry in segment.index))
+        return segment
+
+    def _valid_frame(self, offset):
+        if offset + _FRAME.size > self.capacity:
+            return False
+        size, crc = _FRAME.unpack_from(self.mm, offset)
+        start = offset + _FRAME.size
+        if size == 0 or start + size > self.capacity:
+            return False
+        with memoryview(self.mm) as view:  # checked in place, the frame may be large
+            return zlib.crc32(view[start:start + size]) == crc
+
+    def fits(self, frame_size):
+        return self.end + frame_size <= self.capacity
+
+    def write(self, records):
+        """
+        Appends records that fit in one write, and their index entries
+        """
+        frames = []
+        entries = []
+        offset = self.end
+        for pos, record in enumerate(records, self.count):
+            if pos % INDEX_INTERVAL == 0:
+                entries.append(offset)
+            frames.append(_FRAME.pack(len(record), zlib.crc32(record)))
+            frames.append(record)
+            offset += _FRAME.size + len(record)
+        os.pwrite(self.fd, b"".join(frames), self.end)
+        if entries:
+            with open(self.path + _INDEX_SUFFIX, "ab") as index_file:
+                index_file.write(b"".join(_INDEX_ENTRY.pack(entry) for entry in entries))
+            self.index.extend(entries)
+        self.end = offset
+        self.count += len(records)
+        self.written_at = time.time()
+
+    def read(self, start, end):
+        """
+        Reads the records at positions start to end, inclusive, which must be in this segment;
+        only their pages are touched. Each record is copied out of the map: the decoded
+        records would otherwise hold views of it, e.g., their bytes fields, which would keep
+        it from being closed when the segment expires, and break if it were.
+        """
+        k = (start - self.first) // INDEX_INTERVAL
+        offset = self.index[k]
+        mm = self.mm
+        records = []
+        for pos in range(self.first + k * INDEX_INTERVAL, end + 1):
+            size, _ = _FRAME.unpack_from(mm, offset)
+            offset += _FRAME.size
+            if pos >= start:
+                records.append(mm[offset:offset + size])
+            offset += size
+        return records
+
+    def add_time(self, second, position):
+        with open(self.path + _TIME_SUFFIX, "ab") as time_file:
+            time_file.write(_TIME_ENTRY.pack(second, position))
+
+    def read_times(self):
+        try:
+            with open(self.path + _TIME_SUFFIX, "rb") as time_file:
+                raw = time_file.read()
+        except FileNotFoundError:
+            return []
+        return list(_TIME_ENTRY.iter_unpack(raw[:len(raw) - len(raw) % _TIME_ENTRY.size]))
+
+    def seal(self):
+        """
+        Stops writing: the map stays readable
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def delete(self):
+        self.seal()
+        self.mm.close()
+        for suffix in (_LOG_SUFFIX, _INDEX_SUFFIX, _TIME_SUFFIX):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+class SegmentBackend(StorageBackend):
+    """
+    Keeps the records of each data source on disk, in a log of segment files of segment_bytes
+    bytes under a directory of its own, and blobs as files, so retention is bounded by the
+    disk rather than memory. Reads map the segments, so old records are read from the page
+    cache, only their pages, and a restart finds the records where it left them.
+    Segments are deleted, oldest first, once the last write to them is older than max_age
+    seconds, or while all the segments take more than max_bytes bytes, if that is set.
+    For a single probe process, like MemoryBackend.
+    """
+    wakes_readers = True
+
+    def __init__(self, directory, segment_bytes, max_age, max_bytes):
+        self._directory = directory
+        self._segment_bytes = segment_bytes
+        self._max_age = max_age
+        self._max_bytes = max_bytes
+        self._logs = {}  # stream key -> list of _Segment, oldest first
+        self._times = {}  # stream key -> TimeIndex
+        self._flags = set()
+        self._cond = Condition(Lock())
+        os.makedirs(os.path.join(directory, _BLOB_DIR), exist_ok=True)
+        for name in os.listdir(directory):
+            if name != _BLOB_DIR and os.path.isdir(os.path.join(directory, name)):
+                self._logs[name] = self._load_log(name)
+                self._times[name] = times = TimeIndex()
+                for second, position in sorted(entry for segment in self._logs[name] for entry in segment.read_times()):
+                    times.add(second, position)
+        self._expired_at = 0
+        self._expire(time.time())
+
+    def _load_log(self, key):
+        directory = os.path.join(self._directory, key)
+        firsts = sorted(int(name[:-len(_LOG_SUFFIX)]) for name in os.listdir(directory)
+                        if name.endswith(_LOG_SUFFIX) and os.path.getsize(os.path.join(directory, name)) > 0)
+        log = [_Segment.load(self._segment_path(key, first), first) for first in firsts]
+        for segment in log[:-1]:
+            segment.seal()
+        _logger.info("SegmentBackend: loaded %s segments of %s", len(log), key)
+        return log
+
+    def _segment_path(self, key, first):
+        return os.path.join(self._directory, key, "{0:020d}".format(first))
+
+    def _blob_path(self, digest):
+        return os.path.join(self._directory, _BLOB_DIR, digest)
+
+    @staticmethod
+    def _stream_key(model_id, message_name):
+        return hashlib.sha224("{0}{1}".format(model_id, message_name).encode('utf-8')).hexdigest()
+
+    def _log(self, model_id, message_name):
+        return self._logs.get(self._stream_key(model_id, message_name), [])
+
+    @staticmethod
+    def _total(log):
+        return log[-1].first + log[-1].count if log else 0
+
+    def _start_segment(self, key, log, frame_size):
+        if log and log[-1].count == 0:
+            log.pop().delete()  # too small for the record
+        if log:
+            log[-1].seal()
+        else:
+            os.makedirs(os.path.join(self._directory, key), exist_ok=True)
+        first = self._total(log)
+        log.append(_Segment(self._segment_path(key, first), first, max(self._segment_bytes, frame_size)))
+
+    def _store_blobs(self, blobs):
+        """
+        Writes the blobs that are not on disk yet, and touches the others so they expire with the records
+        """
+        for digest, blob in blobs.items():
+            path = self._blob_path(digest)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                with open(path + ".tmp", "wb") as blob_file:
+                    blob_file.write(blob)
+                os.replace(path + ".tmp", path)  # readers never see part of it
+
+    def append(self, model_id, message_name, records, blobs):
+        if blobs:
+            self._store_blobs(blobs)
+        key = self._stream_key(model_id, message_name)
+        with self._cond:
+            log = self._logs.setdefault(key, [])
+            first = self._total(log)
+            rolled = False
+            batch = []
+            batch_size = 0
+            for record in records:
+                frame_size = _FRAME.size + len(record)
+                if not log or not log[-1].fits(batch_size + frame_size):
+                    if batch:
+                        log[-1].write(batch)
+                        batch, batch_size = [], 0
+                    if not log or not log[-1].fits(frame_size):
+                        self._start_segment(key, log, frame_size)
+                        rolled = True
+                batch.append(record)
+                batch_size += frame_size
+            log[-1].write(batch)
+            now = time.time()
+            # kept with the last segment, which is deleted last
+            if self._times.setdefault(key, TimeIndex()).add(int(now), first):
+                log[-1].add_time(int(now), first)
+            if rolled or now - self._expired_at > _EXPIRE_INTERVAL:
+                self._expire(now)
+            self._cond.notify_all()
+        return first
+
+    def _expire(self, now):
+        """
+        Deletes the segments past max_age, then the oldest ones while there are more than max_bytes.
+        The last segment of a log past max_age is replaced by an empty one, so the positions go on.
+        """
+        self._expired_at = now
+        for key, log in self._logs.items():
+            while log and now - log[0].written_at > self._max_age:
+                segment = log.pop(0)
+                segment.delete()
+                if not log:
+                    first = segment.first + segment.count
+                    log.append(_Segment(self._segment_path(key, first), first, self._segment_bytes))
+                    break
+        if self._max_bytes:
+            used = sum(segment.end for log in self._logs.values() for segment in log)
+            while used > self._max_bytes:
+                sealed = [log for log in self._logs.values() if len(log) > 1]
+                if not sealed:
+                    break
+                log = min(sealed, key=lambda log: log[0].written_at)
+                used -= log[0].end
+                log.pop(0).delete()
+        for key, log in self._logs.items():
+            if log and key in self._times:
+                self._times[key].trim(log[0].first)
+        blob_dir = os.path.join(self._directory, _BLOB_DIR)
+        for name in os.listdir(blob_dir):
+            path = os.path.join(blob_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self._max_age + 60 * 60 * 24:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def count(self, model_id, message_name):
+        with self._cond:
+            return self._total(self._log(model_id, message_name))
+
+    def read(self, model_id, message_name, index_start, index_end):
+        with self._cond:
+            log = self._log(model_id, message_name)
+            total = self._total(log)
+            if not log:
+                return [], []
+            start = max(total + index_start if index_start < 0 else index_start, log[0].first)
+            end = total + index_end if index_end < 0 else min(index_end, total - 1)
+            if start > end:
+                return range(0), []
+            records = []
+            firsts = [segment.first for segment in log]
+            for segment in log[bisect_right(firsts, start) - 1:bisect_right(firsts, end)]:
+                if segment.count:
+                    last = segment.first + segment.count - 1
+                    records.extend(segment.read(max(start, segment.first), min(end, last)))
+            return range(start, end + 1), records
+
+    def locate(self, model_id, message_name, time_start, time_end):
+        key = self._stream_key(model_id, message_name)
+        with self._cond:
+            if key not in self._times:
+                return 0, self._total(self._logs.get(key, [])) - 1
+            return self._times[key].locate(time_start, time_end, self._total(self._logs[key]))
+
+    def wait(self, model_id, message_name, index_start, timeout_ms):
+        key = self._stream_key(model_id, message_name)
+        with self._cond:
+            return self._cond.wait_for(lambda: self._total(self._logs.get(key, [])) > index_start, timeout_ms / 1000.0)
+
+    def get_blob(self, digest):
+        try:
+            with open(self._blob_path(digest), "rb") as blob_file:
+                return blob_file.read()
+        except FileNotFoundError:
+            return None
+
+    def get_flag(self, name):
+        with self._cond:
+            return name in self._flags
+
+    def set_flag(self, name):
+        with self._cond:
+            if name in self._flags:
+                return False
+            self._flags.add(name)
+            return True
+
+    def delete_flag(self, name):
+        with self._cond:
+            if name not in self._flags:
+                return False
+            self._flags.remove(name)
+            return True
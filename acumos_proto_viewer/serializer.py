@@ -0,0 +1,564 @@
+# Acumos - Apache 2.0
+
+
+import base64
+from collections import namedtuple
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.json_format import MessageToDict
+import json
+import math
+import pickle
+import struct
+
+from acumos_proto_viewer import get_module_logger
+from acumos_proto_viewer.utils import APV_RECVD, APV_SEQNO
+
+_logger = get_module_logger(__name__)
+
+_INT64_CPP_TYPES = frozenset([FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64])
+_FLOAT_CPP_TYPES = frozenset([FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE])
+# struct codes of the fixed width types; the binary format packs these, little endian
+_FIXED_CODES = {FieldDescriptor.CPPTYPE_INT32: "i",
+                FieldDescriptor.CPPTYPE_UINT32: "I",
+                FieldDescriptor.CPPTYPE_INT64: "q",
+                FieldDescriptor.CPPTYPE_UINT64: "Q",
+                FieldDescriptor.CPPTYPE_DOUBLE: "d",
+                FieldDescriptor.CPPTYPE_FLOAT: "f",
+                FieldDescriptor.CPPTYPE_BOOL: "?",
+                FieldDescriptor.CPPTYPE_ENUM: "i"}
+# the elements of repeated and map fields of these types are not packed as the json mapping shows them
+_MAPPED_CPP_TYPES = _FLOAT_CPP_TYPES | frozenset([FieldDescriptor.CPPTYPE_ENUM])
+_U64 = struct.Struct("<Q")
+_INT_CPP_TYPES = frozenset([FieldDescriptor.CPPTYPE_INT32, FieldDescriptor.CPPTYPE_UINT32, FieldDescriptor.CPPTYPE_ENUM])
+# repeated 32-bit ints are packed at the narrowest of these widths that fits all of them
+_INT_WIDTHS = [("b", -2 ** 7, 2 ** 7), ("B", 0, 2 ** 8), ("h", -2 ** 15, 2 ** 15), ("H", 0, 2 ** 16),
+               ("i", -2 ** 31, 2 ** 31), ("I", 0, 2 ** 32)]
+
+# the first byte of a serialized record tells its format, so lists may mix formats while
+# the writers are upgraded; pickles always start with the PROTO opcode
+_BINARY_MARKER = b"S"
+_JSON_MARKER = b"J"
+_PICKLE_MARKER = b"\x80"
+
+# kinds of the variable length fields of a message; the fixed width ones have none
+_STRING, _BYTES, _MESSAGE, _REPEATED, _MAP = range(5)
+
+
+class BlobRef(object):
+    """
+    Stands in a record for a bytes field stored out of band, see data.get_blob
+    """
+    __slots__ = ("digest", "size")
+
+    def __init__(self, digest, size):
+        self.digest = digest
+        self.size = size
+
+    def __eq__(self, other):
+        return isinstance(other, BlobRef) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return "BlobRef({0!r}, {1})".format(self.digest, self.size)
+
+
+def is_map_field(field):
+    """
+    Answers whether a field descriptor is a protobuf map<,> field
+    """
+    return field.type == FieldDescriptor.TYPE_MESSAGE and field.message_type.has_options and field.message_type.GetOptions().map_entry
+
+
+def json_value(field, value):
+    """
+    Converts one element of a repeated or map field the way MessageToJson does:
+    64-bit ints become strings, bytes become base64, enums become names.
+    """
+    cpp_type = field.cpp_type
+    if cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        return MessageToDict(value, preserving_proto_field_name=True)
+    if cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        enum_value = field.enum_type.values_by_number.get(value, None)
+        return enum_value.name if enum_value is not None else value
+    if cpp_type == FieldDescriptor.CPPTYPE_STRING:
+        return base64.b64encode(value).decode('utf-8') if field.type == FieldDescriptor.TYPE_BYTES else value
+    if cpp_type in _INT64_CPP_TYPES:
+        return str(value)
+    if cpp_type in _FLOAT_CPP_TYPES:
+        if math.isinf(value):
+            return "Infinity" if value > 0 else "-Infinity"
+        if math.isnan(value):
+            return "NaN"
+    return value
+
+
+def _native_values(field, values):
+    """
+    Reverses json_value on the float and enum elements of a repeated field
+    """
+    if field.cpp_type in _FLOAT_CPP_TYPES:
+        return list(map(float, values))  # also parses "Infinity", "-Infinity" and "NaN"
+    by_name = field.enum_type.values_by_name
+    return [by_name[v].number if isinstance(v, str) else v for v in values]
+
+
+def _json_values(field, values):
+    """
+    Applies json_value to the float and enum elements of a repeated field
+    """
+    if field.cpp_type in _FLOAT_CPP_TYPES:
+        # the sum is finite only if every element is, a cheap check for the common case
+        if math.isfinite(sum(values)):
+            return list(values)
+    return [json_value(field, v) for v in values]
+
+
+def _set_sequence_number(record, sequence_no):
+    """
+    Sets the sequence number of a record read back from redis, and of its nested
+    messages (the dicts that carry a receive time).
+    """
+    record[APV_SEQNO] = sequence_no
+    for v in record.values():
+        if isinstance(v, dict) and APV_RECVD in v:
+            _set_sequence_number(v, sequence_no)
+
+
+def _put_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(buf, pos):
+    result = buf[pos]
+    if result < 0x80:
+        return result, pos + 1  # most are one byte
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _put_bytes(out, value):
+    _put_varint(out, len(value))
+    out += value
+
+
+def _get_bytes(buf, pos):
+    size, pos = _get_varint(buf, pos)
+    return buf[pos:pos + size], pos + size
+
+
+def _encode_elements(field, values, out):
+    """
+    Appends the elements of a repeated or map field; fixed width ones are packed in one go,
+    32-bit ints preceded by the struct code of their width, strings by how they are joined
+    """
+    if not values:
+        return
+    cpp_type = field.cpp_type
+    if cpp_type in _INT64_CPP_TYPES:
+        # the json mapping makes these strings, which are kept as text so reads need not format them
+        _put_bytes(out, "\x00".join(values).encode('utf-8'))
+    elif cpp_type in _FIXED_CODES:
+        code = _FIXED_CODES[cpp_type]
+        if cpp_type in _FLOAT_CPP_TYPES:
+            try:
+                out += struct.pack("<{0}{1}".format(len(values), code), *values)
+                return
+            except struct.error:
+                pass  # some are "Infinity", "-Infinity" or "NaN", as the json mapping writes them
+        if cpp_type in _MAPPED_CPP_TYPES:
+            values = _native_values(field, values)
+        if cpp_type in _INT_CPP_TYPES:
+            lo, hi = min(values), max(values)
+            code = next(c for c, cmin, cmax in _INT_WIDTHS if cmin <= lo and hi < cmax)
+            out.append(ord(code))
+        out += struct.pack("<{0}{1}".format(len(values), code), *values)
+    elif cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        # already in the json mapping, which has no fixed schema
+        for v in values:
+            _put_bytes(out, json.dumps(v).encode('utf-8'))
+    elif field.type == FieldDescriptor.TYPE_BYTES:
+        for v in values:
+            _put_bytes(out, base64.b64decode(v))
+    else:
+        joined = "\x00".join(values)
+        if joined.count("\x00") == len(values) - 1:
+            # split in one go when read
+            out.append(0)
+            _put_bytes(out, joined.encode('utf-8'))
+        else:
+            out.append(1)
+            for v in values:
+                _put_bytes(out, v.encode('utf-8'))
+
+
+def _decode_elements(field, count, buf, pos):
+    """
+    Reverses _encode_elements, answering the values as the json mapping shows them and the new position
+    """
+    if count == 0:
+        return [], pos
+    cpp_type = field.cpp_type
+    if cpp_type in _INT64_CPP_TYPES:
+        chunk, pos = _get_bytes(buf, pos)
+        return chunk.decode('utf-8').split("\x00"), pos
+    if cpp_type in _FIXED_CODES:
+        code = _FIXED_CODES[cpp_type]
+        if cpp_type in _INT_CPP_TYPES:
+            code = chr(buf[pos])
+            pos += 1
+        fmt = "<{0}{1}".format(count, code)
+        values = struct.unpack_from(fmt, buf, pos)
+        pos += struct.calcsize(fmt)
+        if cpp_type in _MAPPED_CPP_TYPES:
+            return _json_values(field, values), pos
+        return list(values), pos
+    if cpp_type == FieldDescriptor.CPPTYPE_STRING and field.type != FieldDescriptor.TYPE_BYTES:
+        pos += 1
+        if buf[pos - 1] == 0:
+            chunk, pos = _get_bytes(buf, pos)
+            return chunk.decode('utf-8').split("\x00"), pos
+    chunks = []
+    for _ in range(count):
+        chunk, pos = _get_bytes(buf, pos)
+        chunks.append(chunk)
+    if cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        return [json.loads(c.decode('utf-8')) for c in chunks], pos
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return [base64.b64encode(c).decode('utf-8') for c in chunks], pos
+    return [c.decode('utf-8') for c in chunks], pos
+
+
+def _encode_map(field, value):
+    """
+    Encodes a map field, already in the json mapping: its size, its keys, then its values
+    """
+    out = bytearray()
+    _put_varint(out, len(value))
+    for k in value:
+        _put_bytes(out, k.encode('utf-8'))
+    _encode_elements(field, list(value.values()), out)
+    return out
+
+
+def _decode_map(field, buf, pos):
+    count, pos = _get_varint(buf, pos)
+    keys = []
+    for _ in range(count):
+        chunk, pos = _get_bytes(buf, pos)
+        keys.append(chunk.decode('utf-8'))
+    values, pos = _decode_elements(field, count, buf, pos)
+    return dict(zip(keys, values)), pos
+
+
+def _encode_repeated(field, values):
+    out = bytearray()
+    _put_varint(out, len(values))
+    _encode_elements(field, values, out)
+    return out
+
+
+def _decode_repeated(field, buf, pos):
+    count, pos = _get_varint(buf, pos)
+    return _decode_elements(field, count, buf, pos)
+
+
+# the one byte encodings of the lengths under 128, which most strings have
+_SMALL_SIZES = [bytes([n]) for n in range(128)]
+
+
+def _size_prefix(size):
+    """
+    Encodes a length of at least 128 as a varint, like _put_varint
+    """
+    if size < 0x4000:
+        return bytes((size & 0x7f | 0x80, size >> 7))
+    if size < 0x200000:
+        return bytes((size & 0x7f | 0x80, size >> 7 & 0x7f | 0x80, size >> 14))
+    out = bytearray()
+    _put_varint(out, size)
+    return bytes(out)
+
+
+class _MessageCodec(object):
+    """
+    Encodes the records of one message type, as converted by data._msg_to_dict,
+    without their keys: the singular fixed width fields are packed into one struct,
+    followed by the other fields in descriptor order. Nested messages are inlined;
+    their receive time and sequence number are those of the top level record.
+    The fields are walked once, when the codec is compiled, into the source of a
+    dumps and a loads function, in which the fixed width fields of consecutive messages,
+    and the receive time, are packed by a single struct and the records are dict literals.
+    """
+    def __init__(self, descriptor, codecs):
+        codecs[descriptor] = self  # before the fields, for recursive messages
+        self._names = {"BlobRef": BlobRef, "Struct": struct.Struct, "_U64": _U64, "_SMALL_SIZES": _SMALL_SIZES,
+                       "_size_prefix": _size_prefix, "_get_varint": _get_varint,
+                       "_encode_map": _encode_map, "_decode_map": _decode_map,
+                       "_encode_repeated": _encode_repeated, "_decode_repeated": _decode_repeated}
+        self._ops = []
+        self._locals = 0
+        node = self._plan(descriptor, "r", [descriptor], codecs)
+        source = self._encoder("dumps", True) + self._encoder("dumps_body", False)
+        source += self._decoder("loads", True, node) + self._decoder("loads_body", False, node)
+        exec(compile(source, "<codec {0}>".format(descriptor.full_name), "exec"), self._names)
+        # dumps(record) and loads(raw, sequence_no) are whole records, the bodies are inlined in others
+        self.dumps = self._names["dumps"]
+        self.loads = self._names["loads"]
+        self.dumps_body = self._names["dumps_body"]
+        self.loads_body = self._names["loads_body"]
+
+    def _name(self, value):
+        """
+        Binds a value the generated code refers to, answering its name
+        """
+        self._locals += 1
+        name = "_k{0}".format(self._locals)
+        self._names[name] = value
+        return name
+
+    def _local(self):
+        self._locals += 1
+        return "v{0}".format(self._locals)
+
+    def _plan(self, descriptor, record, stack, codecs):
+        """
+        Appends the operations (kind, field or struct code, record expression, local) that encode
+        the message record evaluates to, answering the node [(key, local or node)] that decodes it
+        """
+        node = []
+        variable = []
+        for field in descriptor.fields:
+            value = "{0}[{1!r}]".format(record, field.name)
+            if field.label != FieldDescriptor.LABEL_REPEATED and field.cpp_type in _FIXED_CODES:
+                local = self._local()
+                self._ops.append((None, _FIXED_CODES[field.cpp_type], value, local))
+                node.append((field.name, local))
+            else:
+                variable.append((field, value))
+        for field, value in variable:
+            local = self._local()
+            if is_map_field(field):
+                self._ops.append((_MAP, self._name(field.message_type.fields_by_name["value"]), value, local))
+            elif field.label == FieldDescriptor.LABEL_REPEATED:
+                self._ops.append((_REPEATED, self._name(field), value, local))
+            elif field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+                if field.message_type in stack:
+                    # recursive, so encoded by the codec of the message rather than inlined
+                    sub = codecs.get(field.message_type) or _MessageCodec(field.message_type, codecs)
+                    self._ops.append((_MESSAGE, self._name(sub), value, local))
+                else:
+                    node.append((field.name, self._plan(field.message_type, value, stack + [field.message_type], codecs)))
+                    continue
+            elif field.type == FieldDescriptor.TYPE_BYTES:
+                self._ops.append((_BYTES, None, value, local))
+            elif field.cpp_type == FieldDescriptor.CPPTYPE_STRING:
+                self._ops.append((_STRING, None, value, local))
+            else:
+                continue
+            node.append((field.name, local))
+        node.append((APV_RECVD, "recvd"))
+        node.append((APV_SEQNO, "seqno"))
+        return node
+
+    def _encoder(self, name, header):
+        """
+        Generates the function that encodes a record, after the marker and receive time if header
+        """
+        lines = ["def {0}(r):".format(name)]
+        parts = []
+        codes, values = ("<cQ", [self._name(_BINARY_MARKER), "r[{0!r}]".format(APV_RECVD)]) if header else ("<", [])
+        for kind, arg, value, local in self._ops + [(_STRING, None, None, None)]:
+            if kind is None:
+                codes += arg
+                values.append(value)
+                continue
+            if values:
+                parts.append("{0}.pack({1})".format(self._name(struct.Struct(codes)), ", ".join(values)))
+                codes, values = "<", []
+            if value is None:
+                break
+            if kind == _STRING:
+                lines.append("    {0} = {1}.encode('utf-8')".format(local, value))
+                parts.append("_SMALL_SIZES[len({0})] if len({0}) < 128 else _size_prefix(len({0}))".format(local))
+            elif kind == _BYTES:
+                lines.append("    {0} = {1}".format(local, value))
+                lines.append("    if {0}.__class__ is BlobRef:".format(local))
+                lines.append("        {0}h = b'\\x01' + bytes.fromhex({0}.digest) + _U64.pack({0}.size)".format(local))
+                lines.append("        {0} = b''".format(local))
+                lines.append("    else:")
+                lines.append("        {0}h = b'\\x00' + (_SMALL_SIZES[len({0})] if len({0}) < 128 else _size_prefix(len({0})))".format(local))
+                parts.append(local + "h")
+            elif kind == _MESSAGE:
+                lines.append("    {0} = {1}.dumps_body({2})".format(local, arg, value))
+            elif kind == _REPEATED:
+                lines.append("    {0} = _encode_repeated({1}, {2})".format(local, arg, value))
+            else:
+                lines.append("    {0} = _encode_map({1}, {2})".format(local, arg, value))
+            parts.append(local)
+        lines.append("    return b''.join(({0},))".format(", ".join(parts)) if parts else "    return b''")
+        return "\n".join(lines) + "\n"
+
+    def _decoder(self, name, header, node):
+        """
+        Generates the function that decodes a record, from after the marker if header, else from pos
+        """
+        lines = ["def {0}(buf, seqno):".format(name) if header else "def {0}(buf, pos, recvd, seqno):".format(name)]
+        codes, locals_ = ("<Q", ["recvd"]) if header else ("<", [])
+        if header:
+            lines.append("    pos = 1")
+        for kind, arg, _, local in self._ops + [(_STRING, None, None, None)]:
+            if kind is None:
+                codes += arg
+                locals_.append(local)
+                continue
+            if locals_:
+                layout = struct.Struct(codes)
+                lines.append("    {0}, = {1}.unpack_from(buf, pos)".format(", ".join(locals_), self._name(layout)))
+                lines.append("    pos += {0}".format(layout.size))
+                codes, locals_ = "<", []
+            if local is None:
+                break
+            if kind in (_STRING, _BYTES):
+                if kind == _BYTES:
+                    lines.append("    if buf[pos]:")
+                    lines.append("        {0} = BlobRef(buf[pos + 1:pos + 33].hex(), _U64.unpack_from(buf, pos + 33)[0])".format(local))
+                    lines.append("        pos += 41")
+                    lines.append("    else:")
+                    lines.append("        pos += 1")
+                indent = "        " if kind == _BYTES else "    "
+                lines.append(indent + "n = buf[pos]")
+                lines.append(indent + "if n < 128:")
+                lines.append(indent + "    pos += 1")
+                lines.append(indent + "else:")
+                lines.append(indent + "    n, pos = _get_varint(buf, pos)")
+                lines.append(indent + "{0} = buf[pos:pos + n]{1}".format(local, ".decode('utf-8')" if kind == _STRING else ""))
+                lines.append(indent + "pos += n")
+            elif kind == _MESSAGE:
+                lines.append("    {0}, pos = {1}.loads_body(buf, pos, recvd, seqno)".format(local, arg))
+            elif kind == _REPEATED:
+                lines.append("    {0}, pos = _decode_repeated({1}, buf, pos)".format(local, arg))
+            else:
+                lines.append("    {0}, pos = _decode_map({1}, buf, pos)".format(local, arg))
+        literal = self._literal(node)
+        lines.append("    return " + literal if header else "    return {0}, pos".format(literal))
+        return "\n".join(lines) + "\n"
+
+    def _literal(self, node):
+        return "{" + ", ".join("{0!r}: {1}".format(k, v if isinstance(v, str) else self._literal(v)) for k, v in node) + "}"
+
+
+_codecs = {}
+
+
+def compile_codec(descriptor):
+    """
+    Gets the codec of a message descriptor, compiling it on first use; the models
+    compile theirs when registered, see utils.register_proto_from_url.
+    Codecs are published only once complete, so concurrent callers at worst compile twice.
+    """
+    codec = _codecs.get(descriptor)
+    if codec is None:
+        compiled = {}
+        codec = _MessageCodec(descriptor, compiled)
+        _codecs.update(compiled)
+    return codec
+
+
+def _binary_dumps(record, descriptor):
+    return compile_codec(descriptor).dumps(record)
+
+
+def _binary_loads(raw, descriptor, sequence_no):
+    return compile_codec(descriptor).loads(raw, sequence_no)
+
+
+def _json_dumps(record, descriptor):
+    return _JSON_MARKER + json.dumps(record).encode('utf-8')
+
+
+def _json_loads(raw, descriptor, sequence_no):
+    record = json.loads(raw[1:].decode('utf-8'))
+    _set_sequence_number(record, sequence_no)
+    return record
+
+
+def _pickle_dumps(record, descriptor):
+    return pickle.dumps(record)
+
+
+def _pickle_loads(raw, descriptor, sequence_no):
+    # you cannot have lists of dicts in myredis, the solution is to serialize them,
+    # see https://stackoverflow.com/questions/8664664/list-of-dicts-in-myredis
+    record = pickle.loads(raw)
+    _set_sequence_number(record, sequence_no)
+    return record
+
+
+RecordFormat = namedtuple("RecordFormat", ["marker", "dumps", "loads", "needs_schema"])
+_formats = {}
+_formats_by_marker = {}
+
+
+def register_format(name, record_format):
+    """
+    Registers a RecordFormat under a name. dumps(record, descriptor) answers bytes
+    starting with the one byte marker, and loads(raw, descriptor, sequence_no) the
+    record; descriptor is the message descriptor if needs_schema is set, else None.
+    """
+    _formats[name] = record_format
+    _formats_by_marker[record_format.marker] = record_format
+
+
+register_format("binary", RecordFormat(_BINARY_MARKER, _binary_dumps, _binary_loads, True))
+register_format("json", RecordFormat(_JSON_MARKER, _json_dumps, _json_loads, False))
+register_format("pickle", RecordFormat(_PICKLE_MARKER, _pickle_dumps, _pickle_loads, False))
+
+
+def dumps(name, record, descriptor=None):
+    """
+    Serializes a record in the named format. Formats that need the message
+    descriptor fall back to json without one, e.g., for message router topics.
+    Raises ValueError if the format is unknown.
+    """
+    if name not in _formats:
+        raise ValueError("unknown record format {0}, known: {1}".format(name, sorted(_formats)))
+    record_format = _formats[name]
+    if record_format.needs_schema and descriptor is None:
+        record_format = _formats["json"]
+    return record_format.dumps(record, descriptor)
+
+
+def needs_schema(raw):
+    """
+    Answers whether loads needs the message descriptor for this serialized record
+    """
+    record_format = _formats_by_marker.get(raw[:1])
+    return record_format is not None and record_format.needs_schema
+
+
+def loads(raw, sequence_no, descriptor=None, trusted=False):
+    """
+    Deserializes a record in any registered format and sets its sequence number.
+    Loading a pickle runs whatever code its writer put in it, so pickles are only
+    loaded if the writers are trusted, see data.ALLOW_PICKLE_RECORDS.
+    Raises ValueError if the format is unknown, or a pickle is not trusted.
+    """
+    marker = raw[:1]
+    record_format = _formats_by_marker.get(marker)
+    if record_format is None:
+        raise ValueError("unknown record format marker {0!r}".format(marker))
+    if marker == _PICKLE_MARKER and not trusted:
+        raise ValueError("refusing to load a pickled record from an untrusted writer")
+    return record_format.loads(raw, descriptor, sequence_no)
@@ -0,0 +1,243 @@
+# Acumos - Apache 2.0
+
+
+import abc
+from bisect import bisect_left, bisect_right
+from threading import Condition, Lock
+import time
+
+from acumos_proto_viewer import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+
+class StorageBackend(object, metaclass=abc.ABCMeta):
+    """
+    Where the records of each (model_id, message_name) data source live, and the flags
+    of the message-router subscriptions. Records get consecutive positions from zero,
+    in the order appended; a backend may drop the oldest ones.
+    data.RedisBackend is the default; see data.STORAGE_BACKEND.
+    A backend that lacks any of the abstract methods cannot be instantiated.
+    """
+    # whether records are stored as the bytes of data.encode_data, or else as the converted dicts
+    serializes = True
+    # whether wait answers as soon as records arrive, so readers need not poll
+    wakes_readers = False
+
+    @abc.abstractmethod
+    def append(self, model_id, message_name, records, blobs):
+        """
+        Appends records, after the blobs {digest: bytes} they refer to.
+        Returns the position of the first record, or None if it is not known yet.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Blocks until every record appended so far can be read
+        """
+
+    @abc.abstractmethod
+    def count(self, model_id, message_name):
+        """
+        Answers the number of records ever appended, which is also the position after the last one
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, model_id, message_name, index_start, index_end):
+        """
+        Reads the records at positions index_start to index_end, inclusive; negative
+        positions count from the end like LRANGE. Positions dropped are skipped.
+        Returns the tuple (list of positions, list of records).
+        """
+        raise NotImplementedError
+
+    def read_columns(self, model_id, message_name, field_names, index_start, index_end):
+        """
+        Reads some fields of the records at positions index_start to index_end without
+        reading the records, see data.get_raw_columns, or answers None if it cannot.
+        """
+        return None
+
+    def locate(self, model_id, message_name, time_start, time_end):
+        """
+        Answers the positions (start, end) that hold, at least, the records appended from time_start
+        to time_end, in epoch seconds, inclusive; start > end if there are none. Backends
+        without a time index answer every position.
+        """
+        return 0, self.count(model_id, message_name) - 1
+
+    def wait(self, model_id, message_name, index_start, timeout_ms):
+        """
+        Waits until there is a record at position index_start or later, for at most
+        timeout_ms if wakes_readers, and answers whether there is
+        """
+        return self.count(model_id, message_name) > index_start
+
+    def get_blob(self, digest):
+        """
+        Gets the bytes of a blob, None if they are gone
+        """
+        return None
+
+    @abc.abstractmethod
+    def get_flag(self, name):
+        """
+        Answers whether a flag is set
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_flag(self, name):
+        """
+        Sets a flag. Answers false if it was set already.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_flag(self, name):
+        """
+        Clears a flag. Answers false if it was not set.
+        """
+        raise NotImplementedError
+
+
+class TimeIndex(object):
+    """
+    A sparse index from time to position: the first position appended in each second, so
+    a time range is located with two binary searches
+    """
+    __slots__ = ("seconds", "positions")
+
+    def __init__(self):
+        self.seconds = []
+        self.positions = []
+
+    def add(self, second, position):
+        """
+        Indexes the position of a record appended in a second, if it is the first of that second.
+        Answers whether it was.
+        """
+        if self.seconds and second <= self.seconds[-1]:
+            return False
+        self.seconds.append(second)
+        self.positions.append(position)
+        return True
+
+    def locate(self, time_start, time_end, total):
+        """
+        Answers the positions (start, end) of the records appended from time_start to time_end,
+        see StorageBackend.locate, given the position after the last record
+        """
+        i = bisect_left(self.seconds, time_start)
+        j = bisect_right(self.seconds, time_end)
+        start = self.positions[i] if i < len(self.seconds) else total
+        end = self.positions[j] - 1 if j < len(self.seconds) else total - 1
+        return start, end
+
+    def trim(self, position):
+        """
+        Drops the entries of the seconds before that of a position, when the records before it are gone
+        """
+        i = bisect_right(self.positions, position) - 1
+        if i > 0:
+            del self.seconds[:i]
+            del self.positions[:i]
+
+
+class _Ring(object):
+    """
+    The records of one data source: a preallocated list used as a circular buffer, and their time index
+    """
+    __slots__ = ("slots", "total", "times")
+
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.total = 0
+        self.times = TimeIndex()
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps the latest capacity records of each data source in a ring buffer in this process,
+    as the converted dicts, so there is neither a network hop nor serialization. For a
+    single process probe: the records are lost on restart and not shared between processes.
+    Readers get the stored dicts, so they must not modify them.
+    """
+    serializes = False
+    wakes_readers = True
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._rings = {}
+        self._flags = set()
+        self._cond = Condition(Lock())
+
+    def _total(self, key):
+        ring = self._rings.get(key)
+        return ring.total if ring is not None else 0
+
+    def append(self, model_id, message_name, records, blobs):
+        with self._cond:
+            key = (model_id, message_name)
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = _Ring(self._capacity)
+            first = ring.total
+            # of a batch larger than the ring, only the last records are kept
+            skipped = max(len(records) - self._capacity, 0)
+            slots = ring.slots
+            for pos, record in enumerate(records[skipped:], first + skipped):
+                slots[pos % self._capacity] = record
+            ring.total = first + len(records)
+            if ring.times.add(int(time.time()), first):
+                ring.times.trim(ring.total - self._capacity)
+            self._cond.notify_all()
+        return first
+
+    def count(self, model_id, message_name):
+        with self._cond:
+            return self._total((model_id, message_name))
+
+    def read(self, model_id, message_name, index_start, index_end):
+        with self._cond:
+            ring = self._rings.get((model_id, message_name))
+            if ring is None:
+                return [], []
+            total = ring.total
+            start = max(total + index_start if index_start < 0 else index_start, total - self._capacity, 0)
+            end = total + index_end if index_end < 0 else min(index_end, total - 1)
+            positions = range(start, end + 1) if start <= end else range(0)
+            slots = ring.slots
+            return positions, [slots[pos % self._capacity] for pos in positions]
+
+    def locate(self, model_id, message_name, time_start, time_end):
+        with self._cond:
+            ring = self._rings.get((model_id, message_name))
+            if ring is None:
+                return 0, -1
+            return ring.times.locate(time_start, time_end, ring.total)
+
+    def wait(self, model_id, message_name, index_start, timeout_ms):
+        key = (model_id, message_name)
+        with self._cond:
+            return self._cond.wait_for(lambda: self._total(key) > index_start, timeout_ms / 1000.0)
+
+    def get_flag(self, name):
+        with self._cond:
+            return name in self._flags
+
+    def set_flag(self, name):
+        with self._cond:
+            if name in self._flags:
+                return False
+            self._flags.add(name)
+            return True
+
+    def delete_flag(self, name):
+        with self._cond:
+            if name not in self._flags:
+                return False
+            self._flags.remove(name)
+            return True
@@ -6,6 +6,7 @@ from os import makedirs, listdir, environ
 from subprocess import PIPE, Popen
 import importlib.util
 import json
+from operator import itemgetter
 import requests
 from acumos_proto_viewer import get_module_logger
 from acumos_proto_viewer.exceptions import SchemaNotReachable
@@ -106,6 +107,7 @@ def _register_jsonschema(js_schema, model_id):
     data.jsonschema_data_structure[model_id] = {}
     _inject_apv_keys_into_schema(js_schema["properties"])
     data.jsonschema_data_structure[model_id]["json_schema"] = js_schema
+    data.jsonschema_data_structure[model_id]["accessors"] = compile_field_accessors(js_schema["properties"])
 
 
 def _flatten_message_fields(json_schema, msg_name, prefix=None):
@@ -138,7 +140,7 @@ def _register_proto(proto_name, model_id):
     arrives by querying the catalog with the model_id.
     """
     # import here to avoid circular dependency
-    from acumos_proto_viewer import data
+    from acumos_proto_viewer import data, serializer
 
     _logger.info("_register_proto: registering for model_id {0}".format(model_id))
     _compile_proto(model_id)
@@ -159,8 +161,10 @@ def _register_proto(proto_name, model_id):
         flat_json_props = _flatten_message_fields(j_schema, msg_name)
         data.proto_data_structure[model_id]["messages"][msg_name_no_pkg] = {
             "properties": json_props,
-            "properties_flat": flat_json_props
+            "properties_flat": flat_json_props,
+            "accessors": compile_field_accessors(flat_json_props)
         }
+        serializer.compile_codec(getattr(load_proto(model_id), msg_name_no_pkg).DESCRIPTOR)
 
 
 def _proto_url_to_model_id(url):
@@ -311,3 +315,41 @@ def get_message_data(msg_dict, field_name):
             _logger.warning("get_message_data: first component not found {0}".format(prefix))
     # _logger.warning("_get_message_data: unknown field {0}".format(field_name))
     return None
+
+
+def compile_field_accessor(field_name):
+    """
+    Compiles a field name, which may refer to a field in a nested message ("i.x"), into a
+    function of a JSON dict that extracts the field like get_message_data, with the name
+    split once here instead of searched and sliced for every record.
+    """
+    path = field_name.split(".")
+    if len(path) == 1:
+        return lambda msg_dict: msg_dict.get(field_name)
+    getters = [itemgetter(name) for name in path]
+
+    def accessor(msg_dict):
+        value = msg_dict
+        try:
+            for getter in getters:
+                value = getter(value)
+            return value
+        except (KeyError, TypeError):
+            # e.g., a key with a dot in it, or a missing field
+            return get_message_data(msg_dict, field_name)
+    return accessor
+
+
+def compile_field_accessors(field_names):
+    """
+    Compiles the fields of a message, see compile_field_accessor; returns a dict of field name -> accessor
+    """
+    return {field_name: compile_field_accessor(field_name) for field_name in field_names}
+
+
+def get_messages_data(msg_dicts, field_name, accessor=None):
+    """
+    Extracts a field from each of a list of JSON dicts, like get_message_data;
+    accessor is the compiled field name, if at hand, see compile_field_accessor
+    """
+    return list(map(accessor or compile_field_accessor(field_name), msg_dicts))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Acumos - Apache 2.0
+# Compares extracting every flattened field of a batch of records, as a session update
+# does, with get_message_data against the accessors compiled at registration, using the
+# nested message in tests/fixtures.
+
+import os
+import sys
+import timeit
+# the package of the checkout this lives in, whether installed or not
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acumos_proto_viewer import data
+from acumos_proto_viewer.utils import load_module, compile_field_accessors, get_message_data, get_messages_data
+
+# determine base directory, the parent of benchmarks where this lives
+scripthome = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECORDS = 10000
+
+
+def flat_field_names(descriptor, prefix=""):
+    """
+    Lists the field names of a message like utils._flatten_message_fields, "i.x" for nested ones
+    """
+    names = []
+    for field in descriptor.fields:
+        if field.message_type is not None:
+            names.extend(flat_field_names(field.message_type, prefix + field.name + "."))
+        else:
+            names.append(prefix + field.name)
+    return names
+
+
+if __name__ == '__main__':
+    module = load_module("probe_testnested_100_proto", "{0}/tests/fixtures/probe_testnested_100_proto_pb2.py".format(scripthome))
+    records = []
+    for n in range(RECORDS):
+        msg = module.NestOuter(tag="tag {0}".format(n))
+        msg.i.x, msg.i.y, msg.i.z = n, n / 2.0, n / 3.0
+        records.append(data._msg_to_dict(msg, 0, n + 1))
+    fields = flat_field_names(module.NestOuter.DESCRIPTOR)
+    accessors = compile_field_accessors(fields)
+
+    def run_legacy():
+        return {f: [get_message_data(r, f) for r in records] for f in fields}
+
+    def run_compiled():
+        return {f: get_messages_data(records, f, accessors[f]) for f in fields}
+
+    assert run_legacy() == run_compiled()
+    legacy = min(timeit.repeat(run_legacy, number=1, repeat=5)) * 1000
+    compiled = min(timeit.repeat(run_compiled, number=1, repeat=5)) * 1000
+    print("{0} NestOuter records, fields {1}".format(RECORDS, ", ".join(fields)))
+    print("{0:<22}{1:>10}".format("extraction", "ms"))
+    print("{0:<22}{1:>10.1f}".format("get_message_data", legacy))
+    print("{0:<22}{1:>10.1f}".format("compiled accessors", compiled))
+    print("{0:<22}{1:>9.1f}x".format("speedup", legacy / compiled))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Acumos - Apache 2.0
+# Compares reading two fields of a wide message, as a line plot does, from the records
+# against reading them from their columns: the bytes fetched from redis and the time to
+# fetch and decode them. Runs against fakeredis, so the times leave out the network.
+
+import fakeredis
+import os
+import sys
+import time
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+# the package of the checkout this lives in, whether installed or not
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acumos_proto_viewer import data
+from acumos_proto_viewer.utils import get_message_data
+
+MODEL_ID = "bench_columns"
+RECORDS = 5000
+WIDTH = 60
+
+
+def wide_message_class():
+    """
+    Builds a message of WIDTH double fields, x0..., and a string field
+    """
+    file_proto = descriptor_pb2.FileDescriptorProto(name="bench_columns.proto", package="benchcolumns", syntax="proto3")
+    msg_proto = file_proto.message_type.add(name="Wide")
+    for i in range(WIDTH):
+        msg_proto.field.add(name="x{0}".format(i), number=i + 1, type=descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+                            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL)
+    msg_proto.field.add(name="tag", number=WIDTH + 1, type=descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+                        label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message_factory.MessageFactory(pool).GetPrototype(pool.FindMessageTypeByName("benchcolumns.Wide"))
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    cls = wide_message_class()
+    data.myredis = fakeredis.FakeStrictRedis()
+    data.COLUMN_STORE = True
+    data._message_class_cache[(MODEL_ID, "Wide")] = cls
+    data.proto_data_structure[MODEL_ID] = {}
+    records = []
+    for n in range(RECORDS):
+        msg = cls(tag="sample {0}".format(n), **{"x{0}".format(i): n * i / 7.0 for i in range(WIDTH)})
+        records.append(data.encode_data(msg.SerializeToString(), MODEL_ID, "Wide")[0])
+    data.store_data(MODEL_ID, "Wide", records)
+    index = data._get_raw_data_source_index(MODEL_ID, "Wide")
+    fields = ["x1", "x2"]
+
+    def from_records():
+        source = data.get_raw_data(MODEL_ID, "Wide", 0, -1)
+        return {f: [get_message_data(r, f) for r in source] for f in fields}
+
+    def from_columns():
+        return data.get_raw_columns(MODEL_ID, "Wide", fields, 0, -1)
+
+    record_bytes = sum(len(r) for r in data.myredis.lrange(index, 0, -1))
+    column_bytes = sum(data.myredis.strlen(data._get_column_key(index, f)) for f in fields)
+    record_time, expected = best_of(from_records)
+    column_time, actual = best_of(from_columns)
+    assert all(actual[f] == expected[f] for f in fields)
+    print("{0} records of {1} doubles and a string, reading {2}".format(RECORDS, WIDTH, " and ".join(fields)))
+    print("{0:<10}{1:>12}{2:>10}".format("layout", "bytes read", "ms"))
+    print("{0:<10}{1:>12}{2:>10.1f}".format("records", record_bytes, record_time * 1000))
+    print("{0:<10}{1:>12}{2:>10.1f}".format("columns", column_bytes, column_time * 1000))
+    print("{0:<10}{1:>11.1f}x{2:>9.1f}x".format("ratio", record_bytes / column_bytes, record_time / column_time))
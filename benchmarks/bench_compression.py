@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Acumos - Apache 2.0
+# Reports the stored size and the compress/decompress cost of a record for every
+# codec installed, on records built from the messages in tests/fixtures and on a
+# message router (JSON) record. Records of both RECORD_FORMATs are measured.
+
+import os
+import pickle
+import sys
+import timeit
+# the package of the checkout this lives in, whether installed or not
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_converter import fixture_messages
+from acumos_proto_viewer import data
+from acumos_proto_viewer.compression import available_codecs, compress, decompress
+
+NUMBER = 2000
+
+
+def fixture_records():
+    """
+    Returns a list of (name, encoded record) as ingest stores them without compression
+    """
+    records = []
+    for name, msg in fixture_messages():
+        binarydata = msg.SerializeToString()
+        records.append((name + " pickle", pickle.dumps(data._msg_to_dict(msg, 1541000000))))
+        records.append((name + " protobuf", data._RAW_RECORD_HEADER.pack(data._RAW_RECORD_MARKER, 1541000000) + binarydata))
+    event = {"event": {"commonEventHeader": {"domain": "measurementsForVfScaling", "eventName": "Mfvs_vFirewall",
+                                             "sourceName": "vfw-instance-0", "reportingEntityName": "vfw-instance-0",
+                                             "priority": "Normal", "sequence": 1, "version": 3},
+                       "measurementsForVfScalingFields": {"vNicUsageArray": [{"vNicIdentifier": "eth{0}".format(i),
+                                                                              "receivedTotalPacketsDelta": i * 100,
+                                                                              "transmittedTotalPacketsDelta": i * 90}
+                                                                             for i in range(4)]}},
+             "apv_received_at": 1541000000}
+    records.append(("MR topic json", pickle.dumps(event)))
+    return records
+
+
+if __name__ == '__main__':
+    codecs = ["none"] + available_codecs()
+    print("codecs installed: {0}".format(", ".join(codecs)))
+    print("{0:<30}{1:<7}{2:>10}{3:>8}{4:>12}{5:>12}".format("record", "codec", "bytes", "ratio", "enc us/rec", "dec us/rec"))
+    for name, raw in fixture_records():
+        for codec in codecs:
+            packed = compress(codec, raw)
+            enc = min(timeit.repeat(lambda: compress(codec, raw), number=NUMBER, repeat=3)) / NUMBER * 1e6
+            dec = min(timeit.repeat(lambda: decompress(packed), number=NUMBER, repeat=3)) / NUMBER * 1e6
+            print("{0:<30}{1:<7}{2:>10}{3:>7.1f}x{4:>12.1f}{5:>12.1f}".format(name, codec, len(packed), len(raw) / len(packed), enc, dec))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Acumos - Apache 2.0
+# Compares the descriptor-driven protobuf->dict converter in acumos_proto_viewer.data
+# against the former MessageToJson round trip, using the messages in tests/fixtures.
+# Both sides render the raw display string, although ingest no longer does.
+
+import copy
+import json
+import os
+import sys
+import timeit
+from google.protobuf.json_format import MessageToJson
+# the package of the checkout this lives in, whether installed or not
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acumos_proto_viewer import data
+from acumos_proto_viewer.utils import load_module, APV_MODEL, APV_RECVD, APV_SEQNO
+
+# determine base directory, the parent of benchmarks where this lives
+scripthome = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NUMBER = 2000
+
+
+def load_proto(model_id):
+    """
+    Loads a protoc-generated python module from tests/fixtures and returns it
+    """
+    expected_path = "{0}/tests/fixtures/{1}_pb2.py".format(scripthome, model_id)
+    return load_module(model_id, expected_path)
+
+
+def legacy_convert(msg, sequence_no):
+    """
+    The former conversion: MessageToJson, json.loads, repair of bytes and ints,
+    deepcopy, cleaning for display and json.dumps.
+    """
+    def repair(pb_msg, json_equiv):
+        for field in pb_msg.DESCRIPTOR.fields:
+            item = getattr(pb_msg, field.name)
+            if isinstance(item, bytes) or isinstance(item, int):
+                json_equiv[field.name] = item
+            elif hasattr(item, "DESCRIPTOR"):
+                repair(item, json_equiv[field.name])
+        json_equiv[APV_RECVD] = 0
+        json_equiv[APV_SEQNO] = sequence_no
+
+    def clean(json_equiv):
+        del json_equiv[APV_SEQNO]
+        del json_equiv[APV_RECVD]
+        for k, v in json_equiv.items():
+            if isinstance(v, bytes):
+                json_equiv[k] = "<RAW BYTES>"
+            elif isinstance(v, dict):
+                clean(v)
+
+    json_equiv = json.loads(MessageToJson(msg, preserving_proto_field_name=True))
+    repair(msg, json_equiv)
+    json_copy = copy.deepcopy(json_equiv)
+    clean(json_copy)
+    json_equiv[APV_MODEL] = json.dumps(json_copy, indent=4, sort_keys=True)
+    return json_equiv
+
+
+def fixture_messages():
+    """
+    Returns a list of (name, message) built from the fixture protos
+    """
+    xyz = load_proto("probe_testxyz_100_proto").XYZData(x=1.5, y=2.5, z=3.5)
+    nested = load_proto("probe_testnested_100_proto").NestOuter(tag="tag")
+    nested.i.x, nested.i.y, nested.i.z = 1.5, 2.5, 3.5
+    with open("{0}/tests/fixtures/1.png".format(scripthome), "rb") as f:
+        image = load_proto("probe_testimage_100_proto").TransformedImagePNG(imagebinary=f.read())
+    tags = load_proto("image_mood_classification_100_proto").ImageTagSet(
+        image=list(range(100)), tag=["tag{0}".format(i) for i in range(100)], score=[i / 100 for i in range(100)])
+    return [("XYZData", xyz), ("NestOuter", nested), ("TransformedImagePNG", image), ("ImageTagSet", tags)]
+
+
+if __name__ == '__main__':
+    print("{0:<22}{1:>14}{2:>14}{3:>10}".format("message", "legacy us/msg", "new us/msg", "speedup"))
+    for name, msg in fixture_messages():
+        binarydata = msg.SerializeToString()
+        cls = type(msg)
+
+        def run_legacy():
+            m = cls()
+            m.ParseFromString(binarydata)
+            legacy_convert(m, 1)
+
+        def run_new():
+            m = cls()
+            m.ParseFromString(binarydata)
+            data._model_as_string(data._msg_to_dict(m, 0, 1))
+
+        legacy = min(timeit.repeat(run_legacy, number=NUMBER, repeat=3)) / NUMBER * 1e6
+        new = min(timeit.repeat(run_new, number=NUMBER, repeat=3)) / NUMBER * 1e6
+        print("{0:<22}{1:>14.1f}{2:>14.1f}{3:>9.1f}x".format(name, legacy, new, legacy / new))
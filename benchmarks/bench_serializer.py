@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Acumos - Apache 2.0
+# Compares the binary record format against pickle, the legacy one, on the messages in
+# tests/fixtures: the stored size, and the cost of the serialization done on every
+# ingest and of the deserialization done for every record on every session update.
+
+import os
+import sys
+import timeit
+# the package of the checkout this lives in, whether installed or not
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_converter import fixture_messages
+from acumos_proto_viewer import data, serializer
+
+NUMBER = 2000
+
+
+if __name__ == '__main__':
+    print("{0:<22}{1:<8}{2:>8}{3:>14}{4:>14}".format("message", "format", "bytes", "dumps us/rec", "loads us/rec"))
+    for name, msg in fixture_messages():
+        descriptor = msg.DESCRIPTOR
+        record = data._msg_to_dict(msg, 1541000000)
+        loads = {}
+        for fmt in ["pickle", "binary"]:
+            raw = serializer.dumps(fmt, record, descriptor)
+            assert serializer.loads(raw, 1, descriptor, trusted=True) == data._msg_to_dict(msg, 1541000000, 1)
+            dumps_us = min(timeit.repeat(lambda: serializer.dumps(fmt, record, descriptor), number=NUMBER, repeat=3)) / NUMBER * 1e6
+            loads[fmt] = min(timeit.repeat(lambda: serializer.loads(raw, 1, descriptor, trusted=True), number=NUMBER, repeat=3)) / NUMBER * 1e6
+            print("{0:<22}{1:<8}{2:>8}{3:>14.1f}{4:>14.1f}".format(name, fmt, len(raw), dumps_us, loads[fmt]))
@@ -3,6 +3,7 @@
 # runs a web server on port 5006 with a data-viz UI generated by Bokeh
 
 import os
+import time
 from functools import partial
 from bokeh.server.server import Server
 from bokeh.embed import server_document
@@ -13,9 +14,13 @@ from bokeh.themes import Theme
 from bokeh.models.widgets import DataTable, MultiSelect, Select, TableColumn
 from bokeh.io import curdoc
 from jinja2 import Environment, FileSystemLoader
+from tornado import gen
 from tornado.web import RequestHandler
 from acumos_proto_viewer import data, get_module_logger
-from acumos_proto_viewer.utils import get_message_data, APV_MODEL, APV_RECVD, APV_SEQNO
+from acumos_proto_viewer.downsample import Decimator, LTTB, MINMAX
+from acumos_proto_viewer.hub import StreamHub
+from acumos_proto_viewer.rollups import RESOLUTIONS
+from acumos_proto_viewer.utils import get_message_data, get_messages_data, APV_MODEL, APV_RECVD, APV_SEQNO
 from acumos_proto_viewer.run_handlers import MODEL_SELECTION, MESSAGE_SELECTION, GRAPH_SELECTION, GRAPH_OPTIONS, AFTER_MODEL_SELECTION, FIGURE_MODEL, FIELD_SELECTION, IMAGE_MIME_SELECTION, IMAGE_SELECTION, MIME_SELECTION, DEFAULT_UNSELECTED, X_AXIS_SELECTION, Y_AXIS_SELECTION, COLUMN_MULTISELECT, COLUMN_SELECTION
 from acumos_proto_viewer import run_handlers
 
@@ -24,9 +29,15 @@ _logger = get_module_logger(__name__)
 # read params from env variables
 CBF = int(os.environ["UPDATE_CALLBACK_FREQUENCY"]) if "UPDATE_CALLBACK_FREQUENCY" in os.environ else 1000  # default to 1s
 _logger.debug("run: using callback frequency %d ms", CBF)
+UPDATE_BATCH_SIZE = int(os.environ["UPDATE_BATCH_SIZE"]) if "UPDATE_BATCH_SIZE" in os.environ else 10000  # the most records a session gets per callback
+UPDATE_HISTORY = int(os.environ["UPDATE_HISTORY"]) if "UPDATE_HISTORY" in os.environ else 10000  # the latest records a new plot starts with
+PLOT_POINTS = int(os.environ["PLOT_POINTS"]) if "PLOT_POINTS" in os.environ else 2000  # the points x-y plots are decimated to, 0 for all
 SUPPORTED_MIME_TYPES = ["png", "jpeg"]
 _host = None  # magic that will be used to return the correct image url even when in Docker; will be set to the request uri to /. If they can hit whatever:/, then they can hit whatever/data etc
-_last_callback = None
+# one poller per data source reads new records for every session, see StreamHub
+_hub = StreamHub(CBF, UPDATE_BATCH_SIZE)
+_subscriptions = {}  # session id -> the hub Subscription of its plot
+_decimators = {}  # session id -> {sind: the Decimator of its x-y plot}
 
 class IndexHandler(RequestHandler):
     """handler for /"""
@@ -46,10 +57,37 @@ class IndexHandler(RequestHandler):
 
 class DataHandler(RequestHandler):
     """handler for /data"""
+    @gen.coroutine
     def post(self):
-        """handler for POST /data"""
-        code, status = run_handlers.handle_data_post(self.request.headers, self.request.body)
+        """handler for POST /data; decoding and storage happen off the IOLoop"""
+        code, status, headers = yield run_handlers.handle_data_post_async(self.request.headers, self.request.body)
         self.set_status(code)
+        for name, value in headers.items():
+            self.set_header(name, value)
+        self.write(status)
+        self.finish()
+
+
+class DataBatchHandler(RequestHandler):
+    """handler for /data/batch"""
+    @gen.coroutine
+    def post(self):
+        """handler for POST /data/batch; decoding and storage happen off the IOLoop"""
+        code, status, headers = yield run_handlers.handle_data_batch_post_async(self.request.headers, self.request.body)
+        self.set_status(code)
+        for name, value in headers.items():
+            self.set_header(name, value)
+        self.write(status)
+        self.finish()
+
+
+class IngestStatsHandler(RequestHandler):
+    """handler for /ingest_stats"""
+    def get(self):
+        """handler for GET /ingest_stats"""
+        code, status = run_handlers.handle_ingest_stats_get()
+        self.set_status(code)
+        self.set_header("Content-Type", "application/json")
         self.write(status)
         self.finish()
 
@@ -75,15 +113,27 @@ class ImageHandler(RequestHandler):
     """handler for /image"""
     def get(self, slug):
         """handler for GET /image"""
-        (model_id, message_name, field_name, mime, sind, index) = slug.split("---")
+        parts = slug.split("---")
+        if parts[0] == "blob":
+            # blob---mime---digest, the image is fetched by reference without reading the record
+            (_, mime, digest) = parts
+            val = data.get_blob(digest)
+            if val is not None:
+                # content addressed, so it never changes
+                self.set_header('Cache-Control', 'public, max-age=86400, immutable')
+        else:
+            (model_id, message_name, field_name, mime, sind, index) = parts
+            val = None
+            # positions span day buckets, so the index stays valid across midnight
+            source = data.get_raw_data(model_id, message_name, int(index), int(index))
+            if source:  # empty if the record was dropped since
+                # field may be a dotted tuple
+                val = get_message_data(source[0], field_name)
+                if isinstance(val, data.BlobRef):
+                    val = data.get_blob(val)
         self.set_header('Content-Type', 'image/' + mime)
-        raw_data_count = data.get_raw_data_source_count(model_id, message_name)
-        if raw_data_count > 0:
-            i = min(int(index), raw_data_count - 1)  # if session was logged in before midnight, raw data set might have reset and the session index is now greater; check for this edge case so we don't blow up
-            source = data.get_raw_data(model_id, message_name, i, i + 1)
+        if val is not None:
             self.set_status(200)
-            # field may be a dotted tuple
-            val = get_message_data(source[0], field_name)
             self.write(val)
         else:
             self.set_status(404)
@@ -108,82 +158,148 @@ def _remove_selection(curdoc):
 
 
 def _remove_callback(curdoc):
-    if _last_callback is not None:
-        try:
-            curdoc.remove_periodic_callback(_last_callback)
-            _logger.debug("_remove_callback: success")
-        except Exception as exc:
-            _logger.debug("_remove_callback failed: {0}".format(exc))
+    subscription = _subscriptions.pop(curdoc.session_context.id, None)
+    if subscription is not None:
+        subscription.cancel()
+        _logger.debug("_remove_callback: success")
 
 
-def _install_callback_and_cds(sind, model_id, message_name, field_transforms={}, stream_limit=None):
+def _install_callback_and_cds(sind, model_id, message_name, field_transforms={}, stream_limit=None, render_model_string=False, fields=None, columns=None, decimate=None):
     """
-    Set up a new column_data_source, install a callback to update it
+    Set up a new column_data_source, subscribe it to the hub to update it
     If it already exists do nothing
+    render_model_string fills the apv_model_as_string column, which only the raw view needs
+    fields, if given, restricts the column_data_source to these fields, which are read with data.get_raw_columns;
+    the numeric ones are streamed as numpy arrays of the dtype of their json schema type, see run_handlers.get_column_dtypes
+    columns, if given, are the properties the figure uses when it needs the records, e.g., for field_transforms:
+    only those, and apv_sequence_number, are extracted from the records and streamed, instead of every property
+    decimate, if given, is (x, y, method) for an x-y plot of fields: the column_data_source then holds the
+    latest stream_limit points decimated to PLOT_POINTS with that downsample method, if x and y are numeric
+    The hub delivers batches from its thread, so they are applied on the next tick of the document,
+    the way bokeh documents updating from threads
+    A new column_data_source starts from the tail: the last record if stream_limit is 1, else the
+    last UPDATE_HISTORY records, at most stream_limit, which the hub delivers UPDATE_BATCH_SIZE at a time
     """
     d = curdoc()
     _remove_callback(d)
     model_id, message_name, model_type = run_handlers.get_modelid_messagename_type(d)
-    emptyd = {k: [] for k in run_handlers.get_model_properties(model_id, message_name, model_type)}
+    if fields is None and columns is not None:
+        columns = [APV_SEQNO] + [k for k in columns if k != APV_SEQNO]
+    elif fields is None:
+        columns = list(run_handlers.get_model_properties(model_id, message_name, model_type))
+    if fields is not None:
+        dtypes = run_handlers.get_column_dtypes(model_id, message_name, model_type, fields)
+        emptyd = {k: run_handlers.to_typed_column([], dtypes[k]) for k in fields}
+    else:
+        dtypes = None
+        emptyd = {k: [] for k in columns}
     if d.get_model_by_name(sind) is None:
+        history = min(stream_limit, UPDATE_HISTORY) if stream_limit is not None else UPDATE_HISTORY
+        start = max(data.get_raw_data_source_count(model_id, message_name) - history, 0)
         d.add_root(ColumnDataSource(emptyd,
                                     name=sind,
-                                    tags=[0]))
-    func = partial(_bokeh_periodic_update, sind, model_id, message_name, field_transforms, stream_limit)
-    global _last_callback
-    _last_callback = func
-    d.add_periodic_callback(func, CBF)
-    _logger.debug("_install_callback_and_cds: callback {0} added for sind {1}".format(func, sind))
+                                    tags=[start]))
+    # the accessors of the columns, compiled when the message was registered
+    accessors = data.get_field_accessors(model_id, message_name, columns) if fields is None else None
+    decimation = None
+    if decimate is not None and PLOT_POINTS > 0:
+        x, y, method = decimate
+        if dtypes[x] is not None and dtypes[y] is not None:
+            decimators = _decimators.setdefault(d.session_context.id, {})
+            if sind not in decimators:  # else the column_data_source was drawn by it already
+                decimators[sind] = Decimator(PLOT_POINTS, stream_limit, method)
+            decimation = (decimators[sind], x, y)
+    func = partial(_bokeh_stream_update, sind, model_id, message_name, field_transforms, stream_limit, render_model_string, fields, dtypes, accessors, decimation)
+    _subscriptions[d.session_context.id] = _hub.subscribe(model_id, message_name, fields, d.get_model_by_name(sind).tags[0],
+                                                          lambda batch: d.add_next_tick_callback(partial(func, batch)))
+    _logger.debug("_install_callback_and_cds: callback {0} subscribed for sind {1}".format(func, sind))
+
+
+def _session_destroyed(session_context):
+    _decimators.pop(session_context.id, None)
+    subscription = _subscriptions.pop(session_context.id, None)
+    if subscription is not None:
+        subscription.cancel()
 
 
 ########
 # UPDATE CALLBACKS
-def _bokeh_periodic_update(sind, model_id, message_name, field_transforms={}, stream_limit=None):
+def _bokeh_stream_update(sind, model_id, message_name, field_transforms, stream_limit, render_model_string, fields, dtypes, accessors, decimation, batch):
     """
-    Callback that gets called periodically *for each session*. That is, each session 
-    (user connecting via browser) will register a callback of this for their session.
-    Here we will update the data source with new points
+    Callback that gets called *for each session* with every batch of new records the hub
+    read for the data source. That is, each session (user connecting via browser) subscribes
+    a callback of this for their session.
+    Here we will update the data source with new points; records of the batch the session
+    already has are skipped
     https://bokeh.pydata.org/en/latest/docs/reference/models/sources.html
 
     field_transforms is a dict {k : [func, kwargs]} where func(k, **kwargs) will be 
     applied for all k in the raw data before going into the column_data_source
 
+    apv_model_as_string is not stored, so if render_model_string is set it is rendered
+    here, and only for the records that survive the stream_limit
+
+    if fields is set, the batch has only those columns, see data.get_raw_columns, and there are no field_transforms;
+    those with a dtype, from dtypes, are streamed as numpy arrays, which bokeh sends as binary buffers;
+    with decimation, (Decimator, x, y), the points go through the Decimator, which may redraw them all;
+    else only the columns of the column_data_source are extracted from the records, a column at a time, with
+    accessors, the dict {column: accessor} of utils.compile_field_accessor
+
     PLEASE READ ABOUT DATA REDUNDANCY:
         https://groups.google.com/a/continuum.io/forum/#!topic/bokeh/m91Y2La6fS0
     """
     d = curdoc()
     column_data_source = d.get_model_by_name(sind)
+    if column_data_source is None:  # the plot was replaced since
+        return
     seq = column_data_source.tags[0]
-    # _logger.debug("_bokeh_periodic_update: model_id {0}, message {1}, seq {2}".format(model_id, message_name, seq))
-    model_id, message_name, model_type = run_handlers.get_modelid_messagename_type(d)
-    source = data.get_raw_data(model_id, message_name, seq, -1)
-    # _logger.debug("_bokeh_periodic_update: source length {0}".format(len(source)))
-    if source != []:  # might be no data, exit callback immediately if so
-        # this has all the properties, even ones we don't want to display
-        # these keys may be dotted pairs
-        sinit = {k: [] for k in run_handlers.get_model_properties(model_id, message_name, model_type)}
-        # _logger.debug("_bokeh_periodic_update: sinit {0}".format(sinit))
-        newdata = sinit
-        num_data = 0
-        for msg in source:  # from where we left off to the end
-            for mk in sinit.keys():
-                val = get_message_data(msg, mk)
-                if val is None:
-                    pass # Ignore.  For example, model_as_string property is defined but not pushed to Redis.
-                    # _logger.warning("_bokeh_periodic_update: failed to get value from message {0}, field {1}".format(message_name, mk))
-                elif mk in field_transforms:
-                    val = field_transforms[mk][0](val, **field_transforms[mk][1])
-                if isinstance(val, bytes):
-                    # this can happen in rare cases, like RAW being used to try to display an image
+    # _logger.debug("_bokeh_stream_update: model_id {0}, message {1}, seq {2}".format(model_id, message_name, seq))
+    if fields is not None:
+        new_from = next((i for i, s in enumerate(batch[APV_SEQNO]) if s > seq), len(batch[APV_SEQNO]))
+        if new_from < len(batch[APV_SEQNO]):
+            newdata = {}
+            for k in fields:
+                values = batch[k][new_from:]
+                newdata[k] = run_handlers.to_typed_column(values, dtypes[k])
+                if newdata[k] is values:  # not numeric, or did not convert
                     # bokeh internally does a JSON serialization so we can't let bytes slip through
-                    # this does not affect image rendering is that is not put into the bokeh CDS, only the URL is
-                    val = "<RAW BYTES>"
-                newdata[mk].append(val)
-            num_data += 1
+                    newdata[k] = ["<RAW BYTES>" if isinstance(v, (bytes, data.BlobRef)) else v for v in values]
+            if decimation is not None:
+                decimator, x, y = decimation
+                redraw, (xs, ys) = decimator.add(newdata[x], newdata[y])
+                newdata = {x: xs, y: ys}
+                if redraw:
+                    column_data_source.data = newdata
+                else:
+                    column_data_source.stream(newdata)
+            else:
+                column_data_source.stream(newdata, stream_limit)
+            column_data_source.tags = [batch[APV_SEQNO][-1]]
+        return
+    source = [msg for msg in batch if msg[APV_SEQNO] > seq]
+    # _logger.debug("_bokeh_stream_update: source length {0}".format(len(source)))
+    if source != []:  # might be no data, exit callback immediately if so
+        # only the properties the figure uses; these keys may be dotted pairs
+        newdata = {}
+        render_from = max(len(source) - stream_limit, 0) if stream_limit is not None else 0
+        for mk, accessor in accessors.items():
+            if mk == APV_MODEL and render_model_string:
+                values = get_messages_data(source[:render_from], mk, accessor)
+                values.extend(data.get_model_as_string(model_id, message_name, msg) for msg in source[render_from:])
+            else:
+                values = get_messages_data(source, mk, accessor)
+            # None is left alone. For example, model_as_string property is defined but not pushed to Redis.
+            if mk in field_transforms:
+                func, kwargs = field_transforms[mk]
+                values = [func(val, **kwargs) if val is not None else val for val in values]
+            # this can happen in rare cases, like RAW being used to try to display an image
+            # bokeh internally does a JSON serialization so we can't let bytes slip through
+            # this does not affect image rendering is that is not put into the bokeh CDS, only the URL is
+            newdata[mk] = ["<RAW BYTES>" if isinstance(val, (bytes, data.BlobRef)) else val for val in values]
 
-        # Warning, don't check newdata = sinit because it's not a deep copy!!!!!11!
         d.get_model_by_name(sind).stream(newdata, stream_limit)  # after the data source is updated, some magic happens such that the new data is streamed via web socket to the browser
-        column_data_source.tags = [seq + num_data]
+        # sequence numbers are stream positions plus one; they may skip records that a ring trimmed
+        column_data_source.tags = [source[-1][APV_SEQNO]]
 
 
 def modelselec_change():
@@ -262,7 +378,7 @@ def graphs_change():
         p.xaxis.visible = False
         p.yaxis.visible = False
         sind = run_handlers.get_source_index(d.session_context.id, model_id, message_name)
-        _install_callback_and_cds(sind, model_id, message_name, stream_limit=1)
+        _install_callback_and_cds(sind, model_id, message_name, stream_limit=1, render_model_string=True, columns=[APV_MODEL])
         p.text(x='apv_sequence_number',
                y=0,
                text='apv_model_as_string',
@@ -282,6 +398,8 @@ def image_selection_change():
 
     def return_image(val, model_id, message_name, field_name, mime, sind):
         """Returns a URL resolvable by the probe"""
+        if isinstance(val, data.BlobRef):
+            return "http://{0}/image/".format(_host) + "---".join(["blob", mime, val.digest])
         column_data_source = curdoc().get_model_by_name(sind)
         index = column_data_source.tags[0]
         url = "http://{0}/image/".format(_host) + "---".join([model_id, message_name, field_name, mime, sind, str(index)])
@@ -303,11 +421,42 @@ def image_selection_change():
                                                                 "field_name": image_field,
                                                                 "mime": mime,
                                                                 "sind": sind}]},
-                                  stream_limit=1)
+                                  stream_limit=1, columns=[image_field])
         plot.image_url(url=image_field, x=0, y=1, h=1, w=1, source=d.get_model_by_name(sind))
         d.add_root(plot)
 
 
+def _draw_rollups(plot, sind, model_id, message_name, x, y, graph_val):
+    """
+    Draws, behind an x-y plot over receive time, the rollups of y from as far back as they go up to the
+    first point of the plot, so zooming out shows hours of data without reading their records, see
+    data.get_rollups: the mean per bucket for a line graph, the min and max for a step graph.
+    Nothing is drawn if y is not rolled up. The rollups are those of this process, see ROLLUPS.
+    """
+    d = curdoc()
+    column_data_source = d.get_model_by_name(sind)
+    if len(column_data_source.data[x]) > 0:
+        time_end = column_data_source.data[x][0] - 1
+    else:
+        start = column_data_source.tags[0]
+        first = data.get_raw_columns(model_id, message_name, [APV_RECVD], start, start)[APV_RECVD]
+        time_end = first[0] - 1 if first else int(time.time())
+    time_start = time_end - data.ROLLUP_BUCKETS * RESOLUTIONS[-1]
+    try:
+        rollup = data.get_rollups(model_id, message_name, [y], time_start, time_end, PLOT_POINTS or UPDATE_HISTORY)
+    except KeyError:  # not numeric
+        return
+    if rollup is None or rollup[APV_RECVD] == []:
+        return
+    stats = rollup["fields"][y]
+    source = ColumnDataSource({x: rollup[APV_RECVD], "mean": stats["mean"], "min": stats["min"], "max": stats["max"]})
+    if graph_val == "line":
+        plot.line(x=x, y="mean", color="firebrick", line_width=2, line_alpha=0.5, source=source)
+    if graph_val == "step":
+        plot.step(x=x, y="min", color="#FB8072", line_alpha=0.5, source=source)
+        plot.step(x=x, y="max", color="#FB8072", line_alpha=0.5, source=source)
+
+
 def make_2axis_graph():
     """Makes a 2 axis graph when user changes the X or Y axis selection"""
     d = curdoc()
@@ -320,13 +469,20 @@ def make_2axis_graph():
 
     if xval != DEFAULT_UNSELECTED and yval != DEFAULT_UNSELECTED:
         plot = figure(plot_width=400, plot_height=400, name=FIGURE_MODEL)
-        sind = run_handlers.get_source_index(d.session_context.id, model_id, message_name)
-        _install_callback_and_cds(sind, model_id, message_name, stream_limit=100000)
 
         # get the field name back from the pretty field : meta string formed above
         x = xval.split(" :")[0]
         y = yval.split(" :")[0]
 
+        # large histories are decimated on the server, LTTB keeps the shape of lines, min/max the steps
+        method = MINMAX if graph_val == "step" else LTTB
+        # the plot only draws x and y, so its data source holds only those, as picked by the method
+        sind = run_handlers.get_source_index(d.session_context.id, model_id, message_name, x + "," + y + "," + method)
+        _install_callback_and_cds(sind, model_id, message_name, stream_limit=100000, fields=sorted(set([x, y])), decimate=(x, y, method))
+        if data.ROLLUPS and x == APV_RECVD and y != APV_RECVD and graph_val in ("line", "step"):
+            # the records before the history of the plot are drawn from the rollups
+            _draw_rollups(plot, sind, model_id, message_name, x, y, graph_val)
+
         if graph_val == "line":
             plot.line(x=x, y=y, color="firebrick", line_width=2, source=d.get_model_by_name(sind))
             plot.x_range.follow = "end"  # don't jam all the data into the graph; "window" it
@@ -345,10 +501,11 @@ def column_selection_change():
     d = curdoc()
     _remove_fig(d)
     model_id, message_name, _ = run_handlers.get_modelid_messagename_type(d)
-    sind = run_handlers.get_source_index(d.session_context.id, model_id, message_name)
-    source = d.get_model_by_name(sind)
-    _install_callback_and_cds(sind, model_id, message_name, stream_limit=1)
     sel_cols = d.get_model_by_name(COLUMN_MULTISELECT).value
+    # the table shows only the selected columns, so its data source holds only those
+    sind = run_handlers.get_source_index(d.session_context.id, model_id, message_name, ",".join(sel_cols))
+    _install_callback_and_cds(sind, model_id, message_name, stream_limit=1, fields=sel_cols)
+    source = d.get_model_by_name(sind)
     columns = [ TableColumn(field=c, title=c) for c in sel_cols ]
     data_table = DataTable(source=source, columns=columns, width=500, height=500)
     table_widget = widgetbox(data_table, name=FIGURE_MODEL)
@@ -369,6 +526,7 @@ def modify_doc(doc):
     selec = widgetbox([modelselec])
     doc.add_root(selec)
     doc.theme = Theme(filename="theme.yaml")
+    doc.on_session_destroyed(_session_destroyed)
 
 # Setting num_procs here means we can't touch the IOLoop before now, we must
 # let Server handle that. If you need to explicitly handle IOLoops then you
@@ -384,12 +542,17 @@ def modify_doc(doc):
 # Allow requests from alternate port to support K8S deployment
 accept_origin = "*:" + os.environ.get("ACUMOS_PROBE_EXTERNAL_PORT", "5006")
 
+# ingest worker processes are forked before the server, or anything else, starts a thread
+run_handlers.start_pools()
+
 server = Server({'/bkapp': modify_doc},
                 num_procs=1,  # see above!
                 port = 5006,
                 extra_patterns=[(
                     '/', IndexHandler),
                     ('/data', DataHandler),
+                    ('/data/batch', DataBatchHandler),
+                    ('/ingest_stats', IngestStatsHandler),
                     ('/image/([^/]+)', ImageHandler),
                     ('/onap_topic_subscription/([^/]+)', ONAPMRTopicHandler)],
                 address="0.0.0.0",
@@ -15,7 +15,10 @@ setup(
                       "jsonschema >2.0.0, <3.0.0",
                       "tornado >4.0.0, <5.0.0",
                       "bokeh >1.0.0, <3.0.0",
+                      "numpy >1.11.0, <2.0.0",
                       "redis >2.0.0, <3.0.0"],
+    extras_require={"lz4": ["lz4"],
+                    "zstd": ["zstandard"]},
     scripts=[
         "bin/fake_data.py",
         "bin/run.py"
@@ -87,11 +87,15 @@ def fake_msg_with_arrays_jsonwb():
                 "tag": ["fish", "cat", "dog"],
                 "score": [0.8, 0.9, 1.0],
                 'apv_received_at': 55555555555,
-                'apv_sequence_number': 1,
-                'apv_model_as_string': '{\n    "image": [\n        "1",\n        "2",\n        "3"\n    ],\n    "score": [\n        0.8,\n        0.9,\n        1.0\n    ],\n    "tag": [\n        "fish",\n        "cat",\n        "dog"\n    ]\n}'}
+                'apv_sequence_number': 1}
     return _fake_msg_with_arrays_jsonwb
 
 
+@pytest.fixture
+def fake_msg_with_arrays_as_string():
+    return '{\n    "image": [\n        "1",\n        "2",\n        "3"\n    ],\n    "score": [\n        0.8,\n        0.9,\n        1.0\n    ],\n    "tag": [\n        "fish",\n        "cat",\n        "dog"\n    ]\n}'
+
+
 @pytest.fixture
 def fake_msg_as_jsonwb():
     def _fake_msg_as_jsonwb():
@@ -103,11 +107,15 @@ def fake_msg_as_jsonwb():
                 'f': 'helives',
                 'g': b'U+1F615',
                 'apv_received_at': 55555555555,
-                'apv_model_as_string': '{\n    "a": 1.1111111111111111e+24,\n    "b": 666.666015625,\n    "c": 777,\n    "d": 77777777777777,\n    "e": true,\n    "f": "helives",\n    "g": "<RAW BYTES>"\n}',
                 'apv_sequence_number': 1}
     return _fake_msg_as_jsonwb
 
 
+@pytest.fixture
+def fake_msg_as_string():
+    return '{\n    "a": 1.1111111111111111e+24,\n    "b": 666.666015625,\n    "c": 777,\n    "d": 77777777777777,\n    "e": true,\n    "f": "helives",\n    "g": "<RAW BYTES>"\n}'
+
+
 @pytest.fixture
 def test_proto_url():
     return "http://myserver.com/fakemodelid/1.0.0/fakemodelid-1.0.0-proto"
@@ -0,0 +1,104 @@
+# Acumos - Apache 2.0
+
+
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+from acumos_proto_viewer.admission import AdmissionController
+from acumos_proto_viewer.exceptions import IngestRejected
+
+
+class FakeClock():
+    """Clock advanced by hand"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limit():
+    clock = FakeClock()
+    adm = AdmissionController(10, 4, 2, clock=clock)
+
+    @gen.coroutine
+    def admit(model_id, cost=1):
+        yield adm.acquire(model_id, cost)
+        adm.release(model_id)
+
+    IOLoop.current().run_sync(lambda: admit("m"))
+    IOLoop.current().run_sync(lambda: admit("m"))
+    with pytest.raises(IngestRejected) as exc:
+        IOLoop.current().run_sync(lambda: admit("m"))
+    assert exc.value.retry_after == 1
+    # another model has its own bucket
+    IOLoop.current().run_sync(lambda: admit("n"))
+
+    # half a second refills one message
+    clock.now = 0.5
+    IOLoop.current().run_sync(lambda: admit("m"))
+    # a batch may overdraw the bucket, then the model waits for the refill
+    clock.now = 1.5
+    IOLoop.current().run_sync(lambda: admit("m", 6))
+    with pytest.raises(IngestRejected) as exc:
+        IOLoop.current().run_sync(lambda: admit("m"))
+    assert exc.value.retry_after == 2
+
+    stats = adm.stats()
+    assert stats["depth"] == 0
+    assert stats["rejected_rate"] == 2
+    assert stats["models"]["m"] == {"depth": 0, "accepted": 4, "rejected_rate": 2}
+
+
+def test_concurrency_and_queue_bound():
+    adm = AdmissionController(3, 1, 0)
+    running = []
+    order = []
+
+    @gen.coroutine
+    def ingest(name, model_id):
+        yield adm.acquire(model_id)
+        try:
+            running.append(name)
+            assert len([r for r in running if r[0] == model_id]) == 1
+            yield gen.sleep(0.01)
+            order.append(name)
+            running.remove(name)
+        finally:
+            adm.release(model_id)
+
+    @gen.coroutine
+    def burst():
+        futs = [ingest("a1", "a"), ingest("a2", "a"), ingest("b1", "b")]
+        assert adm.stats()["depth"] == 3
+        # the queue is full, the fourth request is rejected right away
+        with pytest.raises(IngestRejected):
+            yield adm.acquire("b")
+        yield futs
+
+    IOLoop.current().run_sync(burst)
+    assert order.index("a1") < order.index("a2")
+    stats = adm.stats()
+    assert stats["depth"] == 0
+    assert stats["rejected_queue_full"] == 1
+    assert stats["models"]["a"]["accepted"] == 2
+
+
+def test_models_bounded():
+    adm = AdmissionController(10, 1, 1, clock=FakeClock(), max_models=3)
+
+    @gen.coroutine
+    def cycle():
+        yield adm.acquire("busy")  # not released, so it is never forgotten
+        for i in range(100):
+            yield adm.acquire("m{0}".format(i))
+            adm.release("m{0}".format(i))
+        # over its rate, counted even once the model is forgotten
+        with pytest.raises(IngestRejected):
+            yield adm.acquire("m99")
+
+    IOLoop.current().run_sync(cycle)
+    stats = adm.stats()
+    # a client cycling PROTO-URLs does not grow the table
+    assert sorted(stats["models"]) == ["busy", "m98", "m99"]
+    assert stats["rejected_rate"] == 1
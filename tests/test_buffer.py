@@ -0,0 +1,103 @@
+# Acumos - Apache 2.0
+
+
+from threading import Thread
+import time
+from acumos_proto_viewer.buffer import WriteBehindBuffer
+
+
+class FakeStore():
+    """Flush function that appends to in-memory lists, like RPUSH"""
+    def __init__(self):
+        self.lists = {}
+        self.flushes = 0
+
+    def __call__(self, pending):
+        self.flushes += 1
+        first = {}
+        for key, records in pending.items():
+            lst = self.lists.setdefault(key, [])
+            first[key] = len(lst) + 1
+            lst.extend(records)
+        return first
+
+
+def test_flush_on_size():
+    store = FakeStore()
+    buf = WriteBehindBuffer(store, max_records=3, max_delay_ms=60000)
+    buf.append("a", [1])
+    buf.append("b", [2])
+    assert buf.pending() == 2
+    assert store.flushes == 0
+    buf.append("a", [3])
+    for _ in range(100):
+        if store.flushes:
+            break
+        time.sleep(.01)
+    assert store.flushes == 1
+    assert store.lists == {"a": [1, 3], "b": [2]}
+    assert buf.pending() == 0
+
+
+def test_flush_on_time():
+    store = FakeStore()
+    buf = WriteBehindBuffer(store, max_records=1000, max_delay_ms=20)
+    buf.append("a", [1, 2])
+    time.sleep(.2)
+    assert store.lists == {"a": [1, 2]}
+
+
+def test_flush_on_time_when_idle():
+    store = FakeStore()
+    buf = WriteBehindBuffer(store, max_records=1000, max_delay_ms=20)
+    buf.append("a", [1])
+    buf.flush()
+    # the flusher is now idle, waiting for records; a single one is flushed by age alone
+    buf.append("a", [2])
+    for _ in range(100):
+        if store.flushes == 2:
+            break
+        time.sleep(.01)
+    assert store.flushes == 2
+    assert store.lists == {"a": [1, 2]}
+
+
+def test_wait_returns_sequence_numbers():
+    store = FakeStore()
+    buf = WriteBehindBuffer(store, max_records=4, max_delay_ms=50)
+    seqs = {}
+
+    def post(i):
+        seqs[i] = buf.append("a", [i], wait=True)
+
+    threads = [Thread(target=post, args=[i]) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(seqs.values()) == list(range(1, 11))
+    # each record landed at the position its sequence number says
+    for i, seq in seqs.items():
+        assert store.lists["a"][seq - 1] == i
+
+
+def test_wait_raises_flush_error():
+    def failing(pending):
+        raise IOError("redis is gone")
+
+    buf = WriteBehindBuffer(failing, max_records=1, max_delay_ms=10)
+    try:
+        buf.append("a", [1], wait=True)
+        assert False
+    except IOError:
+        pass
+
+
+def test_explicit_flush():
+    store = FakeStore()
+    buf = WriteBehindBuffer(store, max_records=1000, max_delay_ms=60000)
+    buf.append("a", [1])
+    buf.flush()
+    assert store.lists == {"a": [1]}
+    buf.flush()  # nothing pending
+    assert store.flushes == 1
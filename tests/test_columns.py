@@ -0,0 +1,39 @@
+# Acumos - Apache 2.0
+
+
+from acumos_proto_viewer.utils import load_proto, register_proto_from_url, get_message_data
+from acumos_proto_viewer import columns, data
+
+
+def test_layout(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                test_proto_url, test_proto_mid, test_proto_with_arrays_url, test_proto_with_arrays_mid):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    register_proto_from_url(test_proto_url)
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_mid)
+
+    # singular numbers and bools only, also nested ones; no strings, bytes, maps or repeated fields
+    layout = columns.get_layout(test.Data2.DESCRIPTOR)
+    assert layout.fields == ["apv_received_at", "a.a", "a.b", "a.c", "a.d", "a.e"]
+    assert layout.column_of("a.c") == 3
+    assert layout.column_of("a.apv_received_at") == 0
+    assert layout.column_of("a.f") is None
+    assert layout.column_of("d") is None
+    assert columns.get_layout(test.Data2.DESCRIPTOR) is layout
+    assert columns.get_layout(load_proto(test_proto_with_arrays_mid).ImageTagSet.DESCRIPTOR).fields == ["apv_received_at"]
+
+    msgs = [test.Data2(), test.Data2()]
+    msgs[0].a.a = 1e300
+    msgs[0].a.b = 666.666
+    msgs[0].a.c = -5
+    msgs[0].a.d = -77777777777777
+    msgs[0].a.e = True
+    msgs[1].a.d = 2 ** 62
+    records = [data._msg_to_dict(m, 55555555555 + i) for i, m in enumerate(msgs)]
+    rows = [layout.pack_record(r) for r in records]
+    assert rows == [layout.pack_message(m, 55555555555 + i) for i, m in enumerate(msgs)]
+    assert len(rows[0]) == layout.row.size == 8 + 8 + 4 + 4 + 8 + 1
+    # the values read from the columns are those read from the records
+    for column, chunk in enumerate(layout.split_rows(rows)):
+        assert layout.unpack_column(column, chunk) == [get_message_data(r, layout.fields[column]) for r in records]
+    assert layout.unpack_column(1, b"") == []
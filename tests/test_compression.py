@@ -0,0 +1,36 @@
+# Acumos - Apache 2.0
+
+
+import pytest
+from acumos_proto_viewer import compression
+from acumos_proto_viewer.compression import available_codecs, compress, decompress
+
+
+def test_round_trip():
+    raw = b'{"value": 1.0, "apv_received_at": 1541000000}' * 20
+    for codec in available_codecs():
+        packed = compress(codec, raw)
+        assert packed[:1] == b"Z"
+        assert len(packed) < len(raw)
+        assert decompress(packed) == raw
+    assert "zlib" in available_codecs()
+
+
+def test_left_alone():
+    raw = b"\x80\x04" + bytes(range(200))
+    assert compress("none", raw) == raw
+    assert compress("zlib", raw, min_bytes=1000) == raw
+    # incompressible records are stored as is
+    assert compress("zlib", raw) == raw
+    assert decompress(raw) == raw
+
+
+def test_unavailable_codec(monkeypatch):
+    with pytest.raises(ValueError):
+        compress("brotli", b"x" * 100)
+    packed = compress("zlib", b"x" * 100)
+    monkeypatch.setattr('acumos_proto_viewer.compression._DECOMPRESSORS', {})
+    with pytest.raises(ValueError) as exc:
+        decompress(packed)
+    assert "zlib" in str(exc.value)
+    assert compression._KNOWN_IDS[packed[1:2]] == "zlib"
@@ -3,8 +3,15 @@
 
 import fakeredis
 import hashlib
-from acumos_proto_viewer.utils import register_proto_from_url
+import json
+import pytest
+import time
+from threading import Thread
+from acumos_proto_viewer.utils import load_proto, register_proto_from_url
 from acumos_proto_viewer import data
+from acumos_proto_viewer.segments import SegmentBackend
+from acumos_proto_viewer.storage import MemoryBackend
+from conftest import FakeResponse
 
 
 def test_msg_to_json_preserve_bytes(monkeypatch, monkeyed_requests_get, cleanuptmp,
@@ -30,11 +37,13 @@ def test_msg_to_json_preserve_bytes(monkeypatch, monkeyed_requests_get, cleanupt
 def _verify_inject_test(fake_msg_as_jsonwb, fake_msg_with_arrays_jsonwb,
                         test_proto_mid, test_proto_msg,
                         test_proto_with_arrays_mid, test_proto_with_arrays_msg):
-    expected_h_1 = "{0}{1}{2}".format(test_proto_mid, test_proto_msg, 'asdf0')
-    expected_index_1 = hashlib.sha224(expected_h_1.encode('utf-8')).hexdigest().encode()
-    expected_h_2 = "{0}{1}{2}".format(test_proto_with_arrays_mid, test_proto_with_arrays_msg, 'asdf0')
-    expected_index_2 = hashlib.sha224(expected_h_2.encode('utf-8')).hexdigest().encode()
-    assert(data.myredis.keys() == [expected_index_1, expected_index_2])
+    expected_keys = set()
+    for mid, msg in [(test_proto_mid, test_proto_msg), (test_proto_with_arrays_mid, test_proto_with_arrays_msg)]:
+        expected_h = "{0}{1}".format(mid, msg)
+        expected_stream = hashlib.sha224(expected_h.encode('utf-8')).hexdigest()
+        # the day bucket, the stream position of its first record, the stream count
+        expected_keys.update(k.format(expected_stream).encode() for k in ["{0}_asdf0", "{0}_asdf0_base", "{0}_total", "{0}_time"])
+    assert(set(data.myredis.keys()) == expected_keys)
     assert(data.get_raw_data(test_proto_mid, test_proto_msg, 0, 1) == [fake_msg_as_jsonwb()])
     assert(data.get_raw_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, 0, 1) == [fake_msg_with_arrays_jsonwb()])
 
@@ -57,6 +66,7 @@ def test_inject_data_env(monkeypatch, monkeyed_requests_get, cleanuptmp,
     data.myredis = fakeredis.FakeStrictRedis()
     monkeypatch.setattr('acumos_proto_viewer.data.get_raw_data_source_count', lambda x, y: 0)
     monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'asdf0')
+    monkeypatch.setattr('acumos_proto_viewer.data._time_indexed', {})
     monkeypatch.setattr('time.time', lambda: 55555555555)
 
     msgb = fake_msg()
@@ -79,6 +89,7 @@ def test_inject_data(monkeypatch, monkeyed_requests_get, cleanuptmp,
     data.myredis = fakeredis.FakeStrictRedis()
     monkeypatch.setattr('acumos_proto_viewer.data.get_raw_data_source_count', lambda x, y: 0)
     monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'asdf0')
+    monkeypatch.setattr('acumos_proto_viewer.data._time_indexed', {})
     monkeypatch.setattr('time.time', lambda: 55555555555)
 
     assert(test_proto_mid not in data.list_known_protobufs())
@@ -94,3 +105,754 @@ def test_inject_data(monkeypatch, monkeyed_requests_get, cleanuptmp,
                         test_proto_with_arrays_mid, test_proto_with_arrays_msg)
 
     cleanuptmp()
+
+
+def _delimit(*msgs):
+    """Frames messages with varint length prefixes, like writeDelimitedTo"""
+    out = b""
+    for m in msgs:
+        size = len(m)
+        while size > 0x7f:
+            out += bytes([(size & 0x7f) | 0x80])
+            size >>= 7
+        out += bytes([size]) + m
+    return out
+
+
+def test_encode_data_batch(monkeypatch, monkeyed_requests_get,
+                           fake_msg, fake_msg_as_jsonwb,
+                           test_proto_url, test_proto_mid, test_proto_msg):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'asdf0')
+    monkeypatch.setattr('time.time', lambda: 55555555555)
+
+    register_proto_from_url(test_proto_url)
+    msgb = fake_msg()
+    # the third frame is not a Data1 message, the last one is truncated
+    body = _delimit(msgb, msgb, b"\xff\xff\xff") + b"\x40abc"
+    records, blobs, rejected = data.encode_data_batch(body, test_proto_mid, test_proto_msg)
+    assert (len(records), rejected) == (2, 2)
+    assert data.store_data(test_proto_mid, test_proto_msg, records, blobs) == 1
+    records = data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == [1, 2]
+    assert records[0] == fake_msg_as_jsonwb()
+
+    assert data.encode_data_batch(b"", test_proto_mid, test_proto_msg) == ([], {}, 0)
+    assert data.get_raw_data_source_count(test_proto_mid, test_proto_msg) == 2
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_msg_to_dict_nested(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                            test_proto_url, test_proto_mid, test_proto_with_arrays_url):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    register_proto_from_url(test_proto_url)
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_mid)
+    m = test.Data2()
+    m.a.c = 5
+    m.a.g = b'\x00\x01'
+    m.b["k"].d = 6
+    m.c["j"] = 7
+    m.d.add(d=8)
+    m.e.extend([9, 10])
+    d = data._msg_to_dict(m, 55555555555, 3)
+    assert d["a"]["c"] == 5
+    assert d["a"]["g"] == b'\x00\x01'
+    assert d["a"]["apv_sequence_number"] == 3
+    assert d["a"]["apv_received_at"] == 55555555555
+    # containers follow the protobuf JSON mapping, same as MessageToJson
+    assert d["b"] == {"k": {"d": "6"}}
+    assert d["c"] == {"j": 7}
+    assert d["d"] == [{"d": "8"}]
+    assert d["e"] == [9, 10]
+    assert d["apv_sequence_number"] == 3
+
+    cleanuptmp()
+
+
+def test_get_model_as_string(fake_msg_as_jsonwb, fake_msg_as_string,
+                             fake_msg_with_arrays_jsonwb, fake_msg_with_arrays_as_string):
+    rec = fake_msg_as_jsonwb()
+    assert data.get_model_as_string("mid", "Data1", rec) == fake_msg_as_string
+    # the rendering is not stored in the record
+    assert "apv_model_as_string" not in rec
+    # second read is served from the cache
+    assert data.get_model_as_string("mid", "Data1", {"apv_sequence_number": 1, "apv_received_at": 55555555555}) == fake_msg_as_string
+    assert data.get_model_as_string("mid", "ImageTagSet", fake_msg_with_arrays_jsonwb()) == fake_msg_with_arrays_as_string
+
+
+def test_inject_data_protobuf_format(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                                     fake_msg, fake_msg_with_arrays, fake_msg_as_jsonwb, fake_msg_with_arrays_jsonwb,
+                                     test_proto_url, test_proto_mid, test_proto_msg,
+                                     test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', 'protobuf')
+    monkeypatch.setattr('acumos_proto_viewer.data.get_raw_data_source_count', lambda x, y: 0)
+    monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'asdf0')
+    monkeypatch.setattr('time.time', lambda: 55555555555)
+
+    msgb = fake_msg_with_arrays()  # load_proto needs a registered model, fake_msg does not
+    assert data.inject_data(msgb, test_proto_with_arrays_url, test_proto_with_arrays_msg)
+    register_proto_from_url(test_proto_url)
+    assert data.inject_data(fake_msg(), test_proto_url, test_proto_msg)
+    # what is stored is the original message behind the header
+    index = data._get_raw_data_source_index(test_proto_mid, test_proto_msg)
+    assert data.myredis.lindex(index, 0).endswith(fake_msg())
+    # but readers see the same records as with the pickle format
+    assert data.get_raw_data(test_proto_mid, test_proto_msg, 0, 1) == [fake_msg_as_jsonwb()]
+    assert data.get_raw_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, 0, 1) == [fake_msg_with_arrays_jsonwb()]
+
+    data.myredis.flushall()
+    cleanuptmp()
+
+
+def test_record_format_memory(monkeypatch, monkeyed_requests_get,
+                              test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    """
+    Compares the redis footprint of the record formats on an int-heavy message
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+    n = 200
+    sizes = {}
+    for fmt in ["pickle", "binary", "protobuf"]:
+        monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', fmt)
+        monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: fmt)
+        for i in range(n):
+            m = test.ImageTagSet(image=list(range(i, i + 50)), tag=["tag"] * 5, score=[0.5] * 5)
+            data.inject_data(m.SerializeToString(), test_proto_with_arrays_url, test_proto_with_arrays_msg)
+        index = data._get_raw_data_source_index(test_proto_with_arrays_mid, test_proto_with_arrays_msg)
+        sizes[fmt] = sum(len(x) for x in data.myredis.lrange(index, 0, -1))
+        assert len(data.get_raw_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, 0, -1)) == n
+    per_million = {fmt: size * 1000000 // n for fmt, size in sizes.items()}
+    print("record bytes per million messages: {0}".format(per_million))
+    assert sizes["protobuf"] * 2 < sizes["pickle"]
+    assert sizes["binary"] * 3 < sizes["pickle"] * 2
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_inject_data_concurrent_sequence_numbers(monkeypatch, monkeyed_requests_get,
+                                                 test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'asdf0')
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+
+    def post(i):
+        msgb = test.ImageTagSet(image=[i]).SerializeToString()
+        data.inject_data(msgb, test_proto_with_arrays_url, test_proto_with_arrays_msg)
+
+    threads = [Thread(target=post, args=[i]) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    records = data.get_raw_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == list(range(1, 21))
+    assert sorted(int(r["image"][0]) for r in records) == list(range(20))
+    # reads relative to the end still number records by their position
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, -2, -1)] == [19, 20]
+    index = data._get_raw_data_source_index(test_proto_with_arrays_mid, test_proto_with_arrays_msg)
+    assert 0 < data.myredis.ttl(index) <= 60 * 60 * 24
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_inject_data_write_behind(monkeypatch, monkeyed_requests_get,
+                                  test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'asdf0')
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_RECORDS', 1000)
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_MS', 60000)
+    monkeypatch.setattr('acumos_proto_viewer.data._write_buffer', None)
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+
+    for i in range(5):
+        data.inject_data(test.ImageTagSet(image=[i]).SerializeToString(), test_proto_with_arrays_url, test_proto_with_arrays_msg)
+    # buffered, not yet in redis
+    assert data.get_raw_data_source_count(test_proto_with_arrays_mid, test_proto_with_arrays_msg) == 0
+    data.flush_data()
+    records = data.get_raw_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == [1, 2, 3, 4, 5]
+    assert [r["image"] for r in records] == [['0'], ['1'], ['2'], ['3'], ['4']]
+
+    # synchronous mode acknowledges after the flush and knows the sequence number
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_MS', 10)
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_SYNC', True)
+    monkeypatch.setattr('acumos_proto_viewer.data._write_buffer', None)
+    record, blobs = data.encode_data(test.ImageTagSet(image=[5]).SerializeToString(), test_proto_with_arrays_mid, test_proto_with_arrays_msg)
+    assert blobs == {}
+    assert data.store_data(test_proto_with_arrays_mid, test_proto_with_arrays_msg, [record]) == 6
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_retention_days(monkeypatch, monkeyed_requests_get,
+                        test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    """
+    Positions continue across midnight and reads span the day buckets of the look-back
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    today = [1]
+    monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'day{0}'.format(today[0]))
+    monkeypatch.setattr('acumos_proto_viewer.data._get_buckets', lambda: ['day{0}'.format(today[0] - d) for d in range(3)])
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+    mid, msg = test_proto_with_arrays_mid, test_proto_with_arrays_msg
+
+    def post(n):
+        for _ in range(n):
+            i = data.get_raw_data_source_count(mid, msg)
+            data.inject_data(test.ImageTagSet(image=[i]).SerializeToString(), test_proto_with_arrays_url, msg)
+
+    post(3)
+    today[0] = 2
+    post(2)
+    records = data.get_raw_data(mid, msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == [1, 2, 3, 4, 5]
+    assert [r["image"] for r in records] == [['0'], ['1'], ['2'], ['3'], ['4']]
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, 2, 3)] == [3, 4]
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, -3, -1)] == [3, 4, 5]
+    assert data.get_raw_data(mid, msg, 5, -1) == []
+
+    # a bucket whose base is not recorded yet ends where the next one starts
+    data.myredis.delete(data._get_base_key(data._get_bucket_index(mid, msg, 'day2')))
+    assert [r["image"] for r in data.get_raw_data(mid, msg, 2, 4)] == [['2'], ['3'], ['4']]
+
+    # day 1 is out of the look-back on day 4, but positions stay
+    today[0] = 4
+    post(1)
+    assert data.get_raw_data_source_count(mid, msg) == 6
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, 0, -1)] == [4, 5, 6]
+    assert 0 < data.myredis.ttl(data._get_raw_data_source_index(mid, msg)) <= data._DAY_TTL
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_get_raw_columns(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                         test_proto_url, test_proto_mid, test_proto_msg, test_proto_with_arrays_url):
+    """
+    Fields in columns are read without reading the records
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    today = [1]
+    monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'day{0}'.format(today[0]))
+    monkeypatch.setattr('acumos_proto_viewer.data._get_buckets', lambda: ['day{0}'.format(today[0] - d) for d in range(3)])
+    register_proto_from_url(test_proto_url)
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_mid)
+    mid, msg = test_proto_mid, test_proto_msg
+
+    def post(values):
+        for c in values:
+            data.inject_data(test.Data1(a=c / 2, c=c, d=-c, e=c % 2 == 1, f="x" * c).SerializeToString(), test_proto_url, msg)
+
+    # written before the columns were switched on, so read from the records
+    post([1, 2])
+    monkeypatch.setattr('acumos_proto_viewer.data.COLUMN_STORE', True)
+    post([3])
+    today[0] = 2
+    post([4])
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', 'protobuf')
+    post([5, 6])
+
+    index = data._get_raw_data_source_index(mid, msg)
+    assert data.myredis.strlen(data._get_column_key(index, "c")) == 3 * 4
+    expected = {"c": [2, 3, 4, 5, 6], "a": [1.0, 1.5, 2.0, 2.5, 3.0], "e": [False, True, False, True, False],
+                "apv_sequence_number": [2, 3, 4, 5, 6]}
+    decoded = []
+    decode_record = data._decode_record
+    monkeypatch.setattr('acumos_proto_viewer.data._decode_record', lambda *args: decoded.append(args) or decode_record(*args))
+    assert data.get_raw_columns(mid, msg, ["c", "a", "e"], 1, -1) == expected
+    assert len(decoded) == 2  # the bucket of day 1 has incomplete columns
+    assert data.get_raw_columns(mid, msg, ["apv_received_at", "c"], 3, 4)["c"] == [4, 5]
+    assert data.get_raw_columns(mid, msg, ["c", "apv_sequence_number"], -1, -1) == {"c": [6], "apv_sequence_number": [6]}
+    assert data.get_raw_columns(mid, msg, ["c"], 6, -1) == {"c": [], "apv_sequence_number": []}
+    assert len(decoded) == 2
+    # a string field is not in a column, so the records are read
+    assert data.get_raw_columns(mid, msg, ["c", "f"], 4, -1) == {"c": [5, 6], "f": ["xxxxx", "xxxxxx"], "apv_sequence_number": [5, 6]}
+    assert len(decoded) == 4
+    # with the accessors compiled when the message was registered; unknown fields get theirs compiled
+    accessors = data.get_field_accessors(mid, msg, ["f", "g.x"])
+    assert accessors["f"] is data.proto_data_structure[mid]["messages"][msg]["accessors"]["f"]
+    assert accessors["g.x"]({"g": {"x": 7}}) == 7
+
+    data.myredis.flushall()
+    cleanuptmp()
+
+
+def test_rollups(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                 test_proto_url, test_proto_mid, test_proto_msg):
+    """
+    Numeric fields are rolled up at ingest, whatever the record format and backend
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data.ROLLUPS', True)
+    monkeypatch.setattr('acumos_proto_viewer.data._rollups', {})
+    now = [55555555555]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    register_proto_from_url(test_proto_url)
+    test = load_proto(test_proto_mid)
+    mid, msg = test_proto_mid, test_proto_msg
+
+    def post(values):
+        for c in values:
+            data.inject_data(test.Data1(a=c / 2, c=c, e=True, f="x").SerializeToString(), test_proto_url, msg)
+
+    assert data.get_rollups(mid, msg, ["c"], 0, now[0], 800) is None
+    post([1, 2])
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', 'protobuf')
+    post([3])
+    now[0] += 1
+    post([4])
+    # the rows carried for the rollups are not stored
+    assert [r["c"] for r in data.get_raw_data(mid, msg, 0, -1)] == [1, 2, 3, 4]
+    assert data.myredis.keys("*_col_*") == []
+
+    result = data.get_rollups(mid, msg, ["c", "a"], now[0] - 1, now[0], 800)
+    assert result["resolution"] == 1
+    assert result["apv_received_at"] == [now[0] - 1, now[0]]
+    assert result["count"] == [3, 1]
+    assert result["fields"]["c"] == {"min": [1, 4], "max": [3, 4], "mean": [2, 4], "last": [3, 4]}
+    assert result["fields"]["a"]["mean"] == [1.0, 2.0]
+    with pytest.raises(KeyError):
+        data.get_rollups(mid, msg, ["f"], 0, now[0], 800)
+
+    monkeypatch.setattr('acumos_proto_viewer.data._backend', MemoryBackend(10))
+    now[0] += 1
+    post([5, 7])
+    assert data.get_rollups(mid, msg, ["c"], now[0], now[0], 800)["fields"]["c"]["mean"] == [6]
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_segment_backend(monkeypatch, monkeyed_requests_get, tmp_path,
+                         test_proto_url, test_proto_mid, test_proto_msg):
+    """
+    The disk backend stores encoded records, without the rows carried for the rollups, and blobs
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('acumos_proto_viewer.data.myredis', None)
+    monkeypatch.setattr('acumos_proto_viewer.data._backend', SegmentBackend(str(tmp_path), 4096, 3600, 0))
+    monkeypatch.setattr('acumos_proto_viewer.data.ROLLUPS', True)
+    monkeypatch.setattr('acumos_proto_viewer.data._rollups', {})
+    monkeypatch.setattr('acumos_proto_viewer.data.BLOB_THRESHOLD', 100)
+    register_proto_from_url(test_proto_url)
+    test = load_proto(test_proto_mid)
+    mid, msg = test_proto_mid, test_proto_msg
+
+    for c in range(100):
+        data.inject_data(test.Data1(c=c, g=b"i" * 200).SerializeToString(), test_proto_url, msg)
+    records = data.get_raw_data(mid, msg, 0, -1)
+    assert [r["c"] for r in records] == list(range(100))
+    assert [r["apv_sequence_number"] for r in records] == list(range(1, 101))
+    assert data.get_blob(records[0]["g"]) == b"i" * 200
+    assert data.get_rollups(mid, msg, ["c"], 0, 2 ** 40, 10)["fields"]["c"]["max"][-1] == 99
+    _, raw = data.get_backend().read(mid, msg, 0, 0)
+    assert raw[0][:1] != data._COLUMN_MARKER
+
+    del data.proto_data_structure[test_proto_mid]
+
+
+@pytest.mark.parametrize("storage", ["daily", "ring", "stream", "memory", "disk"])
+def test_get_raw_data_by_time(monkeypatch, monkeyed_requests_get, tmp_path, storage,
+                              test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    """
+    Time ranges are located with the time index of every backend
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    if storage == "memory":
+        monkeypatch.setattr('acumos_proto_viewer.data._backend', MemoryBackend(100))
+    elif storage == "disk":
+        monkeypatch.setattr('acumos_proto_viewer.data._backend', SegmentBackend(str(tmp_path), 4096, 10 ** 12, 0))
+    else:
+        monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MODE', storage)
+        monkeypatch.setattr('acumos_proto_viewer.data._get_bucket', lambda: 'day')
+        monkeypatch.setattr('acumos_proto_viewer.data._get_buckets', lambda: ['day'])
+    monkeypatch.setattr('acumos_proto_viewer.data._ring_totals', {})
+    monkeypatch.setattr('acumos_proto_viewer.data._time_indexed', {})
+    now = [1000]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+    mid, msg = test_proto_with_arrays_mid, test_proto_with_arrays_msg
+
+    def post(i):
+        data.inject_data(test.ImageTagSet(image=[i]).SerializeToString(), test_proto_with_arrays_url, msg)
+
+    def images(t0, t1):
+        return [int(r["image"][0]) for r in data.get_raw_data_by_time(mid, msg, t0, t1)]
+
+    assert images(0, 2000) == []
+    # three records a second from 1000 to 1009, none from 1010 to 1019, then one at 1020
+    for i in range(30):
+        now[0] = 1000 + i // 3
+        post(i)
+    now[0] = 1020
+    post(30)
+    # received at 1020, written two seconds later
+    record, blobs = data.encode_data(test.ImageTagSet(image=[31]).SerializeToString(), mid, msg)
+    now[0] = 1022
+    data.store_data(mid, msg, [record], blobs)
+
+    assert images(1000, 1000) == [0, 1, 2]
+    assert images(1003, 1004) == [9, 10, 11, 12, 13, 14]
+    assert images(1009, 1015) == [27, 28, 29]
+    assert images(1011, 1015) == []
+    assert images(1015, 1030) == [30, 31]
+    assert images(0, 999) == []
+    assert images(0, 2000) == list(range(32))
+    located = data.get_backend().locate(mid, msg, 1005, 1006)
+    assert located == (15, 20)
+
+    # with a long flush delay records are written up to that much after they are received
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_MS', 30000)
+    now[0] = 1040
+    record, blobs = data.encode_data(test.ImageTagSet(image=[32]).SerializeToString(), mid, msg)
+    now[0] = 1060
+    data.store_data(mid, msg, [record], blobs)
+    now[0] = 1061
+    post(33)
+    assert images(1040, 1040) == [32]
+    assert images(1035, 1059) == [32]
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_ring_retention(monkeypatch, monkeyed_requests_get,
+                        test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    """
+    A ring keeps the latest records of a stream and keeps numbering them
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MODE', 'ring')
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MAX_RECORDS', 4)
+    monkeypatch.setattr('acumos_proto_viewer.data._ring_totals', {})
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+    mid, msg = test_proto_with_arrays_mid, test_proto_with_arrays_msg
+
+    for i in range(10):
+        data.inject_data(test.ImageTagSet(image=[i]).SerializeToString(), test_proto_with_arrays_url, msg)
+    index = data._get_raw_data_source_index(mid, msg)
+    assert data.myredis.llen(index) == 4
+    assert data.myredis.ttl(index) == -1  # no midnight reset
+    assert data.get_raw_data_source_count(mid, msg) == 10
+    records = data.get_raw_data(mid, msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == [7, 8, 9, 10]
+    assert [r["image"] for r in records] == [['6'], ['7'], ['8'], ['9']]
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, 7, 8)] == [8, 9]
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, -2, -1)] == [9, 10]
+    assert data.get_raw_data(mid, msg, 2, 4) == []  # trimmed
+    assert data.get_raw_data(mid, msg, 10, -1) == []  # nothing new
+
+    # many records since the last read: the window is widened and read again
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MAX_RECORDS', 1000)
+    records = [data.encode_data(test.ImageTagSet(image=[i]).SerializeToString(), mid, msg)[0] for i in range(10, 300)]
+    assert data.store_data(mid, msg, records) == 11
+    records = data.get_raw_data(mid, msg, 10, 12)
+    assert [r["apv_sequence_number"] for r in records] == [11, 12, 13]
+    assert [r["image"] for r in records] == [['10'], ['11'], ['12']]
+    assert len(data.get_raw_data(mid, msg, 6, -1)) == 294
+
+    # the byte cap takes over when records are large
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MAX_BYTES', 10 * len(records[0]))
+    monkeypatch.setattr('acumos_proto_viewer.data._record_sizes', {})
+    data.inject_data(test.ImageTagSet(image=[300]).SerializeToString(), test_proto_with_arrays_url, msg)
+    assert data.myredis.llen(index) <= 10
+    assert data.get_raw_data(mid, msg, -1, -1)[0]["apv_sequence_number"] == 301
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_ring_retention_write_behind(monkeypatch, monkeyed_requests_get,
+                                     test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MODE', 'ring')
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MAX_RECORDS', 3)
+    monkeypatch.setattr('acumos_proto_viewer.data._ring_totals', {})
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_RECORDS', 1000)
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_MS', 10)
+    monkeypatch.setattr('acumos_proto_viewer.data.INGEST_FLUSH_SYNC', True)
+    monkeypatch.setattr('acumos_proto_viewer.data._write_buffer', None)
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+    mid, msg = test_proto_with_arrays_mid, test_proto_with_arrays_msg
+
+    for i in range(5):
+        record, _ = data.encode_data(test.ImageTagSet(image=[i]).SerializeToString(), mid, msg)
+        assert data.store_data(mid, msg, [record]) == i + 1
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, 0, -1)] == [3, 4, 5]
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_stream_retention(monkeypatch, monkeyed_requests_get,
+                          test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    """
+    A Redis stream keeps the latest records, numbered like a ring, and wakes readers
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MODE', 'stream')
+    monkeypatch.setattr('acumos_proto_viewer.data._ring_totals', {})
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_with_arrays_mid)
+    mid, msg = test_proto_with_arrays_mid, test_proto_with_arrays_msg
+
+    def post(i):
+        data.inject_data(test.ImageTagSet(image=[i]).SerializeToString(), test_proto_with_arrays_url, msg)
+
+    assert not data.wait_for_data(mid, msg, 0, 10)
+    for i in range(10):
+        post(i)
+    index = data._get_raw_data_source_index(mid, msg)
+    assert data.myredis.xlen(index) == 10
+    assert data.get_raw_data_source_count(mid, msg) == 10
+    records = data.get_raw_data(mid, msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == list(range(1, 11))
+    assert [r["image"] for r in records] == [[str(i)] for i in range(10)]
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, 7, 8)] == [8, 9]
+    assert [r["apv_sequence_number"] for r in data.get_raw_data(mid, msg, -2, -1)] == [9, 10]
+    assert data.get_raw_data(mid, msg, 10, -1) == []
+
+    # a batch written since the last read is found by widening the read
+    records = [data.encode_data(test.ImageTagSet(image=[i]).SerializeToString(), mid, msg)[0] for i in range(10, 300)]
+    assert data.store_data(mid, msg, records) == 11
+    assert [r["image"] for r in data.get_raw_data(mid, msg, 10, 11)] == [['10'], ['11']]
+
+    # waiting readers are woken by writers
+    assert data.wait_for_data(mid, msg, 299, 10)
+    assert not data.wait_for_data(mid, msg, 300, 10)
+    writer = Thread(target=lambda: (time.sleep(0.1), post(300)))
+    writer.start()
+    started = time.monotonic()
+    assert data.wait_for_data(mid, msg, 300, 5000)
+    assert time.monotonic() - started < 4
+    writer.join()
+    assert data.get_raw_data(mid, msg, 300, -1)[0]["image"] == ['300']
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_with_arrays_mid]
+
+
+def test_memory_backend(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                        fake_msg, fake_msg_as_jsonwb, test_proto_url, test_proto_mid, test_proto_msg,
+                        test_probe_fake_schema_url):
+    """
+    The in-process backend keeps the converted dicts; redis is never used
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('acumos_proto_viewer.data.myredis', None)
+    monkeypatch.setattr('acumos_proto_viewer.data._backend', MemoryBackend(3))
+    monkeypatch.setattr('time.time', lambda: 55555555555)
+
+    for _ in range(4):
+        data.inject_data(fake_msg(), test_proto_url, test_proto_msg)
+    assert data.get_raw_data_source_count(test_proto_mid, test_proto_msg) == 4
+    records = data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)
+    assert [r["apv_sequence_number"] for r in records] == [2, 3, 4]
+    expected = fake_msg_as_jsonwb()
+    del expected["apv_sequence_number"]
+    assert all({k: v for k, v in r.items() if k != "apv_sequence_number"} == expected for r in records)
+    assert data.get_raw_columns(test_proto_mid, test_proto_msg, ["c"], 3, -1) == {"c": [777], "apv_sequence_number": [4]}
+    assert data.wait_for_data(test_proto_mid, test_proto_msg, 3, 10)
+    assert not data.wait_for_data(test_proto_mid, test_proto_msg, 4, 10)
+    # reads number copies, the stored dicts are left alone
+    assert data.get_raw_data(test_proto_mid, test_proto_msg, -1, -1)[0]["apv_sequence_number"] == 4
+
+    # message router subscriptions keep their flag in the backend too
+    topic_name = "memory_topic"
+    data.register_jsonschema_from_url(test_probe_fake_schema_url, topic_name)
+    assert data.get_backend().set_flag(topic_name)
+
+    def fake_poll(url):
+        data.delete_mr_subscription(topic_name)  # one poll only
+        return FakeResponse(200, json.dumps([json.dumps({"value": i}) for i in range(2)]))
+
+    monkeypatch.setattr('requests.get', fake_poll)
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    data.mr_reader_thread("http://foo:666/events/memory_topic", topic_name)
+    assert [r["value"] for r in data.get_raw_data(topic_name, topic_name + "_messages", 0, -1)] == [0, 1]
+    assert not data.delete_mr_subscription(topic_name)
+
+    del data.jsonschema_data_structure[topic_name]
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_inject_data_blobs(monkeypatch, monkeyed_requests_get, test_proto_url, test_proto_mid, test_proto_msg):
+    """
+    Large bytes fields are stored once per content, outside of the records
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('acumos_proto_viewer.data.BLOB_THRESHOLD', 8)
+    data.myredis = fakeredis.FakeStrictRedis()
+    register_proto_from_url(test_proto_url)
+    test = load_proto(test_proto_mid)
+    image = b"\x89PNG" + bytes(range(256)) * 4
+    for g in [image, image, b"tiny"]:
+        assert data.inject_data(test.Data1(g=g).SerializeToString(), test_proto_url, test_proto_msg)
+
+    # two records refer to one blob, the small field stays inline
+    digest = hashlib.sha256(image).hexdigest()
+    assert data.myredis.keys("apv_blob_*") == [data._blob_key(digest).encode()]
+    records = data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)
+    assert records[0]["g"] == data.BlobRef(digest, len(image))
+    assert records[1]["g"] == records[0]["g"]
+    assert records[2]["g"] == b"tiny"
+    assert data.get_blob(records[0]["g"]) == image
+    assert data.get_blob(digest) == image
+    assert '"g": "<RAW BYTES>"' in data.get_model_as_string(test_proto_mid, test_proto_msg, records[0])
+    assert data.myredis.ttl(data._blob_key(digest)) > 60 * 60 * 24
+
+    # a batch stores each distinct blob once
+    body = _delimit(test.Data1(g=image).SerializeToString(), test.Data1(g=image[::-1]).SerializeToString())
+    records, blobs, rejected = data.encode_data_batch(body, test_proto_mid, test_proto_msg)
+    assert (len(records), len(blobs), rejected) == (2, 2, 0)
+    data.store_data(test_proto_mid, test_proto_msg, records, blobs)
+    assert len(data.myredis.keys("apv_blob_*")) == 2
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_ring_retention_blobs(monkeypatch, monkeyed_requests_get, test_proto_url, test_proto_mid, test_proto_msg):
+    """
+    A ring keeps large bytes fields in its records, so trimming it frees them
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('acumos_proto_viewer.data.BLOB_THRESHOLD', 8)
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MODE', 'ring')
+    monkeypatch.setattr('acumos_proto_viewer.data.RETENTION_MAX_RECORDS', 4)
+    monkeypatch.setattr('acumos_proto_viewer.data._ring_totals', {})
+    data.myredis = fakeredis.FakeStrictRedis()
+    register_proto_from_url(test_proto_url)
+    test = load_proto(test_proto_mid)
+    images = [bytes([i]) * 20000 for i in range(50)]
+    for g in images:
+        assert data.inject_data(test.Data1(g=g).SerializeToString(), test_proto_url, test_proto_msg)
+
+    assert data.myredis.llen(data._get_raw_data_source_index(test_proto_mid, test_proto_msg)) == 4
+    assert data.myredis.keys("apv_blob_*") == []
+    assert [r["g"] for r in data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)] == images[-4:]
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_inject_data_compressed(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                                fake_msg, fake_msg_as_jsonwb, fake_msg_with_arrays,
+                                test_proto_url, test_proto_mid, test_proto_msg,
+                                test_proto_with_arrays_url, test_proto_with_arrays_mid, test_proto_with_arrays_msg):
+    """
+    Records are compressed per model and read back transparently, in both record formats
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('time.time', lambda: 55555555555)
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_COMPRESSION', 'zlib')
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_COMPRESSION_MIN_BYTES', 0)
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_COMPRESSION_MODELS', {test_proto_with_arrays_mid: "none"})
+    register_proto_from_url(test_proto_url)
+    test = load_proto(test_proto_mid)
+    wordy = test.Data1(f="helives " * 100).SerializeToString()
+    for fmt in ["pickle", "protobuf"]:
+        data.myredis = fakeredis.FakeStrictRedis()
+        monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', fmt)
+        assert data.inject_data(wordy, test_proto_url, test_proto_msg)
+        assert data.inject_data(fake_msg(), test_proto_url, test_proto_msg)  # too short to shrink
+        assert data.inject_data(fake_msg_with_arrays(), test_proto_with_arrays_url, test_proto_with_arrays_msg)
+        index = data._get_raw_data_source_index(test_proto_mid, test_proto_msg)
+        assert data.myredis.lindex(index, 0)[:2] == b"Z\x01"
+        assert data.myredis.lindex(index, 1)[:1] != b"Z"
+        records = data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)
+        assert records[0]["f"] == "helives " * 100
+        expected = fake_msg_as_jsonwb()
+        expected["apv_sequence_number"] = 2
+        assert records[1] == expected
+        # this model is excluded
+        stored = data.myredis.lindex(data._get_raw_data_source_index(test_proto_with_arrays_mid, test_proto_with_arrays_msg), 0)
+        assert stored[:1] != b"Z"
+    data.myredis.flushall()
+    cleanuptmp()
+
+
+def test_mr_reader_thread_compressed(monkeypatch, monkeyed_requests_get, test_probe_fake_schema_url):
+    """
+    Records from a message router topic are compressed like protobuf ones, and are json in any RECORD_FORMAT
+    """
+    topic_name = "compressed_topic"
+    data.myredis = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', 'pickle')
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('time.sleep', lambda s: None)
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_COMPRESSION_MIN_BYTES', 0)
+    monkeypatch.setattr('acumos_proto_viewer.data.RECORD_COMPRESSION_MODELS', {topic_name: "zlib"})
+    data.register_jsonschema_from_url(test_probe_fake_schema_url, topic_name)
+    data.myredis.set(topic_name, 1)
+
+    def fake_poll(url):
+        data.myredis.delete(topic_name)  # one poll only
+        return FakeResponse(200, json.dumps([json.dumps({"value": i, "note": "compressible " * 20}) for i in range(3)]))
+
+    monkeypatch.setattr('requests.get', fake_poll)
+    data.mr_reader_thread("http://foo:666/events/compressed_topic", topic_name)
+    message_name = "{0}_messages".format(topic_name)
+    stored = data.myredis.lindex(data._get_raw_data_source_index(topic_name, message_name), 0)
+    assert stored[:2] == b"Z\x01"
+    assert data.decompress(stored)[:1] == b"J"
+    assert [r["value"] for r in data.get_raw_data(topic_name, message_name, 0, -1)] == [0, 1, 2]
+    data.myredis.flushall()
+    del data.jsonschema_data_structure[topic_name]
+
+
+def test_record_formats_mixed(monkeypatch, monkeyed_requests_get, fake_msg, fake_msg_as_jsonwb,
+                              test_proto_url, test_proto_mid, test_proto_msg):
+    """
+    A list written by writers of different formats, as during an upgrade, reads back uniformly
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('time.time', lambda: 55555555555)
+    data.myredis = fakeredis.FakeStrictRedis()
+    register_proto_from_url(test_proto_url)
+    for fmt in ["pickle", "binary", "protobuf"]:
+        monkeypatch.setattr('acumos_proto_viewer.data.RECORD_FORMAT', fmt)
+        assert data.inject_data(fake_msg(), test_proto_url, test_proto_msg)
+    index = data._get_raw_data_source_index(test_proto_mid, test_proto_msg)
+    assert [x[:1] for x in data.myredis.lrange(index, 0, -1)] == [b"\x80", b"S", b"P"]
+    # the pickle of the former writer is refused, unless the writers are trusted
+    with pytest.raises(ValueError):
+        data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)
+    assert len(data.get_raw_data(test_proto_mid, test_proto_msg, 1, -1)) == 2
+    monkeypatch.setattr('acumos_proto_viewer.data.ALLOW_PICKLE_RECORDS', True)
+    records = data.get_raw_data(test_proto_mid, test_proto_msg, 0, -1)
+    for seq, record in enumerate(records, 1):
+        expected = fake_msg_as_jsonwb()
+        expected["apv_sequence_number"] = seq
+        assert record == expected
+
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_mid]
@@ -0,0 +1,61 @@
+# Acumos - Apache 2.0
+
+
+import numpy
+import pytest
+from acumos_proto_viewer.downsample import Decimator, LTTB, MINMAX
+
+
+def _draw(decimator, xs, ys, chunk):
+    """
+    Feeds a series to a decimator chunk points at a time, answers the points drawn
+    """
+    drawn_x, drawn_y = [], []
+    for i in range(0, len(xs), chunk):
+        redraw, (dx, dy) = decimator.add(xs[i:i + chunk], ys[i:i + chunk])
+        if redraw:
+            drawn_x, drawn_y = [], []
+        drawn_x.extend(dx.tolist())
+        drawn_y.extend(dy.tolist())
+    return drawn_x, drawn_y
+
+
+def test_few_points():
+    decimator = Decimator(100, 1000)
+    assert _draw(decimator, list(range(50)), list(range(50)), 7) == (list(range(50)), list(range(50)))
+
+
+@pytest.mark.parametrize("method", [LTTB, MINMAX])
+def test_decimator(method):
+    xs = numpy.arange(5000, dtype="float64")
+    ys = numpy.sin(xs / 100.0)
+    ys[1234] = 10.0  # a spike, which must be drawn
+    ys[4321] = -10.0
+    drawn_x, drawn_y = _draw(Decimator(200, 10000, method), xs, ys, 37)
+    assert len(drawn_x) <= 200 + 64
+    assert drawn_x == sorted(drawn_x)
+    assert drawn_x[0] == 0.0 and drawn_x[-1] == 4999.0
+    assert 10.0 in drawn_y and -10.0 in drawn_y
+    # the picks kept along the way are those of decimating the whole series at once, but for
+    # the last complete bucket, which LTTB picks against the incomplete one; buckets are 32 points
+    whole_x, whole_y = _draw(Decimator(200, 10000, method), xs, ys, 5000)
+    assert (whole_x[:-33], whole_y[:-33]) == (drawn_x[:-33], drawn_y[:-33])
+
+
+def test_decimator_window():
+    xs = numpy.arange(20000, dtype="float64")
+    drawn_x, _ = _draw(Decimator(100, 1000), xs, numpy.cos(xs), 333)
+    assert len(drawn_x) <= 100 + 16
+    assert drawn_x == sorted(drawn_x)
+    assert drawn_x[0] == 19000.0 and drawn_x[-1] == 19999.0
+
+
+def test_decimator_gaps():
+    xs = numpy.arange(1000, dtype="float64")
+    ys = numpy.cos(xs / 50.0)
+    ys[100:300] = numpy.nan  # missing values, e.g., of an optional field
+    drawn_x, drawn_y = _draw(Decimator(100, 1000), xs, ys, 1000)
+    assert drawn_x == sorted(drawn_x)
+    # the buckets with values draw one of them, those in the gap draw a gap
+    assert all(100 <= x < 300 for x, y in zip(drawn_x, drawn_y) if numpy.isnan(y))
+    assert any(numpy.isnan(drawn_y))
@@ -0,0 +1,103 @@
+# Acumos - Apache 2.0
+
+
+import pytest
+from queue import Queue
+from acumos_proto_viewer import data
+from acumos_proto_viewer.hub import StreamHub
+from acumos_proto_viewer.storage import MemoryBackend
+
+
+class _PollingBackend(MemoryBackend):
+    wakes_readers = False
+
+
+@pytest.mark.parametrize("backend", [MemoryBackend(100), _PollingBackend(100)])
+def test_stream_hub(monkeypatch, backend):
+    monkeypatch.setattr('acumos_proto_viewer.data._backend', backend)
+    reads = []
+    get_raw_data = data.get_raw_data
+
+    def counted_get_raw_data(*args):
+        records = get_raw_data(*args)
+        if records:
+            reads.append(args[2:])
+        return records
+
+    monkeypatch.setattr('acumos_proto_viewer.data.get_raw_data', counted_get_raw_data)
+
+    def post(values):
+        data.store_data("m", "a", [{"apv_received_at": 1, "v": v} for v in values])
+
+    def received(queue):
+        batch = queue.get(timeout=5)
+        return [r["v"] for r in batch]
+
+    post([0, 1])
+    hub = StreamHub(20, 100)
+    queues = [Queue() for _ in range(3)]
+    subscriptions = [hub.subscribe("m", "a", None, 0, queues[0].put), hub.subscribe("m", "a", None, 0, queues[1].put)]
+    # the history is read for each new subscriber
+    assert received(queues[0]) == [0, 1]
+    assert received(queues[1]) == [0, 1]
+    assert hub.pollers() == [("m", "a", None)]
+    del reads[:]
+
+    # new records are read once, and the same batch goes to every subscriber
+    post([2, 3])
+    assert received(queues[0]) == [2, 3]
+    assert received(queues[1]) == [2, 3]
+    assert reads == [(2, 101)]
+
+    # a subscriber that is up to date only gets the new records
+    subscriptions.append(hub.subscribe("m", "a", None, 4, queues[2].put))
+    post([4])
+    for queue in queues:
+        assert received(queue) == [4]
+
+    # a failing subscriber is dropped, the others go on
+    subscriptions[1].deliver = None
+    post([5])
+    assert received(queues[0]) == [5]
+    assert received(queues[2]) == [5]
+    post([6])
+    assert received(queues[0]) == [6]
+    assert queues[1].empty()
+
+    # the poller exits with its last subscriber
+    for subscription in subscriptions:
+        subscription.cancel()
+    for _ in range(500):
+        if not hub.pollers():
+            break
+        data.wait_for_data("m", "a", 10 ** 6, 10)
+    assert hub.pollers() == []
+
+
+def test_stream_hub_columns(monkeypatch):
+    monkeypatch.setattr('acumos_proto_viewer.data._backend', MemoryBackend(100))
+    data.store_data("m", "b", [{"apv_received_at": 1, "x": x, "y": -x} for x in range(3)])
+    hub = StreamHub(20, 100)
+    queue = Queue()
+    subscription = hub.subscribe("m", "b", ["x", "y"], 1, queue.put)
+    assert queue.get(timeout=5) == {"x": [1, 2], "y": [-1, -2], "apv_sequence_number": [2, 3]}
+    data.store_data("m", "b", [{"apv_received_at": 1, "x": 3, "y": -3}])
+    assert queue.get(timeout=5) == {"x": [3], "y": [-3], "apv_sequence_number": [4]}
+    subscription.cancel()
+
+
+@pytest.mark.parametrize("backend", [MemoryBackend(1000), _PollingBackend(1000)])
+def test_stream_hub_batches(monkeypatch, backend):
+    monkeypatch.setattr('acumos_proto_viewer.data._backend', backend)
+    data.store_data("m", "c", [{"apv_received_at": 1, "v": v} for v in range(25)])
+    hub = StreamHub(20, 10)
+    behind, live = Queue(), Queue()
+    subscriptions = [hub.subscribe("m", "c", None, 0, behind.put), hub.subscribe("m", "c", None, 25, live.put)]
+    # a backlog comes at most 10 records at a time, over several ticks
+    assert [[r["v"] for r in behind.get(timeout=5)] for _ in range(3)] == [list(range(10)), list(range(10, 20)), list(range(20, 25))]
+    # so do new records that arrive faster than that
+    data.store_data("m", "c", [{"apv_received_at": 1, "v": v} for v in range(25, 40)])
+    for queue in (behind, live):
+        assert [[r["v"] for r in queue.get(timeout=5)] for _ in range(2)] == [list(range(25, 35)), list(range(35, 40))]
+    for subscription in subscriptions:
+        subscription.cancel()
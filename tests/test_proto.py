@@ -2,7 +2,7 @@
 
 
 from types import ModuleType
-from acumos_proto_viewer.utils import register_proto_from_url, load_proto, _protobuf_to_js, get_message_data
+from acumos_proto_viewer.utils import register_proto_from_url, load_proto, _protobuf_to_js, get_message_data, compile_field_accessor, get_messages_data
 from acumos_proto_viewer import data
 
 
@@ -155,3 +155,18 @@ def test_get_message_data():
     }
     assert 1 == get_message_data(pbmsg, "i")
     assert 3 == get_message_data(pbmsg, "k.x")
+
+
+def test_compile_field_accessor():
+    pbmsg = {
+        "i": 1,
+        "k": {
+            "x": 3,
+            "y": 4
+        },
+        "d.e": 5
+    }
+    # the compiled accessors agree with get_message_data, missing fields and dotted keys included
+    for field_name in ["i", "k", "k.x", "k.z", "j", "j.x", "d.e"]:
+        assert compile_field_accessor(field_name)(pbmsg) == get_message_data(pbmsg, field_name)
+    assert get_messages_data([pbmsg, {"k": {"x": 7}}, {}], "k.x") == [3, 7, None]
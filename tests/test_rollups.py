@@ -0,0 +1,72 @@
+# Acumos - Apache 2.0
+
+
+import pytest
+from acumos_proto_viewer.utils import load_proto, register_proto_from_url
+from acumos_proto_viewer import columns, data, rollups
+
+
+def test_rollup(monkeypatch, monkeyed_requests_get, cleanuptmp, test_proto_url, test_proto_mid):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    register_proto_from_url(test_proto_url)
+    layout = columns.get_layout(load_proto(test_proto_mid).Data1.DESCRIPTOR)
+    rollup = rollups.Rollup(layout, 4)
+    assert rollup.fields == ["a", "b", "c", "d"]  # no bools
+
+    # rows are (apv_received_at, a, b, c, d, e)
+    rollup.add([(1000, 1.0, 0.0, 5, 0, True), (1000, 3.0, 0.0, -5, 0, False), (1001, 2.0, 0.0, 7, 0, True)])
+    rollup.add([(1009, 10.0, 0.0, 1, 0, True), (1010, 4.0, 0.0, 2, 0, True)])
+
+    # a short range is read from the 1 s tier
+    result = rollup.read(["a", "c"], 1000, 1001, 800)
+    assert result["resolution"] == 1
+    assert result["apv_received_at"] == [1000, 1001]
+    assert result["count"] == [2, 1]
+    assert result["fields"]["a"] == {"min": [1.0, 2.0], "max": [3.0, 2.0], "mean": [2.0, 2.0], "last": [3.0, 2.0]}
+    assert result["fields"]["c"]["last"] == [-5, 7]
+
+    # buckets that overlap the range are included
+    result = rollup.read(["a"], 1005, 1100, 10)
+    assert result["resolution"] == 10
+    assert result["apv_received_at"] == [1000, 1010]
+    assert result["count"] == [4, 1]
+    assert result["fields"]["a"] == {"min": [1.0, 4.0], "max": [10.0, 4.0], "mean": [4.0, 4.0], "last": [10.0, 4.0]}
+    assert rollup.read(["a"], 0, 100000, 10)["resolution"] == 60
+
+    # the 1 s tier keeps 4 buckets, so it no longer covers 1000; late records of dropped buckets only go to the coarser tiers
+    rollup.add([(1011, 0.0, 0.0, 0, 0, True), (1012, 0.0, 0.0, 0, 0, True)])
+    rollup.add([(1000, 100.0, 0.0, 0, 0, True)])
+    result = rollup.read(["a"], 1000, 1012, 800)
+    assert result["resolution"] == 10
+    assert result["count"] == [5, 3]
+    assert result["fields"]["a"]["max"] == [100.0, 4.0]
+    assert rollup.read(["a"], 1009, 1012, 800)["apv_received_at"] == [1009, 1010, 1011, 1012]
+
+    assert rollup.read(["a"], 2000, 3000, 800)["count"] == []
+    with pytest.raises(KeyError):
+        rollup.read(["e"], 1000, 1001, 800)
+
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_rollup_out_of_order(monkeypatch, monkeyed_requests_get, cleanuptmp, test_proto_url, test_proto_mid):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    register_proto_from_url(test_proto_url)
+    layout = columns.get_layout(load_proto(test_proto_mid).Data1.DESCRIPTOR)
+    rollup = rollups.Rollup(layout, 3)
+
+    # records of a batch, and batches, may arrive out of receive time order
+    rollup.add([(1002, 2.0, 0.0, 0, 0, True), (1000, 0.0, 0.0, 0, 0, True)])
+    rollup.add([(1001, 1.0, 0.0, 0, 0, True)])
+    assert rollup.read(["a"], 1000, 1002, 800)["fields"]["a"]["last"] == [0.0, 1.0, 2.0]
+
+    # the tier is full, so the oldest bucket is evicted, not the first added
+    rollup.add([(1003, 3.0, 0.0, 0, 0, True)])
+    result = rollup.read(["a"], 1001, 1003, 800)
+    assert result["resolution"] == 1
+    assert result["apv_received_at"] == [1001, 1002, 1003]
+    assert result["fields"]["a"]["last"] == [1.0, 2.0, 3.0]
+    # and the 1 s tier no longer covers 1000
+    assert rollup.read(["a"], 1000, 1003, 800)["resolution"] == 10
+
+    del data.proto_data_structure[test_proto_mid]
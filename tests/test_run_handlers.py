@@ -2,10 +2,16 @@
 
 
 import hashlib
+import json
 import fakeredis
+import numpy
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
 from acumos_proto_viewer.run_handlers import MODEL_SELECTION, MESSAGE_SELECTION
-from acumos_proto_viewer.run_handlers import get_source_index, handle_data_post, handle_onap_mr_put, handle_onap_mr_delete, get_model_properties, get_modelid_messagename_type
-from acumos_proto_viewer import data
+from acumos_proto_viewer.run_handlers import get_source_index, handle_data_post_async, handle_data_batch_post_async, handle_ingest_stats_get, handle_onap_mr_put, handle_onap_mr_delete, get_model_properties, get_modelid_messagename_type, get_column_dtypes, to_typed_column
+from acumos_proto_viewer import data, run_handlers
+from acumos_proto_viewer.admission import AdmissionController
 
 
 def test_get_source_index():
@@ -28,9 +34,16 @@ def test_get_source_index():
 def test_handle_data_post(monkeypatch, monkeyed_requests_get, fake_msg, cleanuptmp,
                           test_proto_url, test_proto_mid, test_proto_with_arrays_url, test_proto_with_arrays_mid):
     """
-    Test run_handlers.handle_data_post
+    Test run_handlers.handle_data_post_async
     """
     monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._admission', None)
+    data.myredis = fakeredis.FakeStrictRedis()
+
+    def handle_data_post(headers, req_body):
+        code, status, _ = IOLoop.current().run_sync(lambda: handle_data_post_async(headers, req_body))
+        return code, status
+
     assert(test_proto_mid not in data.list_known_protobufs())
     assert(test_proto_with_arrays_mid not in data.list_known_protobufs())
     headers = {"PROTO-URL": test_proto_url, "Message-Name": "Data1"}
@@ -177,3 +190,101 @@ def test_get_modelid_messagename_type():
 
     assert ("amazing_model", "amazing_model_messages",
             "jsonschema") == get_modelid_messagename_type(FakeDoc2)
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_handle_data_post_async(monkeypatch, monkeyed_requests_get, fake_msg, executor,
+                                test_proto_url, test_proto_mid, test_proto_msg):
+    """
+    Test run_handlers.handle_data_post_async and handle_data_batch_post_async
+    """
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers.INGEST_EXECUTOR', executor)
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._io_pool', None)
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._admission', None)
+    data.myredis = fakeredis.FakeStrictRedis()
+
+    headers = {"PROTO-URL": test_proto_url, "Message-Name": test_proto_msg}
+    code, status, _ = IOLoop.current().run_sync(lambda: handle_data_post_async(headers, fake_msg()))
+    assert code == 200
+    assert status == fake_msg()
+    code, status, _ = IOLoop.current().run_sync(lambda: handle_data_post_async(headers, b"\xff\xff\xff"))
+    assert code == 400
+
+    body = b"".join(bytes([len(m)]) + m for m in [fake_msg(), fake_msg()])
+    code, status, _ = IOLoop.current().run_sync(lambda: handle_data_batch_post_async(headers, body))
+    assert code == 200
+    assert json.loads(status) == {"accepted": 2, "rejected": 0}
+    assert data.get_raw_data_source_count(test_proto_mid, test_proto_msg) == 3
+    code, status, _ = IOLoop.current().run_sync(lambda: handle_data_batch_post_async(headers, b"\x03\xff\xff\xff"))
+    assert code == 400
+    assert json.loads(status) == {"accepted": 0, "rejected": 1}
+
+    code, status, _ = IOLoop.current().run_sync(lambda: handle_data_post_async({"Message-Name": "Data1"}, b""))
+    assert code == 400
+    assert status == "Error: PROTO-URL or Message-Name header missing."
+
+    run_handlers._decode_pool.shutdown()
+    run_handlers._io_pool.shutdown()
+    data.myredis.flushall()
+    del data.proto_data_structure[test_proto_mid]
+
+
+def test_start_pools_forks_workers(monkeypatch):
+    """
+    The decoding processes exist once start_pools returns, before any request
+    """
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers.INGEST_EXECUTOR', "process")
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers.INGEST_WORKERS', 2)
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._io_pool', None)
+    run_handlers.start_pools()
+    assert len(run_handlers._decode_pool._processes) == 2
+    run_handlers._decode_pool.shutdown()
+    run_handlers._io_pool.shutdown()
+
+
+def test_handle_data_post_async_admission(monkeypatch):
+    """
+    Test the 429 answers of the asynchronous handlers and handle_ingest_stats_get
+    """
+    @gen.coroutine
+    def fake_ingest_one(proto_url, message_name, req_body):
+        return 200, req_body
+
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._ingest_one', fake_ingest_one)
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._admission', AdmissionController(10, 1, 2, clock=lambda: 0.0))
+    headers = {"PROTO-URL": "someurl", "Message-Name": "Data1"}
+    for _ in range(2):
+        code, status, resp_headers = IOLoop.current().run_sync(lambda: handle_data_post_async(headers, b"x"))
+        assert code == 200
+        assert resp_headers == {}
+    code, status, resp_headers = IOLoop.current().run_sync(lambda: handle_data_post_async(headers, b"x"))
+    assert code == 429
+    assert resp_headers == {"Retry-After": "1"}
+
+    # the rate limit is per model
+    other = {"PROTO-URL": "otherurl", "Message-Name": "Data1"}
+    code, status, resp_headers = IOLoop.current().run_sync(lambda: handle_data_post_async(other, b"x"))
+    assert code == 200
+
+    monkeypatch.setattr('acumos_proto_viewer.run_handlers._admission', AdmissionController(0, 1, 0))
+    code, status, resp_headers = IOLoop.current().run_sync(lambda: handle_data_batch_post_async(headers, b"\x01x"))
+    assert code == 429
+    code, status = handle_ingest_stats_get()
+    assert code == 200
+    assert json.loads(status)["rejected_queue_full"] == 1
+
+
+def test_typed_columns(monkeypatch):
+    monkeypatch.setitem(data.proto_data_structure, "m", {"messages": {"a": {"properties_flat": {
+        "x": {"type": "number"}, "i.n": {"type": "integer"}, "s": {"type": "string"}, "r": {"type": "array"}}}}})
+    monkeypatch.setitem(data.jsonschema_data_structure, "t", {"json_schema": {"properties": {"x": {"type": ["number", "null"]}}}})
+    assert get_column_dtypes("m", "a", "protobuf", ["x", "i.n", "s", "r", "unknown"]) == {"x": "float64", "i.n": "float64", "s": None, "r": None, "unknown": None}
+    assert get_column_dtypes("t", "t_messages", "jsonschema", ["x"]) == {"x": None}
+
+    column = to_typed_column([1, 2.5, None], "float64")
+    assert column.dtype == numpy.float64
+    assert column[:2].tolist() == [1.0, 2.5] and numpy.isnan(column[2])
+    # other columns, and values that are not numbers, stay lists
+    for values, dtype in [(["a", "b"], None), (["a", "b"], "float64"), ([{"k": 1}], "float64")]:
+        assert to_typed_column(values, dtype) is values
@@ -0,0 +1,102 @@
+# Acumos - Apache 2.0
+
+
+import os
+from threading import Thread
+import time
+from acumos_proto_viewer import segments
+from acumos_proto_viewer.segments import SegmentBackend
+
+
+def _records(first, n):
+    return ["record {0}".format(i).encode() * (1 + i % 3) for i in range(first, first + n)]
+
+
+def test_segment_log(tmp_path):
+    # segments of 128 bytes hold a few records each
+    backend = SegmentBackend(str(tmp_path / "small"), 128, 3600, 0)
+    assert backend.count("m", "a") == 0
+    assert backend.read("m", "a", 0, -1) == ([], [])
+    assert backend.append("m", "a", _records(0, 10), {}) == 0
+    assert backend.append("m", "a", _records(10, 90), {}) == 10
+    assert backend.append("m", "b", _records(0, 1), {}) == 0
+    assert backend.count("m", "a") == 100
+    key = SegmentBackend._stream_key("m", "a")
+    assert len(backend._logs[key]) > 10
+    positions, records = backend.read("m", "a", 0, -1)
+    assert list(positions) == list(range(100))
+    assert records == _records(0, 100)
+    assert backend.read("m", "a", 37, 71)[1] == _records(37, 35)
+    assert backend.read("m", "a", -3, -2)[1] == _records(97, 2)
+    assert backend.read("m", "a", 100, -1)[1] == []
+    # a record larger than a segment gets a segment of its own
+    assert backend.append("m", "a", [b"x" * 1000], {}) == 100
+    assert backend.read("m", "a", -2, -1)[1] == _records(99, 1) + [b"x" * 1000]
+
+    # the sparse index is used past the first entries of a segment
+    big = SegmentBackend(str(tmp_path / "big"), 1 << 20, 3600, 0)
+    big.append("m", "a", _records(0, 1000), {})
+    assert big.read("m", "a", 130, 200)[1] == _records(130, 71)
+    assert len(big._logs[key][0].index) == 1000 // segments.INDEX_INTERVAL + 1
+
+    # a restart finds the records where they were, also with a lost index and a torn write
+    big._logs[key][-1].seal()
+    path = big._logs[key][0].path
+    with open(path + ".idx", "r+b") as index_file:
+        index_file.truncate(3 * 8)
+    with open(path + ".log", "r+b") as log_file:
+        log_file.seek(big._logs[key][0].end)
+        log_file.write(b"\x05\x00\x00\x00\x00\x00\x00\x00torn")
+    big = SegmentBackend(str(tmp_path / "big"), 1 << 20, 3600, 0)
+    assert big.count("m", "a") == 1000
+    assert big.read("m", "a", 0, -1)[1] == _records(0, 1000)
+    assert len(big._logs[key][0].index) == 1000 // segments.INDEX_INTERVAL + 1
+    assert big.append("m", "a", _records(1000, 1), {}) == 1000
+    backend = SegmentBackend(str(tmp_path / "small"), 128, 3600, 0)
+    assert backend.count("m", "a") == 101
+    assert backend.read("m", "a", 0, 99)[1] == _records(0, 100)
+    assert backend.read("m", "b", 0, -1)[1] == _records(0, 1)
+
+
+def test_segment_expiry(monkeypatch, tmp_path):
+    now = [time.time()]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    backend = SegmentBackend(str(tmp_path), 128, 3600, 1024)
+    key = SegmentBackend._stream_key("m", "a")
+
+    # over the size cap, the oldest segments go
+    backend.append("m", "a", _records(0, 100), {})
+    assert sum(s.end for s in backend._logs[key]) <= 1024
+    positions, records = backend.read("m", "a", 0, -1)
+    assert positions[0] > 0 and positions[-1] == 99
+    assert records == _records(positions[0], 100 - positions[0])
+    assert not [name for name in os.listdir(str(tmp_path / key)) if int(name[:20]) < positions[0]]
+
+    # past their age, every segment goes, and the positions go on
+    backend.append("m", "b", _records(0, 1), {"digest": b"blob"})
+    assert backend.get_blob("digest") == b"blob"
+    now[0] += 3601
+    os.utime(backend._logs[key][-1].path + ".log", (now[0] - 3601, now[0] - 3601))
+    backend.append("m", "b", _records(1, 100), {})
+    assert backend.read("m", "b", 0, -1)[0][0] > 1
+    assert backend.count("m", "a") == 100
+    assert backend.read("m", "a", 0, -1) == (range(0), [])
+    now[0] += 60 * 60 * 24
+    backend = SegmentBackend(str(tmp_path), 128, 3600, 1024)
+    assert backend.get_blob("digest") is None
+    assert backend.append("m", "a", _records(100, 1), {}) == 100
+
+
+def test_segment_wait_flags(tmp_path):
+    backend = SegmentBackend(str(tmp_path), 1024, 3600, 0)
+    assert not backend.wait("m", "a", 0, 10)
+    writer = Thread(target=lambda: (time.sleep(0.1), backend.append("m", "a", [b"r0"], {})))
+    writer.start()
+    assert backend.wait("m", "a", 0, 5000)
+    writer.join()
+    assert not backend.wait("m", "a", 1, 10)
+    assert backend.set_flag("topic")
+    assert not backend.set_flag("topic")
+    assert backend.get_flag("topic")
+    assert backend.delete_flag("topic")
+    assert not backend.get_flag("topic")
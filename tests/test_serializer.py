@@ -0,0 +1,82 @@
+# Acumos - Apache 2.0
+
+
+import pytest
+from acumos_proto_viewer.utils import load_proto, register_proto_from_url
+from acumos_proto_viewer import data, serializer
+
+
+def test_binary_round_trip(monkeypatch, monkeyed_requests_get, cleanuptmp,
+                           test_proto_url, test_proto_mid, test_proto_with_arrays_url, test_proto_with_arrays_mid):
+    monkeypatch.setattr('requests.get', monkeyed_requests_get)
+    register_proto_from_url(test_proto_url)
+    register_proto_from_url(test_proto_with_arrays_url)
+    test = load_proto(test_proto_mid)
+    # registration compiles the codecs, so the first record does not
+    assert test.Data2.DESCRIPTOR in serializer._codecs
+    m = test.Data2()
+    m.a.a = 1e300
+    m.a.b = 666.666
+    m.a.c = -5
+    m.a.d = -77777777777777
+    m.a.e = True
+    m.a.f = "hélives"
+    m.a.g = b'\x00\x01'
+    m.b["k"].d = 6
+    m.b["l"].f = "x"
+    m.c["j"] = 7
+    m.c["é"] = -8
+    m.d.add(d=8)
+    m.e.extend([9, -10])
+    arrays = load_proto(test_proto_with_arrays_mid).ImageTagSet(
+        image=[1, 2 ** 40], tag=["fish", ""], score=[0.5, float("inf"), float("-inf")])
+    for msg in [m, test.Data2(), arrays, test.Data1()]:
+        record = data._msg_to_dict(msg, 55555555555)
+        raw = serializer.dumps("binary", record, msg.DESCRIPTOR)
+        assert raw[:1] == b"S"
+        assert serializer.needs_schema(raw)
+        assert serializer.loads(raw, 3, msg.DESCRIPTOR) == data._msg_to_dict(msg, 55555555555, 3)
+
+    # a blob reference survives
+    record = data._msg_to_dict(test.Data1(), 1)
+    record["g"] = serializer.BlobRef("ab" * 32, 1000)
+    loaded = serializer.loads(serializer.dumps("binary", record, test.Data1.DESCRIPTOR), 1, test.Data1.DESCRIPTOR)
+    assert loaded["g"] == record["g"]
+    assert loaded["g"].size == 1000
+
+    cleanuptmp()
+
+
+def test_schemaless_formats():
+    record = {"value": 1.5, "nested": {"x": [1, 2], "apv_received_at": 5}, "apv_received_at": 5}
+    for name, marker in [("json", b"J"), ("pickle", b"\x80"), ("binary", b"J")]:
+        # without a descriptor binary falls back to json
+        raw = serializer.dumps(name, record)
+        assert raw[:1] == marker
+        assert not serializer.needs_schema(raw)
+        loaded = serializer.loads(raw, 2, trusted=True)
+        assert loaded["apv_sequence_number"] == 2
+        assert loaded["nested"]["apv_sequence_number"] == 2
+        assert loaded["value"] == 1.5
+
+    # loading a pickle may run any code, so it takes a trusted writer
+    with pytest.raises(ValueError):
+        serializer.loads(serializer.dumps("pickle", record), 2)
+    assert serializer.loads(serializer.dumps("json", record), 2)["value"] == 1.5
+
+    with pytest.raises(ValueError):
+        serializer.dumps("yaml", record)
+    with pytest.raises(ValueError):
+        serializer.loads(b"?", 1)
+
+
+def test_register_format():
+    fmt = serializer.RecordFormat(b"T", lambda record, descriptor: b"T" + repr(record).encode(),
+                                  lambda raw, descriptor, sequence_no: {"text": raw[1:].decode(), "apv_sequence_number": sequence_no},
+                                  False)
+    serializer.register_format("text", fmt)
+    try:
+        assert serializer.loads(serializer.dumps("text", {"a": 1}), 4) == {"text": "{'a': 1}", "apv_sequence_number": 4}
+    finally:
+        del serializer._formats["text"]
+        del serializer._formats_by_marker[b"T"]
@@ -0,0 +1,62 @@
+# Acumos - Apache 2.0
+
+
+import pytest
+from threading import Thread
+import time
+from acumos_proto_viewer.storage import MemoryBackend, StorageBackend
+
+
+def test_memory_backend_ring():
+    backend = MemoryBackend(4)
+    assert backend.count("m", "a") == 0
+    assert backend.read("m", "a", 0, -1) == ([], [])
+    assert backend.append("m", "a", ["r0", "r1", "r2"], {}) == 0
+    assert backend.append("m", "a", ["r3", "r4"], {}) == 3
+    assert backend.count("m", "a") == 5
+    positions, records = backend.read("m", "a", 0, -1)
+    assert list(positions) == [1, 2, 3, 4]
+    assert records == ["r1", "r2", "r3", "r4"]
+    assert backend.read("m", "a", 2, 3)[1] == ["r2", "r3"]
+    assert backend.read("m", "a", -1, -1)[1] == ["r4"]
+    assert backend.read("m", "a", 5, -1)[1] == []
+    assert backend.count("m", "b") == 0
+
+    # a batch larger than the ring keeps its last records and counts them all
+    assert backend.append("m", "a", ["s{0}".format(i) for i in range(6)], {}) == 5
+    positions, records = backend.read("m", "a", 0, -1)
+    assert list(positions) == [7, 8, 9, 10]
+    assert records == ["s2", "s3", "s4", "s5"]
+
+
+def test_memory_backend_wait():
+    backend = MemoryBackend(10)
+    assert not backend.wait("m", "a", 0, 10)
+    writer = Thread(target=lambda: (time.sleep(0.1), backend.append("m", "a", ["r0"], {})))
+    writer.start()
+    started = time.monotonic()
+    assert backend.wait("m", "a", 0, 5000)
+    assert time.monotonic() - started < 4
+    writer.join()
+    assert backend.wait("m", "a", 0, 10)
+    assert not backend.wait("m", "a", 1, 10)
+
+
+def test_memory_backend_flags():
+    backend = MemoryBackend(1)
+    assert not backend.get_flag("topic")
+    assert backend.set_flag("topic")
+    assert not backend.set_flag("topic")
+    assert backend.get_flag("topic")
+    assert backend.delete_flag("topic")
+    assert not backend.delete_flag("topic")
+    assert not backend.get_flag("topic")
+
+
+def test_incomplete_backend():
+    class ReadOnlyBackend(StorageBackend):
+        def count(self, model_id, message_name):
+            return 0
+
+    with pytest.raises(TypeError):
+        ReadOnlyBackend()